@@ -9,13 +9,50 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from authentication import (
     AuthError,
+    setup_auth,
     requires_auth
 )
 from models import (
     Movie,
     Actor,
     setup_db,
-    get_db
+    get_db,
+    parse_date,
+    add_cast,
+    remove_cast
+)
+from pagination import get_page_args, paginate
+from filtering import (
+    ACTOR_SORTS,
+    MOVIE_SORTS,
+    get_sort,
+    filter_actors,
+    filter_movies
+)
+from streaming import wants_stream, stream_ndjson
+from versions import read_versions, table_etag, row_etag, not_modified
+from cache import DETAIL_CACHE, cached_response
+from fields import get_fields, select_fields, format_fields
+from fastjson import fast_path_enabled, get_encoder
+from expand import get_expand, expand_tables
+from timing import setup_timing, timed
+from querylog import setup_query_log
+from metrics import setup_metrics
+from ratelimit import AdmissionError, setup_admission
+from groupcommit import setup_group_commit
+from stats import actor_stats, movie_stats
+from replicas import setup_replicas
+from bulk import (
+    ACTOR_FILTERS,
+    MOVIE_FILTERS,
+    get_bulk_items,
+    bulk_create,
+    bulk_update,
+    bulk_delete,
+    validate_actor,
+    validate_movie,
+    validate_actor_changes,
+    validate_movie_changes
 )
 import sys
 
@@ -23,7 +60,16 @@ import sys
 def create_app(test_config=None):
     # Create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    setup_auth(app)
+    setup_query_log(app, get_db().engine)
+    setup_replicas(app)
+    setup_group_commit(app, get_db().engine)
+    setup_timing(app)
+    setup_metrics(app)
+    setup_admission(app)
     CORS(app)
 
     @app.route('/', methods=['GET'])
@@ -32,40 +78,110 @@ def create_app(test_config=None):
             'message': 'Welcome to the Casting-App'
         })
 
-    # Gets all actors in the db
+    # Gets a page of the actors in the db matching the filters,
+    # ordered by the sort key (id by default)
     # Returns json containing an array of the actors
+    # and the cursor of the next page
+    # or every matching actor as NDJSON when streaming is requested
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
     def get_actors(payload):
         actors_obj = []
         actors_formatted = []
+        fields = get_fields(Actor)
+        if wants_stream():
+            return stream_ndjson(
+                filter_actors(select_fields(Actor, fields)), Actor,
+                lambda row: format_fields([row], Actor, fields)[0])
+        limit, after = get_page_args()
+        sort, descending = get_sort(Actor, ACTOR_SORTS)
+        expand = get_expand(Actor)
+        etag = table_etag(read_versions(), 'actors')
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
 
         try:
-            actors_obj = Actor.query.all()
-            actors_formatted = [actor.format() for actor in actors_obj]
-            return jsonify({
-                "success": True,
-                "actors": actors_formatted
-                })
+            if fast_path_enabled(expand):
+                encoder = get_encoder(Actor, fields)
+                query = filter_actors(encoder.select(Actor.id, sort))
+                actors_obj, next_cursor = paginate(
+                    query, Actor, limit, after, sort, descending)
+                with timed('serialize'):
+                    response = app.response_class(
+                        encoder.encode_page('actors', actors_obj, next_cursor),
+                        mimetype=app.config['JSONIFY_MIMETYPE'])
+                response.set_etag(etag)
+                return response
+
+            query = filter_actors(
+                select_fields(Actor, fields, expand, sort))
+            actors_obj, next_cursor = paginate(
+                query, Actor, limit, after, sort, descending)
+            with timed('serialize'):
+                actors_formatted = format_fields(
+                    actors_obj, Actor, fields, expand)
+                response = jsonify({
+                    "success": True,
+                    "actors": actors_formatted,
+                    "next_cursor": next_cursor
+                    })
+            response.set_etag(etag)
+            return response
         except Exception:
             print(sys.exc_info())
             abort(422)
 
-    # Gets all movies in the db
+    # Gets a page of the movies in the db matching the filters,
+    # ordered by the sort key (id by default)
     # Returns json containing an array of the movies
+    # and the cursor of the next page
+    # or every matching movie as NDJSON when streaming is requested
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
     def get_movies(payload):
         movies_obj = []
         movies_formatted = []
+        fields = get_fields(Movie)
+        if wants_stream():
+            return stream_ndjson(
+                filter_movies(select_fields(Movie, fields)), Movie,
+                lambda row: format_fields([row], Movie, fields)[0])
+        limit, after = get_page_args()
+        sort, descending = get_sort(Movie, MOVIE_SORTS)
+        expand = get_expand(Movie)
+        etag = table_etag(read_versions(), 'movies')
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
 
         try:
-            movies_obj = Movie.query.all()
-            movies_formatted = [movie.format() for movie in movies_obj]
-            return jsonify({
-                "success": True,
-                "movies": movies_formatted
-                })
+            if fast_path_enabled(expand):
+                encoder = get_encoder(Movie, fields)
+                query = filter_movies(encoder.select(Movie.id, sort))
+                movies_obj, next_cursor = paginate(
+                    query, Movie, limit, after, sort, descending)
+                with timed('serialize'):
+                    response = app.response_class(
+                        encoder.encode_page('movies', movies_obj, next_cursor),
+                        mimetype=app.config['JSONIFY_MIMETYPE'])
+                response.set_etag(etag)
+                return response
+
+            query = filter_movies(
+                select_fields(Movie, fields, expand, sort))
+            movies_obj, next_cursor = paginate(
+                query, Movie, limit, after, sort, descending)
+            with timed('serialize'):
+                movies_formatted = format_fields(
+                    movies_obj, Movie, fields, expand)
+                response = jsonify({
+                    "success": True,
+                    "movies": movies_formatted,
+                    "next_cursor": next_cursor
+                    })
+            response.set_etag(etag)
+            return response
         except Exception:
             print(sys.exc_info())
             abort(422)
@@ -75,14 +191,38 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['GET'])
     @requires_auth('get:actors')
     def get_actor(payload, actor_id):
+        expand = get_expand(Actor)
+        fields = get_fields(Actor)
+        variant = ','.join(fields or ())
+        versions = read_versions('actors', actor_id)
+        etag = row_etag(versions, 'actors', actor_id,
+                        *expand_tables(Actor, expand))
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        # only plain detail bodies are cached, expanded ones embed other rows
+        if not expand:
+            body, age = DETAIL_CACHE.get(
+                'actors', actor_id, versions.row, variant)
+            if body is not None:
+                return cached_response(body, age, etag)
+
         try:
-            actor_obj = Actor.query.filter_by(id=actor_id).one_or_none()
+            actor_obj = select_fields(Actor, fields, expand) \
+                .filter(Actor.id == actor_id).one_or_none()
             if actor_obj is None:
                 abort(422)
-            return jsonify({
-                "success": True,
-                "actor": actor_obj.format()
-                })
+            with timed('serialize'):
+                response = jsonify({
+                    "success": True,
+                    "actor": format_fields(
+                        [actor_obj], Actor, fields, expand)[0]
+                    })
+            response.set_etag(etag)
+            if not expand:
+                DETAIL_CACHE.put('actors', actor_id, versions.row,
+                                 response.get_data(), variant)
+            return response
         except Exception:
             print(sys.exc_info())
             abort(422)
@@ -92,18 +232,190 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth('get:movies')
     def get_movie(payload, movie_id):
+        expand = get_expand(Movie)
+        fields = get_fields(Movie)
+        variant = ','.join(fields or ())
+        versions = read_versions('movies', movie_id)
+        etag = row_etag(versions, 'movies', movie_id,
+                        *expand_tables(Movie, expand))
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        # only plain detail bodies are cached, expanded ones embed other rows
+        if not expand:
+            body, age = DETAIL_CACHE.get(
+                'movies', movie_id, versions.row, variant)
+            if body is not None:
+                return cached_response(body, age, etag)
+
+        try:
+            movie_obj = select_fields(Movie, fields, expand) \
+                .filter(Movie.id == movie_id).one_or_none()
+            if movie_obj is None:
+                abort(422)
+            with timed('serialize'):
+                response = jsonify({
+                    "success": True,
+                    "movie": format_fields(
+                        [movie_obj], Movie, fields, expand)[0]
+                    })
+            response.set_etag(etag)
+            if not expand:
+                DETAIL_CACHE.put('movies', movie_id, versions.row,
+                                 response.get_data(), variant)
+            return response
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Gets the cast of a movie
+    # Returns json containing an array of the actors in the movie
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_movie_actors(payload, movie_id):
+        etag = row_etag(read_versions('movies', movie_id), 'movies',
+                        movie_id, 'actors')
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
         try:
             movie_obj = Movie.query.filter_by(id=movie_id).one_or_none()
             if movie_obj is None:
                 abort(422)
+            response = jsonify({
+                "success": True,
+                "actors": [actor.format() for actor in movie_obj.actors]
+                })
+            response.set_etag(etag)
+            return response
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Gets the movies an actor is cast in
+    # Returns json containing an array of the movies of the actor
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor_movies(payload, actor_id):
+        etag = row_etag(read_versions('actors', actor_id), 'actors',
+                        actor_id, 'movies')
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        try:
+            actor_obj = Actor.query.filter_by(id=actor_id).one_or_none()
+            if actor_obj is None:
+                abort(422)
+            response = jsonify({
+                "success": True,
+                "movies": [movie.format() for movie in actor_obj.movies]
+                })
+            response.set_etag(etag)
+            return response
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Gets the number of actors by gender and by age decade
+    # Returns json containing the counts, read from the summary table
+    @app.route('/stats/actors', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor_stats(payload):
+        etag = table_etag(read_versions(), 'actors')
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        try:
+            response = jsonify({
+                "success": True,
+                "actors": actor_stats()
+                })
+            response.set_etag(etag)
+            return response
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Gets the number of movies by release year
+    # Returns json containing the counts, read from the summary table
+    @app.route('/stats/movies', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_movie_stats(payload):
+        etag = table_etag(read_versions(), 'movies')
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+
+        try:
+            response = jsonify({
+                "success": True,
+                "movies": movie_stats()
+                })
+            response.set_etag(etag)
+            return response
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Casts actors in a movie
+    # Returns the ids of the actors added to the cast
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @requires_auth('patch: movie')
+    def cast_movie_actors(payload, movie_id):
+        try:
+            body = request.get_json()
+            actor_ids = body.get('actor_ids')
+            if not isinstance(actor_ids, list) or not actor_ids:
+                abort(422)
+            if not all(isinstance(i, int) for i in actor_ids):
+                abort(422)
+            if Movie.query.filter_by(id=movie_id).one_or_none() is None:
+                abort(422)
+            added = add_cast(movie_id, actor_ids)
+
+            return jsonify({
+                "success": True,
+                "added": added
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            get_db().session.rollback()
+            abort(422)
+
+        finally:
+            get_db().session.close()
+
+    # Removes actors from the cast of a movie
+    # Returns the number of actors removed from the cast
+    @app.route('/movies/<int:movie_id>/actors', methods=['DELETE'])
+    @requires_auth('patch: movie')
+    def uncast_movie_actors(payload, movie_id):
+        try:
+            body = request.get_json()
+            actor_ids = body.get('actor_ids')
+            if not isinstance(actor_ids, list) or not actor_ids:
+                abort(422)
+            if not all(isinstance(i, int) for i in actor_ids):
+                abort(422)
+            removed = remove_cast(movie_id, actor_ids)
+
             return jsonify({
                 "success": True,
-                "movie": movie_obj.format()
+                "removed": removed
                 })
+
         except Exception:
             print(sys.exc_info())
+            get_db().session.rollback()
             abort(422)
 
+        finally:
+            get_db().session.close()
+
     # Creates an actor in the db if all fields are given
     # Returns the created actor as a dict representation
     @app.route('/actors', methods=['POST'])
@@ -120,8 +432,13 @@ def create_app(test_config=None):
                 abort(422)
             if gender is None:
                 abort(422)
-            actor = Actor(name=name, age=age, gender=gender)
-            actor.insert()
+            group_commit = app.extensions['group_commit']
+            if group_commit is not None:
+                actor = group_commit.insert(
+                    Actor, {'name': name, 'age': age, 'gender': gender})
+            else:
+                actor = Actor(name=name, age=age, gender=gender)
+                actor.insert()
 
             return jsonify({
                 "success": True,
@@ -135,12 +452,47 @@ def create_app(test_config=None):
         finally:
             get_db().session.close()
 
+    # Creates many actors in the db in a single transaction
+    # Takes a json array (or NDJSON) of actors
+    # Returns the created actors and the errors of the rejected items
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actor')
+    def create_actors_bulk(payload):
+        items = get_bulk_items()
+        try:
+            created, errors = bulk_create(Actor, items, validate_actor)
+
+            return jsonify({
+                "success": not errors,
+                "actors": [actor.format() for actor in created],
+                "errors": errors
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            get_db().session.rollback()
+            abort(422)
+
+        finally:
+            get_db().session.close()
+
     # Modifies an actor in the db
     # Returns the modified actor as a dict represention
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actor')
     def modify_actor(payload, actor_id):
         try:
+            group_commit = app.extensions['group_commit']
+            if group_commit is not None:
+                body = request.get_json()
+                actor = group_commit.update(Actor, actor_id, {
+                    column: body.get(column)
+                    for column in ('name', 'age', 'gender')})
+                return jsonify({
+                    "success": True,
+                    "actor": actor.format()
+                    })
+
             actor = Actor.query.filter_by(id=actor_id).one_or_none()
             if actor is None:
                 abort(422)
@@ -171,6 +523,34 @@ def create_app(test_config=None):
         finally:
             get_db().session.close()
 
+    # Modifies every actor selected by ids or filter in one statement
+    # Returns the modified actors, or their count with ?return=count
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actor')
+    def modify_actors_bulk(payload):
+        try:
+            changed = bulk_update(Actor, ACTOR_FILTERS,
+                                  validate_actor_changes)
+            if isinstance(changed, int):
+                return jsonify({
+                    "success": True,
+                    "count": changed
+                    })
+
+            return jsonify({
+                "success": True,
+                "count": len(changed),
+                "actors": [actor.format() for actor in changed]
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            get_db().session.rollback()
+            abort(422)
+
+        finally:
+            get_db().session.close()
+
     # Creates a movie in the db
     # Returns the movie as a dict representation
     @app.route('/movies', methods=['POST'])
@@ -185,9 +565,15 @@ def create_app(test_config=None):
                 abort(422)
             if release_date is None:
                 abort(422)
+            release_date = parse_date(release_date)
 
-            movie = Movie(title=title, release_date=release_date)
-            movie.insert()
+            group_commit = app.extensions['group_commit']
+            if group_commit is not None:
+                movie = group_commit.insert(
+                    Movie, {'title': title, 'release_date': release_date})
+            else:
+                movie = Movie(title=title, release_date=release_date)
+                movie.insert()
 
             return jsonify({
                 "success": True,
@@ -202,12 +588,49 @@ def create_app(test_config=None):
         finally:
             get_db().session.close()
 
+    # Creates many movies in the db in a single transaction
+    # Takes a json array (or NDJSON) of movies
+    # Returns the created movies and the errors of the rejected items
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movie')
+    def create_movies_bulk(payload):
+        items = get_bulk_items()
+        try:
+            created, errors = bulk_create(Movie, items, validate_movie)
+
+            return jsonify({
+                "success": not errors,
+                "movies": [movie.format() for movie in created],
+                "errors": errors
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            get_db().session.rollback()
+            abort(422)
+
+        finally:
+            get_db().session.close()
+
     # Modifies a movie in the db
     # Returns the movie as dict representation
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch: movie')
     def modify_movie(payload, movie_id):
         try:
+            group_commit = app.extensions['group_commit']
+            if group_commit is not None:
+                body = request.get_json()
+                release_date = body.get('release_date')
+                movie = group_commit.update(Movie, movie_id, {
+                    'title': body.get('title'),
+                    'release_date': parse_date(release_date)
+                    if release_date is not None else None})
+                return jsonify({
+                    "success": True,
+                    "movie": movie.format()
+                    })
+
             movie = Movie.query.filter_by(id=movie_id).one_or_none()
             if movie is None:
                 abort(422)
@@ -218,7 +641,7 @@ def create_app(test_config=None):
             if title is not None:
                 movie.title = title
             if release_date is not None:
-                movie.release_date = release_date
+                movie.release_date = parse_date(release_date)
 
             movie_formatted = movie.format()
             movie.update()
@@ -236,6 +659,34 @@ def create_app(test_config=None):
         finally:
             get_db().session.close()
 
+    # Modifies every movie selected by ids or filter in one statement
+    # Returns the modified movies, or their count with ?return=count
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch: movie')
+    def modify_movies_bulk(payload):
+        try:
+            changed = bulk_update(Movie, MOVIE_FILTERS,
+                                  validate_movie_changes)
+            if isinstance(changed, int):
+                return jsonify({
+                    "success": True,
+                    "count": changed
+                    })
+
+            return jsonify({
+                "success": True,
+                "count": len(changed),
+                "movies": [movie.format() for movie in changed]
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            get_db().session.rollback()
+            abort(422)
+
+        finally:
+            get_db().session.close()
+
     # Deletes an actor from the db
     # Returns the deleted actor in dict format
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
@@ -261,6 +712,33 @@ def create_app(test_config=None):
         finally:
             get_db().session.close()
 
+    # Deletes every actor selected by ids or filter in one statement
+    # Returns the deleted actors, or their count with ?return=count
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    def delete_actors_bulk(payload):
+        try:
+            changed = bulk_delete(Actor, ACTOR_FILTERS)
+            if isinstance(changed, int):
+                return jsonify({
+                    "success": True,
+                    "count": changed
+                    })
+
+            return jsonify({
+                "success": True,
+                "count": len(changed),
+                "actors": [actor.format() for actor in changed]
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            get_db().session.rollback()
+            abort(422)
+
+        finally:
+            get_db().session.close()
+
     # Deletes a movie from the db
     # Returns the deleted movie in dict representation
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
@@ -286,6 +764,33 @@ def create_app(test_config=None):
         finally:
             get_db().session.close()
 
+    # Deletes every movie selected by ids or filter in one statement
+    # Returns the deleted movies, or their count with ?return=count
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    def delete_movies_bulk(payload):
+        try:
+            changed = bulk_delete(Movie, MOVIE_FILTERS)
+            if isinstance(changed, int):
+                return jsonify({
+                    "success": True,
+                    "count": changed
+                    })
+
+            return jsonify({
+                "success": True,
+                "count": len(changed),
+                "movies": [movie.format() for movie in changed]
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            get_db().session.rollback()
+            abort(422)
+
+        finally:
+            get_db().session.close()
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
@@ -326,11 +831,19 @@ def create_app(test_config=None):
             "message": error.error,
             }), error.status_code
 
-    return app
+    @app.errorhandler(AdmissionError)
+    def admission_error(error):
+        response = jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": error.error,
+            })
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, error.status_code
 
+    return app
 
-APP = create_app()
 
 if __name__ == '__main__':
-    APP.run()
-    # APP.run(host='0.0.0.0', port=8080, debug=False)
+    create_app().run()
+    # create_app().run(host='0.0.0.0', port=8080, debug=False)
@@ -0,0 +1,571 @@
+import json
+import os
+import sys
+from contextlib import asynccontextmanager
+from functools import wraps
+from http import HTTPStatus
+from sqlalchemy import select
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException as RoutingError
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.http import parse_etags, quote_etag
+from authentication import (
+    AUTH_SETTINGS,
+    AuthError,
+    get_token_auth_header,
+    verify_decode_jwt,
+    check_permissions
+)
+from jwks import create_jwks_store
+from tokencache import create_token_cache
+from ratelimit import AdmissionError, create_rate_limiter, create_admission
+from models import Movie, Actor, parse_date, rows_changed
+from asyncdb import create_async_db, paginate, related_rows, format_expanded
+from pagination import get_page_args
+from filtering import (
+    ACTOR_SORTS,
+    MOVIE_SORTS,
+    get_sort,
+    filter_actors,
+    filter_movies
+)
+from fields import FIELDS, get_fields
+from fastjson import row_encoder
+from expand import get_expand, expand_tables
+from versions import Versions, versions_statement, table_etag, row_etag
+
+
+'''
+ASGI app
+An async build of the API on Starlette and the asyncio engine of
+asyncdb.py, for workloads that hold many slow or idle connections open:
+a request waiting on the database costs a coroutine instead of a thread.
+
+    uvicorn --factory asgi:create_app --workers $WEB_CONCURRENCY
+
+It serves the same routes with the same models, permissions, AuthError
+bodies, ETags and JSON bodies as app.py (list and detail bodies come from
+the same encoders, byte for byte):
+
+    GET / and the paged list, detail and casting reads
+    POST, PATCH and DELETE of single actors and movies
+
+Rate limiting and load shedding (ratelimit.py) apply with the same
+settings; the in-flight cap counts the requests of the event loop.
+NDJSON streaming, the bulk endpoints, casting writes, the detail cache,
+Server-Timing and /metrics stay with the WSGI app. ETags are built from
+the same database versions (versions.py), so they stay consistent when
+both apps run side by side.
+'''
+
+
+ERROR_MESSAGES = {
+    404: 'resource not found',
+    405: 'method not allowed',
+    422: 'unprocessable',
+    500: 'server error'
+}
+
+
+# The body jsonify() writes under its default settings
+def json_response(data, status_code=200, etag=None):
+    body = json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n'
+    return encoded_response(body, etag, status_code)
+
+
+def encoded_response(body, etag=None, status_code=200):
+    headers = {'ETag': quote_etag(etag)} if etag is not None else None
+    return Response(body, status_code, headers,
+                    media_type='application/json')
+
+
+# Path and query string as Flask's request.full_path has them
+def full_path(request):
+    return request.url.path + '?' + request.scope['query_string'].decode()
+
+
+# Reads the versions behind the ETags, see read_versions in versions.py
+async def read_versions(session, table=None, row_id=None):
+    return Versions(*(await session.execute(
+        versions_statement(table, row_id))).one())
+
+
+# Returns a 304 response if the client already holds the representation
+def not_modified(request, etag):
+    if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+        return Response(status_code=304, headers={'ETag': quote_etag(etag)})
+    return None
+
+
+def admission_response(error):
+    response = json_response({
+        "success": False,
+        "error": error.status_code,
+        "message": error.error
+        }, error.status_code)
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def error_response(status_code):
+    message = ERROR_MESSAGES.get(status_code,
+                                 HTTPStatus(status_code).phrase.lower())
+    return json_response({
+        "success": False,
+        "error": status_code,
+        "message": message
+        }, status_code)
+
+
+'''
+requires_auth(permission) for async routes
+The token cache and permission check of authentication.py; only a token
+missing from the cache is verified, in the thread pool, since verifying
+may refetch the JWKS over the network.
+'''
+
+
+def requires_auth(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request):
+            state = request.app.state
+            token = get_token_auth_header(request.headers)
+            verified = state.token_cache.get(token)
+            if verified is None:
+                payload = await run_in_threadpool(
+                    verify_decode_jwt, token, state.config, state.jwks)
+                verified = state.token_cache.put(token, payload)
+            check_permissions(permission, verified.payload,
+                              verified.permissions)
+            state.rate_limiter.check(verified.payload.get('sub'),
+                                     permission)
+            return await f(request, verified.payload)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+# Answers 503 to requests over the limits of the load shedder,
+# see setup_admission in ratelimit.py; CORS preflights are never shed
+class AdmissionMiddleware:
+    def __init__(self, app, admission):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] == 'OPTIONS' or \
+                not (self.admission.max_in_flight or
+                     self.admission.max_queue_ms):
+            await self.app(scope, receive, send)
+            return
+        try:
+            self.admission.enter(
+                Headers(scope=scope).get('X-Request-Start'))
+        except AdmissionError as error:
+            await admission_response(error)(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.leave()
+
+
+def create_app(test_config=None):
+    # Create and configure the app
+    # settings missing from test_config are read from the environment
+    config = dict(test_config or {})
+    for key in AUTH_SETTINGS + ('DATABASE_URL',):
+        if key not in config:
+            config[key] = os.environ[key]
+    engine, Session = create_async_db(config['DATABASE_URL'])
+    jwks = create_jwks_store(config['AUTH0_DOMAIN'])
+
+    def setting(key, default):
+        return config.get(key, os.environ.get(key, default))
+
+    admission = create_admission(setting)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await run_in_threadpool(jwks.warm)
+        yield
+        await engine.dispose()
+
+    async def home(request):
+        return json_response({
+            'message': 'Welcome to the Casting-App'
+        })
+
+    # Reads a page of a list endpoint, see get_actors in app.py
+    async def read_page(request, model, table, sorts, apply_filters):
+        args = request.query_params
+        fields = get_fields(model, args)
+        limit, after = get_page_args(args)
+        sort, descending = get_sort(model, sorts, args)
+        expand = get_expand(model, args)
+
+        try:
+            async with Session() as session:
+                etag = table_etag(await read_versions(session), table,
+                                  path=full_path(request))
+                cached = not_modified(request, etag)
+                if cached is not None:
+                    return cached
+                if not expand:
+                    encoder = row_encoder(
+                        model, tuple(fields or FIELDS[model]), True)
+                    statement = apply_filters(
+                        encoder.select(model.id, sort), args)
+                    rows, next_cursor = await paginate(
+                        session, statement, model, limit, after, sort,
+                        descending)
+                    return encoded_response(
+                        encoder.encode_page(table, rows, next_cursor), etag)
+
+                statement = apply_filters(select(*model.__table__.c), args)
+                rows, next_cursor = await paginate(
+                    session, statement, model, limit, after, sort,
+                    descending)
+                formatted = await format_expanded(
+                    session, rows, model, fields, expand)
+            return json_response({
+                "success": True,
+                table: formatted,
+                "next_cursor": next_cursor
+                }, etag=etag)
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Reads a single row, see get_actor in app.py
+    async def read_item(request, model, key, table, row_id):
+        args = request.query_params
+        expand = get_expand(model, args)
+        fields = get_fields(model, args)
+
+        try:
+            async with Session() as session:
+                etag = row_etag(await read_versions(session, table, row_id),
+                                table, row_id, *expand_tables(model, expand),
+                                path=full_path(request))
+                cached = not_modified(request, etag)
+                if cached is not None:
+                    return cached
+                if not expand:
+                    encoder = row_encoder(
+                        model, tuple(fields or FIELDS[model]), True)
+                    row = (await session.execute(
+                        encoder.select(model.id)
+                        .where(model.id == row_id))).first()
+                    if row is None:
+                        abort(422)
+                    return encoded_response(
+                        encoder.encode_item(key, row), etag)
+
+                row = (await session.execute(
+                    select(*model.__table__.c)
+                    .where(model.id == row_id))).first()
+                if row is None:
+                    abort(422)
+                formatted = await format_expanded(
+                    session, [row], model, fields, expand)
+            return json_response({
+                "success": True,
+                key: formatted[0]
+                }, etag=etag)
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Reads the other side of the casting of a row,
+    # see get_movie_actors in app.py
+    async def read_casting(request, model, table, key, row_id):
+        try:
+            async with Session() as session:
+                etag = row_etag(await read_versions(session, table, row_id),
+                                table, row_id, key, path=full_path(request))
+                cached = not_modified(request, etag)
+                if cached is not None:
+                    return cached
+                found = (await session.execute(
+                    select(model.id).where(model.id == row_id))).first()
+                if found is None:
+                    abort(422)
+                grouped = await related_rows(session, model, [row_id])
+            return json_response({
+                "success": True,
+                key: grouped[row_id]
+                }, etag=etag)
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    @requires_auth('get:actors')
+    async def get_actors(request, payload):
+        return await read_page(request, Actor, 'actors', ACTOR_SORTS,
+                               filter_actors)
+
+    @requires_auth('get:movies')
+    async def get_movies(request, payload):
+        return await read_page(request, Movie, 'movies', MOVIE_SORTS,
+                               filter_movies)
+
+    @requires_auth('get:actors')
+    async def get_actor(request, payload):
+        return await read_item(request, Actor, 'actor', 'actors',
+                               request.path_params['actor_id'])
+
+    @requires_auth('get:movies')
+    async def get_movie(request, payload):
+        return await read_item(request, Movie, 'movie', 'movies',
+                               request.path_params['movie_id'])
+
+    @requires_auth('get:movies')
+    async def get_movie_actors(request, payload):
+        return await read_casting(request, Movie, 'movies', 'actors',
+                                  request.path_params['movie_id'])
+
+    @requires_auth('get:actors')
+    async def get_actor_movies(request, payload):
+        return await read_casting(request, Actor, 'actors', 'movies',
+                                  request.path_params['actor_id'])
+
+    # Creates a new actor in the db
+    # Returns json containing a dict representation of the actor
+    @requires_auth('post:actor')
+    async def create_actor(request, payload):
+        try:
+            body = await request.json()
+            name = body.get('name')
+            age = body.get('age')
+            gender = body.get('gender')
+            if name is None:
+                abort(422)
+            if age is None:
+                abort(422)
+            if gender is None:
+                abort(422)
+            actor = Actor(name=name, age=int(age), gender=gender)
+            async with Session() as session:
+                session.add(actor)
+                await session.commit()
+            rows_changed(Actor.__tablename__, actor.id)
+
+            return json_response({
+                "success": True,
+                "actor": actor.format()
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Creates a new movie in the db
+    # Returns json containing a dict representation of the movie
+    @requires_auth('post:movie')
+    async def create_movie(request, payload):
+        try:
+            body = await request.json()
+            title = body.get('title')
+            release_date = body.get('release_date')
+
+            if title is None:
+                abort(422)
+            if release_date is None:
+                abort(422)
+            release_date = parse_date(release_date)
+
+            movie = Movie(title=title, release_date=release_date)
+            async with Session() as session:
+                session.add(movie)
+                await session.commit()
+            rows_changed(Movie.__tablename__, movie.id)
+
+            return json_response({
+                "success": True,
+                "movie": movie.format()
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Modifies an actor with a specific id
+    # Returns json containing a dict representation of the modified actor
+    @requires_auth('patch:actor')
+    async def modify_actor(request, payload):
+        actor_id = request.path_params['actor_id']
+        try:
+            async with Session() as session:
+                actor = await session.get(Actor, actor_id)
+                if actor is None:
+                    abort(422)
+                body = await request.json()
+                name = body.get('name')
+                age = body.get('age')
+                gender = body.get('gender')
+                if name is not None:
+                    actor.name = name
+                if age is not None:
+                    actor.age = int(age)
+                if gender is not None:
+                    actor.gender = gender
+
+                actor_formatted = actor.format()
+                await session.commit()
+            rows_changed(Actor.__tablename__, actor_id)
+
+            return json_response({
+                "success": True,
+                "actor": actor_formatted
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Modifies a movie with a specific id
+    # Returns json containing a dict representation of the modified movie
+    @requires_auth('patch: movie')
+    async def modify_movie(request, payload):
+        movie_id = request.path_params['movie_id']
+        try:
+            async with Session() as session:
+                movie = await session.get(Movie, movie_id)
+                if movie is None:
+                    abort(422)
+                body = await request.json()
+                title = body.get('title')
+                release_date = body.get('release_date')
+
+                if title is not None:
+                    movie.title = title
+                if release_date is not None:
+                    movie.release_date = parse_date(release_date)
+
+                movie_formatted = movie.format()
+                await session.commit()
+            rows_changed(Movie.__tablename__, movie_id)
+
+            return json_response({
+                "success": True,
+                "movie": movie_formatted
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Deletes an actor with a specific id
+    # Returns json containing a dict representation of the deleted actor
+    @requires_auth('delete:actor')
+    async def delete_actor(request, payload):
+        actor_id = request.path_params['actor_id']
+        try:
+            async with Session() as session:
+                actor = await session.get(Actor, actor_id)
+                if actor is None:
+                    abort(422)
+                actor_formatted = actor.format()
+                await session.delete(actor)
+                await session.commit()
+            rows_changed(Actor.__tablename__, actor_id)
+
+            return json_response({
+                "success": True,
+                "actor": actor_formatted
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # Deletes a movie with a specific id
+    # Returns json containing a dict representation of the deleted movie
+    @requires_auth('delete:movie')
+    async def delete_movie(request, payload):
+        movie_id = request.path_params['movie_id']
+        try:
+            async with Session() as session:
+                movie = await session.get(Movie, movie_id)
+                if movie is None:
+                    abort(422)
+                movie_formatted = movie.format()
+                await session.delete(movie)
+                await session.commit()
+            rows_changed(Movie.__tablename__, movie_id)
+
+            return json_response({
+                "success": True,
+                "movie": movie_formatted
+                })
+
+        except Exception:
+            print(sys.exc_info())
+            abort(422)
+
+    # aborts from the shared request helpers
+    async def http_error(request, error):
+        return error_response(error.code)
+
+    # unknown routes and methods
+    async def routing_error(request, error):
+        return error_response(error.status_code)
+
+    async def server_error(request, error):
+        return error_response(500)
+
+    async def rate_limit_error(request, error):
+        return admission_response(error)
+
+    async def auth_error(request, error):
+        return json_response({
+            "success": False,
+            "error": error.status_code,
+            "message": error.error,
+            }, error.status_code)
+
+    routes = [
+        Route('/', home, methods=['GET']),
+        Route('/actors', get_actors, methods=['GET']),
+        Route('/actors', create_actor, methods=['POST']),
+        Route('/movies', get_movies, methods=['GET']),
+        Route('/movies', create_movie, methods=['POST']),
+        Route('/actors/{actor_id:int}', get_actor, methods=['GET']),
+        Route('/actors/{actor_id:int}', modify_actor, methods=['PATCH']),
+        Route('/actors/{actor_id:int}', delete_actor, methods=['DELETE']),
+        Route('/movies/{movie_id:int}', get_movie, methods=['GET']),
+        Route('/movies/{movie_id:int}', modify_movie, methods=['PATCH']),
+        Route('/movies/{movie_id:int}', delete_movie, methods=['DELETE']),
+        Route('/movies/{movie_id:int}/actors', get_movie_actors,
+              methods=['GET']),
+        Route('/actors/{actor_id:int}/movies', get_actor_movies,
+              methods=['GET'])
+    ]
+    app = Starlette(
+        routes=routes,
+        middleware=[Middleware(AdmissionMiddleware, admission=admission),
+                    Middleware(CORSMiddleware, allow_origins=['*'],
+                               allow_methods=['*'], allow_headers=['*'])],
+        exception_handlers={
+            HTTPException: http_error,
+            RoutingError: routing_error,
+            AuthError: auth_error,
+            AdmissionError: rate_limit_error,
+            500: server_error
+        },
+        lifespan=lifespan)
+    app.state.config = config
+    app.state.jwks = jwks
+    app.state.token_cache = create_token_cache()
+    app.state.rate_limiter = create_rate_limiter(setting)
+    app.state.admission = admission
+    app.state.engine = engine
+    return app
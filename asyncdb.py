@@ -0,0 +1,148 @@
+import os
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from models import Movie, Actor, movie_actors, from_row
+from pagination import page_steps
+from pool import engine_options, configure_engine
+from expand import EXPANSIONS
+
+
+'''
+Async database access
+The ASGI app (asgi.py) runs on an SQLAlchemy asyncio engine over a
+non-blocking driver: asyncpg for Postgres, aiosqlite for SQLite. The same
+DATABASE_URL is used, rewritten to the async dialect, and the pool is sized
+from the same DB_* variables as the WSGI engine (pool.py). Every
+coroutine waiting on the database gives the event loop back, so one
+process can hold as many requests in flight as it has connections.
+
+Queries are the ones the WSGI app runs: pagination goes through the same
+page_steps() as paginate(), and the expansions return the related rows
+and counts in one query each.
+'''
+
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+# the model on the other side of each expansion
+# and the casting column joining it
+RELATED = {
+    Movie: (Actor, movie_actors.c.actor_id),
+    Actor: (Movie, movie_actors.c.movie_id)
+}
+
+
+# Rewrites a database URL to its async driver
+def async_url(database_path):
+    url = make_url(database_path)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'no async driver for {backend}')
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+# Creates the async engine and session factory for the database URL
+def create_async_db(database_path=None):
+    if database_path is None:
+        database_path = os.environ['DATABASE_URL']
+    options = engine_options(database_path)
+    # TimedQueuePool is a blocking pool, the async engine brings its own
+    options.pop('poolclass', None)
+    # a single event loop serves every request of the process,
+    # so the whole connection budget stays open in the pool
+    if 'pool_size' in options:
+        options['pool_size'] += options['max_overflow']
+        options['max_overflow'] = 0
+    engine = create_async_engine(async_url(database_path), **options)
+    configure_engine(engine.sync_engine)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine.sync_engine, 'connect',
+                     enable_sqlite_foreign_keys)
+    return engine, sessionmaker(engine, class_=AsyncSession,
+                                expire_on_commit=False)
+
+
+# models.py switches foreign keys on for sqlite3 connections only,
+# aiosqlite hands its own connection class to the connect event
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+async def fetch_all(session, statement):
+    return (await session.execute(statement)).all()
+
+
+# Returns one page of the statement and the cursor of the next page
+# (see pagination.paginate)
+async def paginate(session, statement, model, limit, after=None, sort=None,
+                   descending=False):
+    steps = page_steps(statement, model, limit, after, sort, descending)
+    rows = None
+    while True:
+        try:
+            statement = steps.send(rows)
+        except StopIteration as done:
+            return done.value
+        rows = await fetch_all(session, statement)
+
+
+# Returns the formatted rows of the other side of the casting of each id,
+# ordered by their id like the relationships
+async def related_rows(session, model, ids):
+    related, join_column = RELATED[model]
+    column = EXPANSIONS[model]['column']
+    rows = await fetch_all(
+        session,
+        select(*related.__table__.c, column)
+        .join_from(related.__table__, movie_actors,
+                   related.id == join_column)
+        .where(column.in_(ids))
+        .order_by(related.id))
+    grouped = {row_id: [] for row_id in ids}
+    for row in rows:
+        values = dict(row._mapping)
+        parent_id = values.pop(column.key)
+        grouped[parent_id].append(from_row(related, values).format())
+    return grouped
+
+
+# counts the casting rows of each id in one aggregate query
+# (see models.count_casting)
+async def count_casting(session, column, ids):
+    if not ids:
+        return {}
+    counts = dict(await fetch_all(
+        session,
+        select(column, func.count())
+        .where(column.in_(ids))
+        .group_by(column)))
+    return {row_id: counts.get(row_id, 0) for row_id in ids}
+
+
+# Formats full rows of the model with their expansions and keeps only the
+# requested fields (see fields.format_fields)
+async def format_expanded(session, rows, model, fields, expand):
+    expansion = EXPANSIONS[model]
+    formatted = [from_row(model, row._mapping).format() for row in rows]
+    ids = [data['id'] for data in formatted]
+    if expansion['rows'] in expand:
+        grouped = await related_rows(session, model, ids)
+        for data in formatted:
+            data[expansion['key']] = grouped[data['id']]
+    if expansion['count'] in expand:
+        counts = await count_casting(session, expansion['column'], ids)
+        for data in formatted:
+            data[expansion['count']] = counts[data['id']]
+    if fields is not None:
+        keep = set(fields) | {expansion['key'], expansion['count']}
+        formatted = [{key: value for key, value in data.items()
+                      if key in keep} for data in formatted]
+    return formatted
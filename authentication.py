@@ -1,14 +1,24 @@
-import json
-from flask import request, _request_ctx_stack
+from flask import request, current_app, g, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 import os
+from jwks import create_jwks_store
+from tokencache import create_token_cache
+from timing import timed
 
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = [os.environ['ALGORITHMS']]
-API_AUDIENCE = os.environ['API_AUDIENCE']
+AUTH_SETTINGS = ('AUTH0_DOMAIN', 'ALGORITHMS', 'API_AUDIENCE')
+
+
+# sets up token verification for the app
+# settings missing from the app config are read from the environment
+def setup_auth(app):
+    for key in AUTH_SETTINGS:
+        if key not in app.config:
+            app.config[key] = os.environ[key]
+    app.extensions['jwks'] = create_jwks_store(app.config['AUTH0_DOMAIN'])
+    app.extensions['token_cache'] = create_token_cache()
+
 
 # AuthError Exception
 '''
@@ -34,13 +44,15 @@ class AuthError(Exception):
 '''
 
 
-def get_token_auth_header():
-    if request.headers is None:
+def get_token_auth_header(headers=None):
+    if headers is None:
+        headers = request.headers
+    if headers is None:
         raise AuthError({
             'code': 'authorization_header_missing',
             'description': 'Authorization header is expected.'
         }, 401)
-    auth = request.headers.get('Authorization', None)
+    auth = headers.get('Authorization', None)
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -74,6 +86,7 @@ def get_token_auth_header():
     @INPUTS
         permission: string permission (i.e. 'post:drink')
         payload: decoded jwt payload
+        granted: optional precomputed set of the payload permissions
 
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
@@ -83,13 +96,15 @@ def get_token_auth_header():
 '''
 
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, granted=None):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'No permissions',
             'description': 'Client must have permissions'
         }, 401)
-    if permission not in payload.get('permissions'):
+    if granted is None:
+        granted = payload.get('permissions')
+    if permission not in granted:
         raise AuthError({
             'code': 'Access not granted',
             'description': 'Client must have appropriate permissions'
@@ -100,9 +115,12 @@ def check_permissions(permission, payload):
 @TODO implement verify_decode_jwt(token) method
     @INPUTS
         token: a json web token (string)
+        config, jwks: the auth settings and JWKS store to use
+        (default to the current Flask app's)
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+    (served from the in-process JWKS key store, see jwks.py)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -112,9 +130,7 @@ def check_permissions(permission, payload):
 '''
 
 
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+def verify_decode_jwt(token, config=None, jwks=None):
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -123,23 +139,27 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    if config is None:
+        config = current_app.config
+    if jwks is None:
+        jwks = current_app.extensions['jwks']
+    key = jwks.get_key(unverified_header['kid'])
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=[config['ALGORITHMS']],
+                audience=config['API_AUDIENCE'],
+                issuer='https://' + config['AUTH0_DOMAIN'] + '/'
             )
 
             return payload
@@ -174,8 +194,11 @@ def verify_decode_jwt(token):
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+    (skipped when the token is already in the verified token cache)
     it should use the check_permissions method validate claims and
     check the requested permission
+    it should take a token from the rate limit bucket of the sub
+    (see ratelimit.py)
     return the decorator which passes the decoded payload to the
     decorated method
 '''
@@ -185,10 +208,20 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with timed('auth'):
+                token = get_token_auth_header()
+                token_cache = current_app.extensions['token_cache']
+                verified = token_cache.get(token)
+                if verified is None:
+                    payload = verify_decode_jwt(token)
+                    verified = token_cache.put(token, payload)
+                check_permissions(permission, verified.payload,
+                                  verified.permissions)
+                current_app.extensions['rate_limiter'].check(
+                    verified.payload.get('sub'), permission)
+            # the client of the request, for replicas.py
+            g.subject = verified.payload.get('sub')
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
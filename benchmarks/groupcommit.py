@@ -0,0 +1,111 @@
+'''
+Group commit benchmark
+Sends concurrent POST /actors and PATCH /actors/<id> requests through the
+app in process, once with every write committing on its own and once with
+GROUP_COMMIT=1, and prints throughput, latency and commits per write.
+
+    python benchmarks/groupcommit.py [--clients 16] [--writes 100]
+        [--window-ms 2] [--max-items 32]
+
+Runs against DATABASE_URL, or a temporary SQLite database when unset. The
+gain comes from flushing the WAL once per group, so run it against
+Postgres on the disk it will use in production.
+'''
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from localauth import LocalAuth  # noqa: E402
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def client(app, headers, writes, latencies, errors):
+    test_client = app.test_client()
+    actor_id = None
+    for i in range(writes):
+        started = time.perf_counter()
+        if actor_id is None or i % 2 == 0:
+            response = test_client.post('/actors', headers=headers, json={
+                'name': f'writer {i}', 'age': 20 + i % 60,
+                'gender': 'female'})
+        else:
+            response = test_client.patch(f'/actors/{actor_id}',
+                                         headers=headers,
+                                         json={'age': 20 + i % 60})
+        latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+            continue
+        actor_id = response.get_json()['actor']['id']
+
+
+def run(group_commit, args, headers):
+    from app import create_app
+    from models import db
+    from groupcommit import COMMITS
+    app = create_app({'GROUP_COMMIT': '1' if group_commit else '0',
+                      'GROUP_COMMIT_WINDOW_MS': args.window_ms,
+                      'GROUP_COMMIT_MAX': args.max_items})
+    with app.app_context():
+        db.create_all()
+    latencies = []
+    errors = []
+    commits = COMMITS.commits
+    clients = [threading.Thread(
+        target=client, args=(app, headers, args.writes, latencies, errors))
+        for _ in range(args.clients)]
+    started = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    commits = COMMITS.commits - commits
+    latencies.sort()
+    return {
+        'writes': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'commits_per_write': commits / max(1, len(latencies))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=100)
+    parser.add_argument('--window-ms', type=float, default=2)
+    parser.add_argument('--max-items', type=int, default=32)
+    args = parser.parse_args()
+
+    auth = LocalAuth()
+    auth.configure()
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'bench.db'))
+    headers = {'Authorization': 'Bearer ' + auth.token()}
+
+    print(f'{args.clients} clients, {args.writes} writes each, '
+          f'window {args.window_ms:g} ms, groups of up to {args.max_items}')
+    print(f'{"path":<14} {"writes/s":>9} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"commits/write":>14} {"errors":>7}')
+    for name, group_commit in (('per request', False),
+                               ('group commit', True)):
+        result = run(group_commit, args, headers)
+        print(f'{name:<14} {result["rps"]:>9.1f} {result["p50_ms"]:>8.1f} '
+              f'{result["p95_ms"]:>8.1f} '
+              f'{result["commits_per_write"]:>14.2f} {result["errors"]:>7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+'''
+Local auth for benchmarks
+Mints RS256 tokens with a key generated on the spot and points the app at
+a JWKS holding its public half, so benchmarks verify real signatures
+without reaching Auth0.
+'''
+import base64
+import json
+import os
+import time
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+
+DOMAIN = 'bench.invalid'
+AUDIENCE = 'bench'
+PERMISSIONS = ['get:actors', 'get:movies', 'post:actor', 'post:movie',
+               'patch:actor', 'patch: movie', 'delete:actor', 'delete:movie']
+
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+class LocalAuth:
+    def __init__(self, kid='bench'):
+        self.kid = kid
+        self.key = RSA.generate(2048)
+        self.pem = self.key.export_key().decode()
+        self.jwks = {'keys': [{'kty': 'RSA', 'kid': kid, 'use': 'sig',
+                               'n': _b64(self.key.n),
+                               'e': _b64(self.key.e)}]}
+
+    def token(self, permissions=PERMISSIONS, sub='bench', ttl=86400):
+        return jwt.encode({
+            'iss': f'https://{DOMAIN}/', 'aud': AUDIENCE, 'sub': sub,
+            'exp': int(time.time()) + ttl, 'permissions': list(permissions)
+        }, self.pem, algorithm='RS256', headers={'kid': self.kid})
+
+    # Sets the Auth0 settings and the JWKS of the app in the environment
+    def configure(self, environ=os.environ):
+        environ.update(AUTH0_DOMAIN=DOMAIN, ALGORITHMS='RS256',
+                       API_AUDIENCE=AUDIENCE,
+                       JWKS_JSON=json.dumps(self.jwks))
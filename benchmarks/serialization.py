@@ -0,0 +1,92 @@
+'''
+Serialization benchmark
+Compares the ORM read path (Model.query -> format() -> jsonify) with the
+core select() fast path of fastjson.py on N rows, checks that both produce
+the same bytes and prints the time per page.
+
+    python benchmarks/serialization.py [rows ...]    (default 10000 100000)
+
+Runs against DATABASE_URL, or a temporary SQLite database when unset.
+'''
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.invalid')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'bench')
+os.environ.setdefault('JWKS_JSON', json.dumps({'keys': []}))
+
+from flask import jsonify  # noqa: E402
+from app import create_app  # noqa: E402
+from models import db, Actor, Movie, parse_date  # noqa: E402
+from fastjson import get_encoder  # noqa: E402
+
+
+def seed(rows):
+    db.create_all()
+    db.session.execute(Actor.__table__.delete())
+    db.session.execute(Movie.__table__.delete())
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': f'actor {i}', 'age': 20 + i % 60,
+         'gender': 'female' if i % 2 else 'male'} for i in range(rows)])
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': f'movie {i}',
+         'release_date': parse_date(f'{i % 12 + 1:02d}-01-{2000 + i % 20}')}
+        for i in range(rows)])
+    db.session.commit()
+
+
+def orm_page(model, key, rows):
+    objs = model.query.order_by(model.id).limit(rows).all()
+    body = jsonify({
+        'success': True,
+        key: [obj.format() for obj in objs],
+        'next_cursor': None
+    }).get_data()
+    db.session.remove()
+    return body
+
+
+def fast_page(model, key, rows):
+    encoder = get_encoder(model)
+    result = db.session.execute(
+        encoder.select(model.id).order_by(model.id).limit(rows)).all()
+    body = encoder.encode_page(key, result, None).encode()
+    db.session.remove()
+    return body
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), body
+
+
+def main(sizes):
+    app = create_app()
+    with app.test_request_context():
+        for rows in sizes:
+            seed(rows)
+            repeat = 5 if rows <= 10000 else 3
+            for model, key in ((Actor, 'actors'), (Movie, 'movies')):
+                orm, orm_body = best_of(
+                    lambda: orm_page(model, key, rows), repeat)
+                fast, fast_body = best_of(
+                    lambda: fast_page(model, key, rows), repeat)
+                same = 'identical' if orm_body == fast_body else 'DIFFERENT'
+                print(f'{key:7} {rows:>7} rows  orm {orm * 1000:8.1f} ms  '
+                      f'fast {fast * 1000:8.1f} ms  '
+                      f'x{orm / fast:4.1f}  bytes {same}')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
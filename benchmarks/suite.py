@@ -0,0 +1,414 @@
+'''
+Benchmark suite
+Runs every route of create_app() in process through the Flask test client
+against SQLite or a local Postgres, with RS256 tokens minted locally (see
+localauth.py), and reports latency percentiles and requests per second per
+scenario.
+
+    python benchmarks/suite.py [--actors 1000] [--movies 1000] [--cast 5]
+        [--iterations 200] [--warmup 20] [--only PATTERN]
+        [--output results.json] [--baseline baseline.json]
+        [--threshold 0.25]
+
+Runs against DATABASE_URL, or a temporary SQLite database when unset. The
+database is emptied and seeded first, so never point it at real data.
+The suite refuses to run when a route has no scenario, so new endpoints
+have to be added here. With --baseline, scenarios whose p95 grew by more
+than --threshold (default 25%) are reported and the exit status is 1.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from localauth import LocalAuth  # noqa: E402
+
+
+class Scenario:
+    def __init__(self, name, method, rule, build, prepare=None,
+                 status=(200,)):
+        self.name = name
+        self.method = method
+        self.rule = rule
+        self.build = build
+        self.prepare = prepare
+        self.status = status
+
+
+# Raised by prepare() when the seeded data cannot exercise the scenario
+class SkipScenario(Exception):
+    pass
+
+
+class Context:
+    def __init__(self, app, token):
+        self.app = app
+        self.client = app.test_client()
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.actor_ids = []
+        self.movie_ids = []
+        self.spare = {}
+
+    def pick(self, ids, i):
+        return ids[(i * 7919) % len(ids)]
+
+    # Takes a row created by prepare() for a destructive scenario
+    def take(self, key):
+        return self.spare[key].pop()
+
+
+def seed(actors, movies, cast):
+    from models import db, Actor, Movie, movie_actors
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': f'actor {i}', 'age': 18 + i % 70,
+         'gender': ('female', 'male', 'other')[i % 3]}
+        for i in range(actors)])
+    start = date(1970, 1, 1)
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': f'movie {i}',
+         'release_date': start + timedelta(days=i * 17 % 20000)}
+        for i in range(movies)])
+    actor_ids = [row[0] for row in db.session.query(Actor.id)]
+    movie_ids = [row[0] for row in db.session.query(Movie.id)]
+    if actor_ids and cast:
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': movie_id,
+             'actor_id': actor_ids[(n * 31 + k) % len(actor_ids)]}
+            for n, movie_id in enumerate(movie_ids)
+            for k in range(min(cast, len(actor_ids)))])
+    db.session.commit()
+    return actor_ids, movie_ids
+
+
+def _create(model, count):
+    from models import db, Actor
+    if model is Actor:
+        rows = [Actor(name=f'spare {i}', age=40, gender='other')
+                for i in range(count)]
+    else:
+        rows = [model(title=f'spare {i}', release_date=date(2001, 1, 1))
+                for i in range(count)]
+    db.session.add_all(rows)
+    db.session.commit()
+    return [row.id for row in rows]
+
+
+def spare_rows(key, model, per_request=1):
+    def prepare(ctx, count):
+        ids = _create(model, count * per_request)
+        ctx.spare[key] = [ids[i:i + per_request]
+                          for i in range(0, len(ids), per_request)]
+    return prepare
+
+
+def scenarios():
+    from models import Actor, Movie
+
+    def get(path):
+        return lambda ctx, i: {'path': path}
+
+    def conditional(path):
+        def prepare(ctx, count):
+            res = ctx.client.get(path, headers=ctx.headers)
+            ctx.spare[path] = res.headers['ETag']
+
+        def build(ctx, i):
+            return {'path': path,
+                    'headers': {'If-None-Match': ctx.spare[path]}}
+        return prepare, build
+
+    def next_page(ctx, count):
+        cursor = ctx.client.get('/actors?limit=50',
+                                headers=ctx.headers).get_json()['next_cursor']
+        if cursor is None:
+            raise SkipScenario('the actors fit on one page')
+        ctx.spare['actors cursor'] = cursor
+
+    actors_304 = conditional('/actors?limit=50')
+    movies_304 = conditional('/movies?limit=50')
+    return [
+        Scenario('home', 'GET', '/', get('/')),
+        Scenario('metrics', 'GET', '/metrics', get('/metrics')),
+
+        Scenario('list actors', 'GET', '/actors', get('/actors?limit=50')),
+        Scenario('list actors sorted, filtered', 'GET', '/actors',
+                 get('/actors?limit=50&sort=-age&gender=female&min_age=30')),
+        Scenario('list actors fields', 'GET', '/actors',
+                 get('/actors?limit=50&fields=id,name')),
+        Scenario('list actors expanded', 'GET', '/actors',
+                 get('/actors?limit=50&expand=movies,movie_count')),
+        Scenario('list actors page 2', 'GET', '/actors',
+                 lambda ctx, i: {'path': '/actors?limit=50&cursor=' +
+                                 ctx.spare['actors cursor']},
+                 prepare=next_page),
+        Scenario('list actors 304', 'GET', '/actors', actors_304[1],
+                 prepare=actors_304[0], status=(304,)),
+        Scenario('stream actors', 'GET', '/actors',
+                 get('/actors?stream=1')),
+        Scenario('list movies', 'GET', '/movies', get('/movies?limit=50')),
+        Scenario('list movies date range', 'GET', '/movies',
+                 get('/movies?limit=50&sort=release_date'
+                     '&released_after=1990-01-01'
+                     '&released_before=2010-12-31')),
+        Scenario('list movies expanded', 'GET', '/movies',
+                 get('/movies?limit=50&expand=cast,cast_count')),
+        Scenario('list movies 304', 'GET', '/movies', movies_304[1],
+                 prepare=movies_304[0], status=(304,)),
+        Scenario('stream movies', 'GET', '/movies',
+                 get('/movies?stream=1')),
+
+        Scenario('get actor', 'GET', '/actors/<int:actor_id>',
+                 lambda ctx, i: {'path': '/actors/%d' %
+                                 ctx.pick(ctx.actor_ids, i)}),
+        Scenario('get actor expanded', 'GET', '/actors/<int:actor_id>',
+                 lambda ctx, i: {'path': '/actors/%d?expand=movies' %
+                                 ctx.pick(ctx.actor_ids, i)}),
+        Scenario('get movie', 'GET', '/movies/<int:movie_id>',
+                 lambda ctx, i: {'path': '/movies/%d' %
+                                 ctx.pick(ctx.movie_ids, i)}),
+        Scenario('get movie cast', 'GET', '/movies/<int:movie_id>/actors',
+                 lambda ctx, i: {'path': '/movies/%d/actors' %
+                                 ctx.pick(ctx.movie_ids, i)}),
+        Scenario('get actor movies', 'GET', '/actors/<int:actor_id>/movies',
+                 lambda ctx, i: {'path': '/actors/%d/movies' %
+                                 ctx.pick(ctx.actor_ids, i)}),
+        Scenario('actor stats', 'GET', '/stats/actors', get('/stats/actors')),
+        Scenario('movie stats', 'GET', '/stats/movies', get('/stats/movies')),
+
+        Scenario('create actor', 'POST', '/actors',
+                 lambda ctx, i: {'path': '/actors', 'json': {
+                     'name': f'new actor {i}', 'age': 30,
+                     'gender': 'female'}}),
+        Scenario('create movie', 'POST', '/movies',
+                 lambda ctx, i: {'path': '/movies', 'json': {
+                     'title': f'new movie {i}',
+                     'release_date': '06-15-2021'}}),
+        Scenario('create actors bulk (100)', 'POST', '/actors/bulk',
+                 lambda ctx, i: {'path': '/actors/bulk', 'json': [
+                     {'name': f'bulk actor {i}.{n}', 'age': 20 + n % 50,
+                      'gender': 'male'} for n in range(100)]}),
+        Scenario('create movies bulk (100)', 'POST', '/movies/bulk',
+                 lambda ctx, i: {'path': '/movies/bulk', 'json': [
+                     {'title': f'bulk movie {i}.{n}',
+                      'release_date': '2015-03-01'} for n in range(100)]}),
+
+        Scenario('modify actor', 'PATCH', '/actors/<int:actor_id>',
+                 lambda ctx, i: {'path': '/actors/%d' %
+                                 ctx.pick(ctx.actor_ids, i),
+                                 'json': {'age': 20 + i % 60}}),
+        Scenario('modify movie', 'PATCH', '/movies/<int:movie_id>',
+                 lambda ctx, i: {'path': '/movies/%d' %
+                                 ctx.pick(ctx.movie_ids, i),
+                                 'json': {'title': f'renamed {i}'}}),
+        Scenario('modify actors bulk (50 ids)', 'PATCH', '/actors/bulk',
+                 lambda ctx, i: {'path': '/actors/bulk?return=count',
+                                 'json': {'ids': ctx.actor_ids[
+                                     i % 10 * 50:i % 10 * 50 + 50] or
+                                     ctx.actor_ids[:50],
+                                     'changes': {'age': 33}}}),
+        Scenario('modify movies bulk (50 ids)', 'PATCH', '/movies/bulk',
+                 lambda ctx, i: {'path': '/movies/bulk?return=count',
+                                 'json': {'ids': ctx.movie_ids[
+                                     i % 10 * 50:i % 10 * 50 + 50] or
+                                     ctx.movie_ids[:50],
+                                     'changes': {'title': 'retitled'}}}),
+        Scenario('cast actors', 'POST', '/movies/<int:movie_id>/actors',
+                 lambda ctx, i: {'path': '/movies/%d/actors' %
+                                 ctx.pick(ctx.movie_ids, i),
+                                 'json': {'actor_ids': [
+                                     ctx.pick(ctx.actor_ids, i + 1)]}}),
+        Scenario('uncast actors', 'DELETE', '/movies/<int:movie_id>/actors',
+                 lambda ctx, i: {'path': '/movies/%d/actors' %
+                                 ctx.pick(ctx.movie_ids, i),
+                                 'json': {'actor_ids': [
+                                     ctx.pick(ctx.actor_ids, i + 1)]}}),
+
+        Scenario('delete actor', 'DELETE', '/actors/<int:actor_id>',
+                 lambda ctx, i: {'path': '/actors/%d' %
+                                 ctx.take('actors')[0]},
+                 prepare=spare_rows('actors', Actor)),
+        Scenario('delete movie', 'DELETE', '/movies/<int:movie_id>',
+                 lambda ctx, i: {'path': '/movies/%d' %
+                                 ctx.take('movies')[0]},
+                 prepare=spare_rows('movies', Movie)),
+        Scenario('delete actors bulk (20 ids)', 'DELETE', '/actors/bulk',
+                 lambda ctx, i: {'path': '/actors/bulk?return=count',
+                                 'json': {'ids': ctx.take('actor batches')}},
+                 prepare=spare_rows('actor batches', Actor, 20)),
+        Scenario('delete movies bulk (20 ids)', 'DELETE', '/movies/bulk',
+                 lambda ctx, i: {'path': '/movies/bulk?return=count',
+                                 'json': {'ids': ctx.take('movie batches')}},
+                 prepare=spare_rows('movie batches', Movie, 20)),
+    ]
+
+
+# Returns the routes of the app that no scenario exercises
+def uncovered(app, all_scenarios):
+    covered = {(scenario.method, scenario.rule)
+               for scenario in all_scenarios}
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            if (method, rule.rule) not in covered:
+                missing.append(f'{method} {rule.rule}')
+    return missing
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(ctx, scenario, iterations, warmup):
+    if scenario.prepare is not None:
+        scenario.prepare(ctx, iterations + warmup)
+    send = getattr(ctx.client, scenario.method.lower())
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(iterations + warmup):
+        spec = scenario.build(ctx, i)
+        headers = dict(ctx.headers, **spec.get('headers', {}))
+        if i == warmup:
+            started = time.perf_counter()
+        request_started = time.perf_counter()
+        response = send(spec['path'], json=spec.get('json'),
+                        headers=headers)
+        response.get_data()
+        elapsed = time.perf_counter() - request_started
+        if i < warmup:
+            continue
+        if response.status_code not in scenario.status:
+            errors += 1
+        latencies.append(elapsed)
+    total = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'method': scenario.method,
+        'route': scenario.rule,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / total, 1),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if before is None or not before['p95_ms']:
+            continue
+        change = result['p95_ms'] / before['p95_ms'] - 1
+        result['p95_change'] = round(change, 3)
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--cast', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--only', help='run scenarios containing this text')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    args = parser.parse_args()
+
+    auth = LocalAuth()
+    auth.configure()
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'bench.db'))
+    os.environ.setdefault('DB_POOL_LOG_INTERVAL', '0')
+    os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp())
+
+    from app import create_app
+    from models import db
+    app = create_app()
+    all_scenarios = scenarios()
+    missing = uncovered(app, all_scenarios)
+    if missing:
+        sys.exit('no scenario for: ' + ', '.join(missing))
+
+    results = {}
+    with app.app_context():
+        ctx = Context(app, auth.token())
+        ctx.actor_ids, ctx.movie_ids = seed(args.actors, args.movies,
+                                            args.cast)
+        print(f'{db.engine.dialect.name}, {args.actors} actors, '
+              f'{args.movies} movies, {args.cast} cast per movie, '
+              f'{args.iterations} requests per scenario')
+        print(f'{"scenario":<34} {"rps":>8} {"p50 ms":>8} {"p95 ms":>8} '
+              f'{"p99 ms":>8} {"errors":>6}')
+        for scenario in all_scenarios:
+            if args.only and args.only not in scenario.name:
+                continue
+            try:
+                result = results[scenario.name] = run(
+                    ctx, scenario, args.iterations, args.warmup)
+            except SkipScenario as skip:
+                print(f'{scenario.name:<34} skipped, {skip}')
+                continue
+            print(f'{scenario.name:<34} {result["rps"]:>8.1f} '
+                  f'{result["p50_ms"]:>8.2f} {result["p95_ms"]:>8.2f} '
+                  f'{result["p99_ms"]:>8.2f} {result["errors"]:>6}')
+        database = db.engine.dialect.name
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name in regressions:
+            print(f'regression: {name} p95 '
+                  f'{results[name]["p95_change"]:+.0%}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'commit': git_commit(),
+                    'database': database,
+                    'python': platform.python_version(),
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                             time.gmtime()),
+                    'actors': args.actors,
+                    'movies': args.movies,
+                    'cast': args.cast,
+                    'iterations': args.iterations,
+                    'warmup': args.warmup
+                },
+                'results': results
+            }, f, indent=2, sort_keys=True)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+'''
+Worker model benchmark
+Starts gunicorn with gunicorn.conf.py once per worker class, drives it
+with a closed loop of concurrent keep-alive clients and prints throughput
+and latency percentiles for each. The uvicorn class runs the async app of
+asgi.py instead, with the same number of worker processes, to compare it
+with the WSGI workers under high concurrency (e.g. --clients 128).
+
+    python benchmarks/workers.py [--classes sync gthread gevent uvicorn]
+        [--workers 2] [--clients 16] [--duration 10] [--rows 1000]
+
+Runs against DATABASE_URL, or a temporary SQLite database when unset.
+Requests carry an RS256 token minted by localauth.py and checked against a
+local JWKS, so nothing is fetched from Auth0. The client runs on the same
+machine as the server, so results are relative, not absolute.
+'''
+import argparse
+import http.client
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from localauth import LocalAuth  # noqa: E402
+
+
+def seed(rows):
+    from app import create_app
+    from models import db, Actor, Movie, parse_date
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Actor.__table__.delete())
+        db.session.execute(Movie.__table__.delete())
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': f'actor {i}', 'age': 20 + i % 60,
+             'gender': 'female' if i % 2 else 'male'} for i in range(rows)])
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': f'movie {i}', 'release_date': parse_date(
+                f'{i % 12 + 1:02d}-01-{2000 + i % 20}')}
+            for i in range(rows)])
+        db.session.commit()
+        ids = [row[0] for row in db.session.query(Actor.id)]
+        db.engine.dispose()
+    return ids
+
+
+def wait_ready(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with %s' % process.returncode)
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+
+def client(port, token, ids, stop, latencies, errors):
+    headers = {'Authorization': f'Bearer {token}'}
+    paths = ['/actors?limit=50', '/movies?limit=50',
+             '/actors?limit=50&sort=-age&gender=female']
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    rng = random.Random()
+    while not stop.is_set():
+        if rng.random() < 0.5:
+            path = rng.choice(paths)
+        else:
+            path = f'/actors/{rng.choice(ids)}'
+        started = time.perf_counter()
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException):
+            errors.append('connection')
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(worker_class, args, env, ids, port):
+    env = dict(env, GUNICORN_WORKER_CLASS=worker_class,
+               WEB_CONCURRENCY=str(args.workers), PORT=str(port),
+               DB_POOL_LOG_INTERVAL='0')
+    if worker_class == 'uvicorn':
+        command = ['uvicorn', '--factory', 'asgi:create_app',
+                   '--port', str(port), '--workers', str(args.workers),
+                   '--no-access-log', '--log-level', 'warning']
+    else:
+        command = ['gunicorn', '--config', 'gunicorn.conf.py',
+                   '--access-logfile', '/dev/null', 'wsgi:app']
+    process = subprocess.Popen(
+        [sys.executable, '-m', *command], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port, process)
+        stop = threading.Event()
+        latencies = []
+        errors = []
+        clients = [threading.Thread(
+            target=client,
+            args=(port, env['BENCH_TOKEN'], ids, stop, latencies, errors))
+            for _ in range(args.clients)]
+        for thread in clients:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in clients:
+            thread.join()
+    finally:
+        process.terminate()
+        process.wait()
+    latencies.sort()
+    return {
+        'worker_class': worker_class,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / args.duration,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classes', nargs='+',
+                        default=['sync', 'gthread', 'gevent', 'uvicorn'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    auth = LocalAuth()
+    auth.configure()
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'bench.db'))
+    ids = seed(args.rows)
+    env = dict(os.environ,
+               BENCH_TOKEN=auth.token(['get:actors', 'get:movies']))
+
+    print(f'{args.workers} workers, {args.clients} clients, '
+          f'{args.duration:g}s each, {args.rows} rows')
+    print(f'{"class":<8} {"rps":>8} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"p99 ms":>8} {"errors":>7}')
+    for worker_class in args.classes:
+        result = run(worker_class, args, env, ids, args.port)
+        print(f'{worker_class:<8} {result["rps"]:>8.1f} '
+              f'{result["p50_ms"]:>8.1f} {result["p95_ms"]:>8.1f} '
+              f'{result["p99_ms"]:>8.1f} {result["errors"]:>7}')
+
+
+if __name__ == '__main__':
+    main()
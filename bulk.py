@@ -0,0 +1,204 @@
+import json
+import os
+from flask import request, abort
+from models import insert_many, update_many, delete_many, parse_date
+
+
+MAX_BULK_ITEMS = int(os.environ.get('MAX_BULK_ITEMS', 10000))
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 500))
+
+
+'''
+Bulk writes
+Bulk creates take a JSON array of objects, or one object per line with
+Content-Type: application/x-ndjson, and validate every item on its own so
+errors can be reported per item.
+
+Bulk updates and deletes select their rows with either
+    ids: a list of ids
+    filter: an object of column values the rows must equal
+and run as a single set-based UPDATE/DELETE ... RETURNING.
+With ?return=count only the number of affected rows is returned.
+'''
+
+
+ACTOR_FILTERS = ('name', 'age', 'gender')
+MOVIE_FILTERS = ('title', 'release_date')
+
+
+# Reads the items of a bulk request body
+# Aborts with 422 if the body is not a list of objects
+def get_bulk_items():
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            items = [json.loads(line)
+                     for line in request.get_data(as_text=True).splitlines()
+                     if line.strip()]
+        else:
+            items = request.get_json()
+    except Exception:
+        abort(422)
+    if not isinstance(items, list) or not items:
+        abort(422)
+    if len(items) > MAX_BULK_ITEMS:
+        abort(422)
+    return items
+
+
+# Checks the fields required to create an actor
+# Returns the column values or raises ValueError
+def validate_actor(item):
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+    name = item.get('name')
+    age = item.get('age')
+    gender = item.get('gender')
+    if name is None:
+        raise ValueError('name is required')
+    if age is None:
+        raise ValueError('age is required')
+    if gender is None:
+        raise ValueError('gender is required')
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        raise ValueError('age must be an integer')
+    return {'name': name, 'age': age, 'gender': gender}
+
+
+# Checks the fields required to create a movie
+# Returns the column values or raises ValueError
+def validate_movie(item):
+    if not isinstance(item, dict):
+        raise ValueError('item must be an object')
+    title = item.get('title')
+    release_date = item.get('release_date')
+    if title is None:
+        raise ValueError('title is required')
+    if release_date is None:
+        raise ValueError('release_date is required')
+    try:
+        release_date = parse_date(release_date)
+    except ValueError:
+        raise ValueError('release_date must be MM-DD-YYYY or YYYY-MM-DD')
+    return {'title': title, 'release_date': release_date}
+
+
+# Validates every item and inserts the valid ones in one transaction
+# Returns the created instances and the per-item errors
+def bulk_create(model, items, validate):
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append((index, validate(item)))
+        except ValueError as e:
+            errors.append({'index': index, 'message': str(e)})
+
+    created = []
+    for index, obj, error in insert_many(model, rows, BULK_BATCH_SIZE):
+        if error is None:
+            created.append(obj)
+        else:
+            errors.append({
+                'index': index,
+                'message': f'could not be inserted ({error})'
+            })
+    errors.sort(key=lambda error: error['index'])
+    return created, errors
+
+
+# Builds the WHERE criteria of a bulk update or delete from the body
+# Aborts with 422 unless exactly one of ids or filter selects rows
+def get_bulk_criteria(model, body, allowed):
+    if not isinstance(body, dict):
+        abort(422)
+    ids = body.get('ids')
+    filters = body.get('filter')
+    if (ids is None) == (filters is None):
+        abort(422)
+    if ids is not None:
+        if not isinstance(ids, list) or not ids or \
+                not all(isinstance(i, int) for i in ids):
+            abort(422)
+        if len(ids) > MAX_BULK_ITEMS:
+            abort(422)
+        return [model.id.in_(ids)]
+    if not isinstance(filters, dict) or not filters:
+        abort(422)
+    criteria = []
+    for column, value in filters.items():
+        if column not in allowed:
+            abort(422)
+        if column == 'release_date':
+            try:
+                value = parse_date(value)
+            except ValueError:
+                abort(422)
+        criteria.append(getattr(model, column) == value)
+    return criteria
+
+
+# Checks the changes of a bulk actor update
+# Returns the column values or raises ValueError
+def validate_actor_changes(changes):
+    if not isinstance(changes, dict):
+        raise ValueError('changes must be an object')
+    values = {}
+    for column in ('name', 'age', 'gender'):
+        if changes.get(column) is not None:
+            values[column] = changes[column]
+    if 'age' in values:
+        try:
+            values['age'] = int(values['age'])
+        except (TypeError, ValueError):
+            raise ValueError('age must be an integer')
+    if not values:
+        raise ValueError('no changes given')
+    return values
+
+
+# Checks the changes of a bulk movie update
+# Returns the column values or raises ValueError
+def validate_movie_changes(changes):
+    if not isinstance(changes, dict):
+        raise ValueError('changes must be an object')
+    values = {}
+    for column in ('title', 'release_date'):
+        if changes.get(column) is not None:
+            values[column] = changes[column]
+    if 'release_date' in values:
+        try:
+            values['release_date'] = parse_date(values['release_date'])
+        except ValueError:
+            raise ValueError(
+                'release_date must be MM-DD-YYYY or YYYY-MM-DD')
+    if not values:
+        raise ValueError('no changes given')
+    return values
+
+
+def count_only():
+    return request.args.get('return') == 'count'
+
+
+# Applies the changes to every selected row in one UPDATE statement
+# Returns the updated instances, or their count with ?return=count
+def bulk_update(model, allowed, validate):
+    body = request.get_json(silent=True)
+    criteria = get_bulk_criteria(model, body, allowed)
+    try:
+        values = validate(body.get('changes'))
+    except ValueError:
+        abort(422)
+    changed = update_many(model, criteria, values, ids_only=count_only())
+    return len(changed) if count_only() else changed
+
+
+# Deletes every selected row in one DELETE statement
+# Returns the deleted instances, or their count with ?return=count
+def bulk_delete(model, allowed):
+    body = request.get_json(silent=True)
+    criteria = get_bulk_criteria(model, body, allowed)
+    changed = delete_many(model, criteria, ids_only=count_only())
+    return len(changed) if count_only() else changed
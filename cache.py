@@ -0,0 +1,207 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from flask import Response
+
+
+'''
+Detail cache
+A read-through cache of serialized GET /actors/<id> and GET /movies/<id>
+bodies in two tiers:
+
+    L1: a bounded LRU in each gunicorn worker (DETAIL_CACHE_SIZE entries,
+    default 1024, 0 disables)
+    L2: an optional store shared by all workers and dynos, speaking the
+    Redis protocol (DETAIL_CACHE_URL, e.g. redis://localhost:6379/0)
+
+Model writes invalidate both tiers. Entries of both tiers also remember
+the database version of the row they were read at (see versions.py) and
+are dropped when it no longer matches, so writes the app did not make are
+seen too, and a reader that missed before a write cannot fill either tier
+with the old body after the invalidation. Every entry expires
+after DETAIL_CACHE_TTL seconds (default 30). Hits, misses and the age of the
+oldest entry served are kept in stats().
+'''
+
+
+# In-process stand-in for the Redis commands used by the L2 tier,
+# for tests and benchmarks (DETAIL_CACHE_URL=local://)
+class LocalStore:
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        if self._expires.get(key, float('inf')) <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return self._data.get(key)
+
+    def hget(self, key, field):
+        with self._lock:
+            return (self._live(key) or {}).get(field)
+
+    def hset(self, key, field, value):
+        with self._lock:
+            self._data.setdefault(key, {})[field] = value
+
+    def expire(self, key, seconds):
+        with self._lock:
+            self._expires[key] = time.time() + seconds
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+
+
+class DetailCache:
+    def __init__(self, maxsize=1024, ttl=30, shared=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.l2_errors = 0
+        self.max_served_age = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _shared_key(table, row_id):
+        return f'casting:detail:{table}:{row_id}'
+
+    def _served(self, stored_at):
+        age = time.time() - stored_at
+        if age > self.max_served_age:
+            self.max_served_age = age
+        return age
+
+    # Returns (body, age) on a hit or (None, None)
+    # version is the row version read before the row itself and must be
+    # handed to put() after a miss
+    def get(self, table, row_id, version, variant=''):
+        key = (table, row_id, variant)
+        if self.maxsize > 0:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry_version, body, stored_at = entry
+                    if entry_version == version and \
+                            time.time() - stored_at < self.ttl:
+                        self._entries.move_to_end(key)
+                        self.l1_hits += 1
+                        return body, self._served(stored_at)
+                    del self._entries[key]
+        if self.shared is not None:
+            try:
+                value = self.shared.hget(
+                    self._shared_key(table, row_id), variant)
+            except Exception:
+                print(sys.exc_info())
+                self.l2_errors += 1
+                value = None
+            if value is not None:
+                try:
+                    stored_at, entry_version, body = \
+                        bytes(value).split(b'\n', 2)
+                    stored_at = float(stored_at)
+                    entry_version = int(entry_version)
+                except ValueError:
+                    entry_version = None
+                if entry_version == version:
+                    self._put_local(key, version, body, stored_at)
+                    self.l2_hits += 1
+                    return body, self._served(stored_at)
+        self.misses += 1
+        return None, None
+
+    def _put_local(self, key, version, body, stored_at):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (version, body, stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def put(self, table, row_id, version, body, variant=''):
+        stored_at = time.time()
+        self._put_local((table, row_id, variant), version, body, stored_at)
+        if self.shared is not None:
+            shared_key = self._shared_key(table, row_id)
+            try:
+                self.shared.hset(shared_key, variant,
+                                 f'{stored_at!r}\n{version}\n'.encode() +
+                                 body)
+                self.shared.expire(shared_key, int(self.ttl) or 1)
+            except Exception:
+                print(sys.exc_info())
+                self.l2_errors += 1
+
+    # Drops every cached variant of the rows from both tiers
+    def invalidate(self, table, *row_ids):
+        row_ids = set(row_ids)
+        with self._lock:
+            for key in [key for key in self._entries
+                        if key[0] == table and key[1] in row_ids]:
+                del self._entries[key]
+        if self.shared is not None and row_ids:
+            try:
+                self.shared.delete(*(self._shared_key(table, row_id)
+                                     for row_id in row_ids))
+            except Exception:
+                print(sys.exc_info())
+                self.l2_errors += 1
+
+    def stats(self):
+        lookups = self.l1_hits + self.l2_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'l1_hits': self.l1_hits,
+            'l2_hits': self.l2_hits,
+            'misses': self.misses,
+            'l2_errors': self.l2_errors,
+            'hit_ratio': (self.l1_hits + self.l2_hits) / lookups
+            if lookups else 0.0,
+            'max_served_age': self.max_served_age
+        }
+
+
+# Builds the response of a cache hit
+def cached_response(body, age, etag):
+    response = Response(body, mimetype='application/json')
+    response.headers['Age'] = str(int(age))
+    response.set_etag(etag)
+    return response
+
+
+def create_shared_store(url, setting='DETAIL_CACHE_URL'):
+    if not url:
+        return None
+    if url == 'local://':
+        return LocalStore()
+    try:
+        import redis
+    except ImportError:
+        print(f'{setting} is set but the redis package is missing')
+        return None
+    return redis.Redis.from_url(url, socket_timeout=0.05)
+
+
+def create_detail_cache():
+    return DetailCache(
+        maxsize=int(os.environ.get('DETAIL_CACHE_SIZE', 1024)),
+        ttl=float(os.environ.get('DETAIL_CACHE_TTL', 30)),
+        shared=create_shared_store(os.environ.get('DETAIL_CACHE_URL'))
+    )
+
+
+DETAIL_CACHE = create_detail_cache()
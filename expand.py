@@ -0,0 +1,81 @@
+from flask import request, abort
+from sqlalchemy.orm import selectinload
+from models import Movie, Actor, movie_actors, count_casting
+
+
+'''
+Casting expansion
+?expand= adds the casting relationship to movie and actor responses
+without a query per parent row:
+
+    movies: expand=cast adds "actors", expand=cast_count adds "cast_count"
+    actors: expand=movies adds "movies", expand=movie_count adds
+    "movie_count"
+
+Related rows are loaded for the whole page in one selectin query and
+counts come from one GROUP BY aggregate, so the number of queries per
+request does not depend on the page size.
+'''
+
+
+EXPANSIONS = {
+    Movie: {
+        'relation': Movie.actors,
+        'rows': 'cast',
+        'count': 'cast_count',
+        'key': 'actors',
+        'table': 'actors',
+        'column': movie_actors.c.movie_id
+    },
+    Actor: {
+        'relation': Actor.movies,
+        'rows': 'movies',
+        'count': 'movie_count',
+        'key': 'movies',
+        'table': 'movies',
+        'column': movie_actors.c.actor_id
+    }
+}
+
+
+# Reads the expand parameter of the request
+# (args defaults to the Flask request's)
+# Aborts with 422 on an expansion the model does not have
+def get_expand(model, args=None):
+    if args is None:
+        args = request.args
+    expansion = EXPANSIONS[model]
+    expand = set(filter(None, args.get('expand', '').split(',')))
+    if not expand <= {expansion['rows'], expansion['count']}:
+        abort(422)
+    return expand
+
+
+# Returns the other tables an expanded response depends on
+def expand_tables(model, expand):
+    return (EXPANSIONS[model]['table'],) if expand else ()
+
+
+# Adds the loader options needed by the expansions to the query
+def expand_query(query, model, expand):
+    expansion = EXPANSIONS[model]
+    if expansion['rows'] in expand:
+        query = query.options(selectinload(expansion['relation']))
+    return query
+
+
+# Formats the rows with their expansions
+def format_expanded(rows, model, expand):
+    expansion = EXPANSIONS[model]
+    formatted = [row.format() for row in rows]
+    if expansion['rows'] in expand:
+        for row, data in zip(rows, formatted):
+            data[expansion['key']] = [
+                related.format()
+                for related in getattr(row, expansion['key'])]
+    if expansion['count'] in expand:
+        counts = count_casting(expansion['column'],
+                               [row.id for row in rows])
+        for data in formatted:
+            data[expansion['count']] = counts[data['id']]
+    return formatted
@@ -0,0 +1,66 @@
+from datetime import date
+from flask import request, abort
+from models import Movie, Actor, db, DATE_FORMAT
+from expand import EXPANSIONS, expand_query, format_expanded
+
+
+'''
+Sparse fieldsets
+?fields=id,name returns only the listed fields. Without an expansion the
+query selects just those columns (plus id and the sort key, which keyset
+pagination needs) as plain rows instead of hydrating full entities.
+'''
+
+
+FIELDS = {
+    Movie: ('id', 'title', 'release_date'),
+    Actor: ('id', 'name', 'age', 'gender')
+}
+
+
+# Reads the fields parameter of the request
+# (args defaults to the Flask request's)
+# Returns the requested fields, or None when every field is wanted
+# Aborts with 422 on a field the model does not have
+def get_fields(model, args=None):
+    if args is None:
+        args = request.args
+    fields = args.get('fields')
+    if fields is None:
+        return None
+    fields = list(dict.fromkeys(filter(None, fields.split(','))))
+    if not fields or not set(fields) <= set(FIELDS[model]):
+        abort(422)
+    return fields
+
+
+# Builds the base query of a read endpoint
+# selecting only the needed columns when possible
+def select_fields(model, fields, expand=(), sort=None):
+    if fields is None or expand:
+        return expand_query(model.query, model, expand)
+    needed = {'id', *fields}
+    if sort is not None:
+        needed.add(sort.key)
+    return db.session.query(*[getattr(model, field)
+                              for field in FIELDS[model]
+                              if field in needed])
+
+
+def _value(value):
+    if isinstance(value, date):
+        return value.strftime(DATE_FORMAT)
+    return value
+
+
+# Formats the rows returned by a select_fields query
+def format_fields(rows, model, fields, expand=()):
+    if fields is None:
+        return format_expanded(rows, model, expand)
+    if expand:
+        expansion = EXPANSIONS[model]
+        keep = set(fields) | {expansion['key'], expansion['count']}
+        return [{key: value for key, value in data.items() if key in keep}
+                for data in format_expanded(rows, model, expand)]
+    return [{field: _value(getattr(row, field)) for field in fields}
+            for row in rows]
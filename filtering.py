@@ -0,0 +1,96 @@
+from flask import request, abort
+from models import Movie, Actor, parse_date
+
+
+'''
+Filtering and sorting
+List endpoints push filters and sorting down into SQL. The readers take
+the query string of the Flask request unless given another mapping (the
+ASGI app passes its own).
+
+    /actors: gender, min_age, max_age, name_prefix
+    /movies: title_prefix, released_after, released_before (inclusive)
+    sort: a sort key, prefixed with - for descending order
+
+Sort keys are limited to columns with a (column, id) index so every
+allowed query is index-backed (see migrations/versions).
+'''
+
+
+ACTOR_SORTS = ('id', 'name', 'age')
+MOVIE_SORTS = ('id', 'title', 'release_date')
+
+
+# Reads the sort parameter of the request
+# Returns the sort column and whether it is descending
+# Aborts with 422 on a column that is not a sort key
+def get_sort(model, allowed, args=None):
+    if args is None:
+        args = request.args
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    key = sort.lstrip('-')
+    if key not in allowed:
+        abort(422)
+    return getattr(model, key), descending
+
+
+def _int_arg(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(422)
+
+
+def _date_arg(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse_date(value)
+    except ValueError:
+        abort(422)
+
+
+def _prefix(column, prefix):
+    escaped = prefix.replace('\\', '\\\\') \
+        .replace('%', '\\%').replace('_', '\\_')
+    return column.like(escaped + '%', escape='\\')
+
+
+# Applies the actor filters of the request to the query
+def filter_actors(query, args=None):
+    if args is None:
+        args = request.args
+    gender = args.get('gender')
+    min_age = _int_arg(args, 'min_age')
+    max_age = _int_arg(args, 'max_age')
+    name_prefix = args.get('name_prefix')
+    if gender is not None:
+        query = query.filter(Actor.gender == gender)
+    if min_age is not None:
+        query = query.filter(Actor.age >= min_age)
+    if max_age is not None:
+        query = query.filter(Actor.age <= max_age)
+    if name_prefix:
+        query = query.filter(_prefix(Actor.name, name_prefix))
+    return query
+
+
+# Applies the movie filters of the request to the query
+def filter_movies(query, args=None):
+    if args is None:
+        args = request.args
+    title_prefix = args.get('title_prefix')
+    released_after = _date_arg(args, 'released_after')
+    released_before = _date_arg(args, 'released_before')
+    if title_prefix:
+        query = query.filter(_prefix(Movie.title, title_prefix))
+    if released_after is not None:
+        query = query.filter(Movie.release_date >= released_after)
+    if released_before is not None:
+        query = query.filter(Movie.release_date <= released_before)
+    return query
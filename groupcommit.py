@@ -0,0 +1,198 @@
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import rows_changed
+
+
+'''
+Group commit
+With GROUP_COMMIT=1 single-row creates and updates (POST and PATCH of
+/actors/<id> and /movies/<id>) are not committed one request at a time:
+writes arriving within GROUP_COMMIT_WINDOW_MS (default 2) of each other,
+up to GROUP_COMMIT_MAX (default 32), share one transaction and so one
+commit (one WAL flush on Postgres) per group.
+
+The first writer of a group leads it: it waits out the window, runs every
+item of the group in a SAVEPOINT of its own and commits once, while the
+other writers wait for their result. An item that fails only rolls back
+its savepoint, so its caller gets the error and the others their rows.
+One group commits at a time per worker process: writes arriving during a
+commit form the next group, led by the first of them without waiting for
+another window.
+
+Every commit on the engine is counted (db_commits_total on /metrics)
+whether group commit is on or not, so both paths can be compared;
+benchmarks/groupcommit.py does that.
+'''
+
+
+class _Item:
+    __slots__ = ('run', 'result', 'error', 'finished', 'wake')
+
+    def __init__(self, run):
+        self.run = run
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.wake = threading.Event()
+
+
+class CommitCounter:
+    def __init__(self):
+        self.commits = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, conn):
+        with self._lock:
+            self.commits += 1
+
+
+COMMITS = CommitCounter()
+
+
+class GroupCommitter:
+    def __init__(self, engine, window=0.002, max_items=32):
+        self.engine = engine
+        self.window = window
+        self.max_items = max_items
+        self.groups = 0
+        self.items = 0
+        self.failed_items = 0
+        self.max_group = 0
+        self._pending = []
+        self._leading = False
+        self._cond = threading.Condition()
+
+    # Runs run(session) in the next group and returns its result
+    # Raises the error of the item if it failed
+    def submit(self, run):
+        item = _Item(run)
+        with self._cond:
+            self._pending.append(item)
+            lead = not self._leading
+            self._leading = True
+            if len(self._pending) >= self.max_items:
+                self._cond.notify_all()
+        if lead:
+            self._lead(wait=True)
+        while True:
+            item.wake.wait()
+            if item.finished:
+                break
+            # the previous leader handed over the items that queued up
+            # during its commit, they have waited long enough
+            item.wake.clear()
+            self._lead(wait=False)
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _lead(self, wait):
+        deadline = time.monotonic() + (self.window if wait else 0)
+        with self._cond:
+            while len(self._pending) < self.max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            group = self._pending[:self.max_items]
+            del self._pending[:self.max_items]
+        self._commit(group)
+        # one group commits at a time, the next leader is the first writer
+        # that queued up meanwhile
+        with self._cond:
+            if self._pending:
+                self._pending[0].wake.set()
+            else:
+                self._leading = False
+
+    def _commit(self, group):
+        session = Session(bind=self.engine, expire_on_commit=False)
+        try:
+            for item in group:
+                try:
+                    with session.begin_nested():
+                        item.result = item.run(session)
+                except Exception as e:
+                    item.error = e
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            for item in group:
+                if item.error is None:
+                    item.error = e
+        finally:
+            session.close()
+
+        changed = {}
+        for item in group:
+            if item.error is None:
+                changed.setdefault(item.result.__tablename__, []) \
+                    .append(item.result.id)
+        try:
+            for table, row_ids in changed.items():
+                rows_changed(table, *row_ids)
+        finally:
+            with self._cond:
+                self.groups += 1
+                self.items += len(group)
+                self.failed_items += sum(item.error is not None
+                                         for item in group)
+                self.max_group = max(self.max_group, len(group))
+            for item in group:
+                item.finished = True
+                item.wake.set()
+
+    # Inserts a row of the model
+    # Returns the detached instance
+    def insert(self, model, values):
+        def run(session):
+            obj = model(**values)
+            session.add(obj)
+            session.flush()
+            return obj
+        return self.submit(run)
+
+    # Updates the columns of a row given a value other than None
+    # Returns the detached instance, raises LookupError if it is missing
+    def update(self, model, row_id, values):
+        def run(session):
+            obj = session.get(model, row_id)
+            if obj is None:
+                raise LookupError(f'{model.__tablename__} {row_id}')
+            for key, value in values.items():
+                if value is not None:
+                    setattr(obj, key, value)
+            session.flush()
+            return obj
+        return self.submit(run)
+
+    def stats(self):
+        return {
+            'groups': self.groups,
+            'items': self.items,
+            'failed_items': self.failed_items,
+            'max_group': self.max_group
+        }
+
+
+def _flag(value):
+    return str(value).lower() not in ('', '0', 'false', 'no')
+
+
+# sets up commit counting and, with GROUP_COMMIT, the group committer
+# the settings are read from the app config or the environment
+def setup_group_commit(app, engine):
+    def setting(key, default):
+        return app.config.get(key, os.environ.get(key, default))
+
+    if not event.contains(engine, 'commit', COMMITS):
+        event.listen(engine, 'commit', COMMITS)
+    app.extensions['group_commit'] = None
+    if _flag(setting('GROUP_COMMIT', '')):
+        app.extensions['group_commit'] = GroupCommitter(
+            engine,
+            window=float(setting('GROUP_COMMIT_WINDOW_MS', 2)) / 1000,
+            max_items=int(setting('GROUP_COMMIT_MAX', 32)))
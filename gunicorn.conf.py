@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+
+
+'''
+Gunicorn configuration
+Used by the Procfile (gunicorn --config gunicorn.conf.py wsgi:app).
+
+    GUNICORN_WORKER_CLASS: gthread (default), gevent or sync
+    WEB_CONCURRENCY: worker processes (default: CPU count + 1)
+    WEB_THREADS: threads per gthread worker (default 4)
+    GEVENT_CONNECTIONS: concurrent requests per gevent worker (default 100)
+
+The app is preloaded in the master, so imports, the JWKS warm-up of
+wsgi.py and mapper configuration happen once and the workers share those
+pages. Connections opened while loading are closed before forking, and
+each worker drops the engine pools (primary and replicas) it inherited so
+no socket or lock is shared between processes.
+
+WEB_CONCURRENCY and WEB_THREADS are written back to the environment before
+the app loads, so pool.py sizes each worker's pool from the same numbers.
+'''
+
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_connections = int(os.environ.get('GEVENT_CONNECTIONS', 100))
+
+if worker_class == 'gevent':
+    # patch before the app is preloaded, not when the worker boots,
+    # and let psycopg2 yield to other greenlets while waiting on Postgres
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+    # every greenlet may hold a connection; pool.py caps the pool at the
+    # worker's share of DB_MAX_CONNECTIONS
+    os.environ.setdefault('WEB_THREADS', str(worker_connections))
+elif worker_class == 'sync':
+    os.environ.setdefault('WEB_THREADS', '1')
+else:
+    os.environ.setdefault('WEB_THREADS', str(threads))
+os.environ.setdefault('WEB_CONCURRENCY', str(workers))
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+preload_app = True
+# the Heroku router gives up on a request after 30 seconds
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+forwarded_allow_ips = '*'
+accesslog = '-'
+
+
+# Closes the connections the master opened while loading the app
+# and drops the metrics snapshots of the previous run
+def when_ready(server):
+    from models import db
+    from replicas import dispose_replicas
+    from metrics import REGISTRY
+    db.engine.dispose()
+    dispose_replicas()
+    REGISTRY.clear()
+
+
+# Drops the engine pools and metric values inherited from the master
+def post_fork(server, worker):
+    from models import db
+    from replicas import dispose_replicas
+    from pool import POOL_STATS
+    from metrics import REGISTRY
+    db.engine.dispose(close=False)
+    dispose_replicas(close=False)
+    POOL_STATS.reset()
+    REGISTRY.after_fork()
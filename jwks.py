@@ -0,0 +1,137 @@
+import json
+import os
+import sys
+import threading
+import time
+from urllib.request import urlopen
+
+
+'''
+JWKS key store
+Keeps the identity provider's signing keys in memory so that verifying a
+token does not cost an outbound HTTPS round trip.
+
+    the keyset is cached for JWKS_TTL seconds (default 600); after that
+    a known kid is still served from the cache while one background
+    thread refetches the keyset
+    a token whose kid is not in the cached keyset waits for a refetch,
+    at most once every JWKS_MIN_REFRESH seconds (default 30) once a
+    keyset has been loaded; until then every such token retries, so a
+    failed fetch at boot does not lock clients out
+    concurrent refetches are collapsed into a single request
+    if a refetch fails the last good keyset keeps being served
+
+    JWKS_JSON (a JWKS document) or JWKS_FILE (a path to one) pin the
+    keyset so benchmarks and offline tests never touch the network
+'''
+
+
+class JWKSStore:
+    def __init__(self, url=None, ttl=600, min_refresh=30, timeout=5,
+                 static_jwks=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._attempted_at = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._static = static_jwks is not None
+        if self._static:
+            self._install(static_jwks)
+
+    def _install(self, jwks):
+        self._keys = {key['kid']: key for key in jwks.get('keys', [])
+                      if 'kid' in key}
+        self._fetched_at = time.monotonic()
+        self._generation += 1
+
+    def _fetch(self):
+        response = urlopen(self.url, timeout=self.timeout)
+        return json.loads(response.read())
+
+    def _is_fresh(self):
+        return (self._fetched_at is not None and
+                time.monotonic() - self._fetched_at < self.ttl)
+
+    def _throttled(self):
+        return (self._fetched_at is not None and
+                self._attempted_at is not None and
+                time.monotonic() - self._attempted_at < self.min_refresh)
+
+    # Refetches the keyset, called with the lock held
+    def _attempt(self, force=False):
+        if not force and self._throttled():
+            return
+        self._attempted_at = time.monotonic()
+        try:
+            self._install(self._fetch())
+        except Exception:
+            # Keep serving the last good keyset
+            print(sys.exc_info())
+
+    # Refetches the keyset and waits for it
+    def refresh(self, force=False):
+        if self._static:
+            return
+        generation = self._generation
+        with self._lock:
+            # Another thread refreshed while we were waiting for the lock
+            if self._generation != generation:
+                return
+            self._attempt(force)
+
+    # Starts a refetch in a background thread, unless one is running
+    # or the last attempt was less than min_refresh seconds ago
+    def refresh_in_background(self):
+        if self._static or not self._lock.acquire(blocking=False):
+            return
+        if self._throttled():
+            self._lock.release()
+            return
+
+        def run():
+            try:
+                self._attempt()
+            finally:
+                self._lock.release()
+
+        try:
+            threading.Thread(target=run, daemon=True).start()
+        except Exception:
+            self._lock.release()
+            raise
+
+    def warm(self):
+        self.refresh(force=True)
+
+    def get_key(self, kid):
+        key = self._keys.get(kid)
+        if key is not None:
+            if not self._is_fresh():
+                self.refresh_in_background()
+            return key
+        self.refresh()
+        return self._keys.get(kid)
+
+
+def load_static_jwks():
+    if os.environ.get('JWKS_JSON'):
+        return json.loads(os.environ['JWKS_JSON'])
+    if os.environ.get('JWKS_FILE'):
+        with open(os.environ['JWKS_FILE']) as f:
+            return json.load(f)
+    return None
+
+
+def create_jwks_store(auth0_domain):
+    return JWKSStore(
+        url=os.environ.get(
+            'JWKS_URL', f'https://{auth0_domain}/.well-known/jwks.json'),
+        ttl=float(os.environ.get('JWKS_TTL', 600)),
+        min_refresh=float(os.environ.get('JWKS_MIN_REFRESH', 30)),
+        timeout=float(os.environ.get('JWKS_TIMEOUT', 5)),
+        static_jwks=load_static_jwks()
+    )
@@ -1,13 +1,24 @@
-from flask_script import Manager
+from flask_script import Command, Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import APP
+from app import create_app
 from models import db
+from stats import rebuild_stats as rebuild_catalogue_stats
+
+app = create_app()
+migrate = Migrate(app, db)
+manager = Manager(app)
+
+
+# recomputes the catalogue statistics from the actors and movies tables
+class RebuildStats(Command):
+    def run(self):
+        with db.engine.begin() as connection:
+            rebuild_catalogue_stats(connection)
 
-migrate = Migrate(APP, db)
-manager = Manager(APP)
 
 manager.add_command('db', MigrateCommand)
+manager.add_command('rebuild_stats', RebuildStats())
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,380 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, g, request
+from authentication import AuthError
+from pool import POOL_STATS
+from cache import DETAIL_CACHE
+from groupcommit import COMMITS
+
+
+'''
+Metrics
+An in-process registry served at GET /metrics in the Prometheus text
+format:
+
+    http_requests_total and http_request_duration_seconds per route,
+    method and status, error handler responses included
+    http_response_size_bytes per route (streamed bodies are not counted)
+    auth_token_cache_*, db_pool_* and detail_cache_* from the existing
+    caches and POOL_STATS
+    http_requests_in_flight, http_requests_shed_total and
+    rate_limit_* from the admission control of ratelimit.py
+    db_commits_total and group_commit_* from groupcommit.py
+    db_replica_* from the read routing of replicas.py
+
+Recording a request only updates a dict under a lock. A background thread
+in each worker writes a snapshot of its values to METRICS_DIR every
+METRICS_FLUSH seconds (default 1; the worker serving /metrics writes its
+own first), and /metrics adds up the snapshots of every worker on the
+dyno. Counters and histograms of workers
+that have exited keep counting; gauges only come from live workers.
+METRICS_TOKEN, when set, is required as a bearer token to read /metrics.
+'''
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+HELP = {
+    'http_requests_total': ('counter', 'HTTP requests served'),
+    'http_request_duration_seconds': (
+        'histogram', 'Time spent serving HTTP requests'),
+    'http_response_size_bytes': ('histogram', 'Size of HTTP response bodies'),
+    'auth_token_cache_hits_total': (
+        'counter', 'Requests served from the verified token cache'),
+    'auth_token_cache_misses_total': (
+        'counter', 'Requests that had to verify their token'),
+    'auth_token_cache_evictions_total': (
+        'counter', 'Verified tokens evicted from the cache'),
+    'auth_token_cache_size': ('gauge', 'Verified tokens in the cache'),
+    'db_pool_checkouts_total': ('counter', 'Database connection checkouts'),
+    'db_pool_checkout_wait_seconds_total': (
+        'counter', 'Time spent waiting for a database connection'),
+    'db_pool_overflows_total': (
+        'counter', 'Connections opened beyond the pool size'),
+    'db_pool_timeouts_total': (
+        'counter', 'Checkouts that timed out waiting for a connection'),
+    'db_pool_connections_in_use': (
+        'gauge', 'Database connections checked out'),
+    'db_pool_size': ('gauge', 'Configured database pool size'),
+    'detail_cache_hits_total': ('counter', 'Detail reads served from cache'),
+    'detail_cache_misses_total': ('counter', 'Detail reads that missed'),
+    'detail_cache_size': ('gauge', 'Detail bodies in the local cache'),
+    'http_requests_in_flight': (
+        'gauge', 'Requests being served by the process'),
+    'http_requests_shed_total': (
+        'counter', 'Requests answered 503 by the load shedder'),
+    'rate_limit_rejections_total': (
+        'counter', 'Requests answered 429 by the rate limiter'),
+    'rate_limit_backend_errors_total': (
+        'counter', 'Shared rate limit calls that failed'),
+    'db_commits_total': ('counter', 'Transactions committed'),
+    'group_commit_groups_total': (
+        'counter', 'Transactions committed by the group committer'),
+    'group_commit_items_total': (
+        'counter', 'Writes submitted to the group committer'),
+    'group_commit_failed_items_total': (
+        'counter', 'Group commit writes that failed'),
+    'db_replica_reads_total': (
+        'counter', 'Read requests routed to a replica'),
+    'db_replica_fallbacks_total': (
+        'counter', 'Read requests kept on the primary'),
+    'db_replica_failures_total': (
+        'counter', 'Failed replica checks and lost replica connections'),
+    'db_replica_up': ('gauge', 'Whether the replica serves reads'),
+    'db_replica_lag_seconds': ('gauge', 'Replay lag of the replica')
+}
+
+
+def default_metrics_dir():
+    database = os.environ.get('DATABASE_URL', '')
+    digest = hashlib.sha1(database.encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'casting-metrics-{digest}')
+
+
+class Registry:
+    def __init__(self, path=None, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.histograms = {}
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def directory(self):
+        return self.path or os.environ.get('METRICS_DIR',
+                                           default_metrics_dir())
+
+    # Clears the values a worker inherited from the master
+    def after_fork(self):
+        self.__init__(self.path, self.flush_interval)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value, buckets=BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = \
+                    [0] * (len(buckets) + 1) + [0.0, buckets]
+            # the last slot holds the buckets, the one before it the sum
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+
+    def snapshot(self, collected):
+        with self._lock:
+            counters = [[name, list(labels), value]
+                        for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), values[:-1], values[-1]]
+                          for (name, labels), values
+                          in self.histograms.items()]
+        counters.extend(collected['counters'])
+        return {'pid': os.getpid(), 'counters': counters,
+                'histograms': histograms, 'gauges': collected['gauges']}
+
+    # Writes this worker's snapshot for the other workers to read
+    def flush(self, collect):
+        with self._flush_lock:
+            directory = self.directory()
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'{os.getpid()}.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(collect()), f)
+            os.replace(path + '.tmp', path)
+
+    # Starts the flushing thread of this process, once per process
+    def start_flusher(self, collect):
+        if self._flusher_pid == os.getpid():
+            return
+        with self._flush_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, args=(collect,),
+                         daemon=True).start()
+
+    def _flush_loop(self, collect):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush(collect)
+            except Exception:
+                print(sys.exc_info())
+
+    def clear(self):
+        directory = self.directory()
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+
+REGISTRY = Registry(flush_interval=float(
+    os.environ.get('METRICS_FLUSH', 1)))
+
+
+# Reads the cache and pool counters of this process
+def collect(app):
+    token_cache = app.extensions['token_cache'].stats()
+    detail_cache = DETAIL_CACHE.stats()
+    pool = POOL_STATS.stats()
+    limiter = app.extensions['rate_limiter'].stats()
+    admission = app.extensions['admission'].stats()
+    group_commit = app.extensions['group_commit']
+    groups = group_commit.stats() if group_commit is not None else {}
+    router = app.extensions['replicas']
+    routing = router.stats() if router is not None else \
+        {'fallbacks': {}, 'replicas': []}
+    return {
+        'counters': [
+            ['auth_token_cache_hits_total', [], token_cache['hits']],
+            ['auth_token_cache_misses_total', [], token_cache['misses']],
+            ['auth_token_cache_evictions_total', [],
+             token_cache['evictions']],
+            ['db_pool_checkouts_total', [], pool['checkouts']],
+            ['db_pool_checkout_wait_seconds_total', [],
+             POOL_STATS.wait_total],
+            ['db_pool_overflows_total', [], pool['overflows']],
+            ['db_pool_timeouts_total', [], pool['timeouts']],
+            ['detail_cache_hits_total', [],
+             detail_cache['l1_hits'] + detail_cache['l2_hits']],
+            ['detail_cache_misses_total', [], detail_cache['misses']],
+            ['rate_limit_backend_errors_total', [],
+             limiter['shared_errors']],
+            ['db_commits_total', [], COMMITS.commits]
+        ] + [
+            [f'group_commit_{name}_total', [], groups[name]]
+            for name in ('groups', 'items', 'failed_items') if groups
+        ] + [
+            ['rate_limit_rejections_total', [['permission', permission]],
+             count] for permission, count in limiter['rejections'].items()
+        ] + [
+            ['http_requests_shed_total', [['reason', reason]], count]
+            for reason, count in admission['shed'].items()
+        ] + [
+            ['db_replica_fallbacks_total', [['reason', reason]], count]
+            for reason, count in routing['fallbacks'].items()
+        ] + [
+            [f'db_replica_{name}_total', [['replica', replica['name']]],
+             replica[name]]
+            for replica in routing['replicas']
+            for name in ('reads', 'failures')
+        ],
+        'gauges': [
+            ['auth_token_cache_size', [], token_cache['size']],
+            ['db_pool_connections_in_use', [], pool['in_use']],
+            ['db_pool_size', [], pool['size']],
+            ['detail_cache_size', [], detail_cache['size']],
+            ['http_requests_in_flight', [], admission['in_flight']]
+        ] + [
+            [name, [['replica', replica['name']]], value]
+            for replica in routing['replicas']
+            for name, value in (('db_replica_up', int(replica['up'])),
+                                ('db_replica_lag_seconds', replica['lag']))
+        ]
+    }
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Adds up the snapshots of every worker
+def aggregate(directory):
+    counters = {}
+    histograms = {}
+    gauges = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric, labels, value in snapshot['counters']:
+            key = (metric, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, values, buckets in snapshot['histograms']:
+            key = (metric, tuple(map(tuple, labels)), tuple(buckets))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        if _alive(snapshot['pid']):
+            for metric, labels, value in snapshot['gauges']:
+                key = (metric, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+    return counters, histograms, gauges
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"'
+                          for key, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+def render(counters, histograms, gauges):
+    lines = {}
+    for (metric, labels), value in sorted(counters.items()):
+        lines.setdefault(metric, []).append(
+            f'{metric}{_labels(labels)} {_number(value)}')
+    for (metric, labels), value in sorted(gauges.items()):
+        lines.setdefault(metric, []).append(
+            f'{metric}{_labels(labels)} {_number(value)}')
+    for (metric, labels, buckets), values in sorted(histograms.items()):
+        samples = lines.setdefault(metric, [])
+        cumulative = 0
+        for bound, count in zip(buckets, values):
+            cumulative += count
+            samples.append(f'{metric}_bucket'
+                           f'{_labels(labels, [("le", _number(bound))])} '
+                           f'{cumulative}')
+        cumulative += values[len(buckets)]
+        samples.append(f'{metric}_bucket{_labels(labels, [("le", "+Inf")])} '
+                       f'{cumulative}')
+        samples.append(f'{metric}_sum{_labels(labels)} '
+                       f'{_number(values[-1])}')
+        samples.append(f'{metric}_count{_labels(labels)} {cumulative}')
+    output = []
+    for metric in sorted(lines):
+        kind, description = HELP.get(metric, ('untyped', metric))
+        output.append(f'# HELP {metric} {description}')
+        output.append(f'# TYPE {metric} {kind}')
+        output.extend(lines[metric])
+    return '\n'.join(output) + '\n'
+
+
+# sets up request metrics and the /metrics endpoint for the app
+def setup_metrics(app):
+    token = app.config.get('METRICS_TOKEN',
+                           os.environ.get('METRICS_TOKEN'))
+
+    def collect_app():
+        return collect(app)
+
+    @app.before_request
+    def start_metrics_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_metrics(response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+        rule = request.url_rule
+        route = rule.rule if rule is not None else 'unmatched'
+        labels = (('route', route), ('method', request.method),
+                  ('status', str(response.status_code)))
+        REGISTRY.inc('http_requests_total', labels)
+        REGISTRY.observe('http_request_duration_seconds', labels,
+                         time.perf_counter() - started)
+        size = response.calculate_content_length()
+        if size is not None:
+            REGISTRY.observe('http_response_size_bytes',
+                             (('route', route),), size, SIZE_BUCKETS)
+        REGISTRY.start_flusher(collect_app)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if token:
+            auth = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(auth, f'Bearer {token}'):
+                raise AuthError({
+                    'code': 'invalid_metrics_token',
+                    'description': 'A valid metrics token is expected.'
+                }, 401)
+        REGISTRY.flush(collect_app)
+        return Response(render(*aggregate(REGISTRY.directory())),
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,58 @@
+"""initial schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# Databases created before migrations existed already have these tables
+# (from db.create_all), so only the missing ones are created.
+def upgrade():
+    existing = sa.inspect(op.get_bind()).get_table_names()
+    if 'movies' not in existing:
+        op.create_table(
+            'movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=True),
+            sa.Column('release_date', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'actors' not in existing:
+        op.create_table(
+            'actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=True),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.Column('gender', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'movie_actors' not in existing:
+        op.create_table(
+            'movie_actors',
+            sa.Column('movie_id', sa.Integer(), nullable=False),
+            sa.Column('actor_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                    ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                    ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+        )
+        op.create_index('ix_movie_actors_actor_id', 'movie_actors',
+                        ['actor_id'])
+
+
+def downgrade():
+    op.drop_table('movie_actors')
+    op.drop_table('actors')
+    op.drop_table('movies')
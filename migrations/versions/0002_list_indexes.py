@@ -0,0 +1,48 @@
+"""indexes for filtering and sorting the list endpoints
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+# db.create_all may already have built some of the indexes
+def create_index(name, table, columns, **kw):
+    inspector = sa.inspect(op.get_bind())
+    if name not in {index['name'] for index in inspector.get_indexes(table)}:
+        op.create_index(name, table, columns, **kw)
+
+
+def upgrade():
+    # (sort key, id) indexes back keyset pagination on every sort key
+    create_index('ix_actors_name_id', 'actors', ['name', 'id'])
+    create_index('ix_actors_age_id', 'actors', ['age', 'id'])
+    create_index('ix_actors_gender_id', 'actors', ['gender', 'id'])
+    create_index('ix_actors_gender_age_id', 'actors',
+                 ['gender', 'age', 'id'])
+    create_index('ix_movies_title_id', 'movies', ['title', 'id'])
+    # pattern_ops indexes serve LIKE 'prefix%' under any collation
+    create_index('ix_actors_name_pattern', 'actors', ['name'],
+                 postgresql_ops={'name': 'text_pattern_ops'})
+    create_index('ix_movies_title_pattern', 'movies', ['title'],
+                 postgresql_ops={'title': 'text_pattern_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_pattern', table_name='movies')
+    op.drop_index('ix_actors_name_pattern', table_name='actors')
+    op.drop_index('ix_movies_title_id', table_name='movies')
+    op.drop_index('ix_actors_gender_age_id', table_name='actors')
+    op.drop_index('ix_actors_gender_id', table_name='actors')
+    op.drop_index('ix_actors_age_id', table_name='actors')
+    op.drop_index('ix_actors_name_id', table_name='actors')
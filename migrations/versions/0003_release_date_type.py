@@ -0,0 +1,84 @@
+"""store movies.release_date as an indexed date
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+# Existing values are MM-DD-YYYY strings (some may be YYYY-MM-DD);
+# anything else cannot be converted and becomes NULL
+USING = """
+CASE
+    WHEN release_date ~ '^[0-9]{2}-[0-9]{2}-[0-9]{4}$'
+        THEN to_date(release_date, 'MM-DD-YYYY')
+    WHEN release_date ~ '^[0-9]{4}-[0-9]{2}-[0-9]{2}$'
+        THEN to_date(release_date, 'YYYY-MM-DD')
+END
+"""
+
+
+def convert(value, formats, output):
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt).strftime(output)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+# SQLite has no real date type: SQLAlchemy stores dates there as
+# YYYY-MM-DD text, so only the values are rewritten
+def rewrite_values(formats, output):
+    bind = op.get_bind()
+    movies = sa.table('movies', sa.column('id', sa.Integer),
+                      sa.column('release_date', sa.String))
+    rows = bind.execute(
+        sa.select(movies.c.id, movies.c.release_date)).fetchall()
+    for row in rows:
+        bind.execute(movies.update().where(movies.c.id == row.id).values(
+            release_date=convert(row.release_date, formats, output)))
+
+
+# db.create_all may already have built the column as a date and its index
+def create_index(name, table, columns, **kw):
+    inspector = sa.inspect(op.get_bind())
+    if name not in {index['name'] for index in inspector.get_indexes(table)}:
+        op.create_index(name, table, columns, **kw)
+
+
+def is_date(table, column):
+    inspector = sa.inspect(op.get_bind())
+    return any(isinstance(info['type'], sa.Date) and info['name'] == column
+               for info in inspector.get_columns(table))
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        if not is_date('movies', 'release_date'):
+            op.alter_column('movies', 'release_date', type_=sa.Date(),
+                            postgresql_using=USING)
+    else:
+        rewrite_values(('%m-%d-%Y', '%Y-%m-%d'), '%Y-%m-%d')
+    create_index('ix_movies_release_date_id', 'movies',
+                 ['release_date', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.alter_column('movies', 'release_date', type_=sa.String(),
+                        postgresql_using="to_char(release_date, 'MM-DD-YYYY')")
+    else:
+        rewrite_values(('%Y-%m-%d',), '%m-%d-%Y')
@@ -0,0 +1,202 @@
+"""summary table of the catalogue statistics and its triggers
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+# metric name and bucket expression of each summarized column, {row} is
+# NEW, OLD or the table itself (a copy of stats.METRICS at this revision)
+METRICS = {
+    'postgresql': {
+        'actors': [
+            ('actor_gender', "COALESCE({row}.gender, 'unknown')"),
+            ('actor_age', "COALESCE(({row}.age / 10 * 10)::text, 'unknown')")
+        ],
+        'movies': [
+            ('movie_year', "COALESCE(EXTRACT(YEAR FROM {row}.release_date)"
+                           "::int::text, 'unknown')")
+        ]
+    },
+    'sqlite': {
+        'actors': [
+            ('actor_gender', "COALESCE({row}.gender, 'unknown')"),
+            ('actor_age',
+             "COALESCE(CAST({row}.age / 10 * 10 AS TEXT), 'unknown')")
+        ],
+        'movies': [
+            ('movie_year', "COALESCE(substr({row}.release_date, 1, 4), "
+                           "'unknown')")
+        ]
+    }
+}
+
+COLUMNS = {'actors': 'gender, age', 'movies': 'release_date'}
+
+UPSERT = ('INSERT INTO catalogue_stats (metric, bucket, count) '
+          "VALUES ('{metric}', {bucket}, {delta}) "
+          'ON CONFLICT (metric, bucket) '
+          'DO UPDATE SET count = catalogue_stats.count + excluded.count')
+
+
+def upserts(metrics, row, delta):
+    return [UPSERT.format(metric=metric, bucket=bucket.format(row=row),
+                          delta=delta)
+            for metric, bucket in metrics]
+
+
+# on Postgres the row triggers stage deltas, applied at commit in
+# (metric, bucket) order by a deferred trigger on every catalogue table
+# (a copy of stats.py at this revision)
+CATALOGUE = ('actors', 'movies', 'movie_actors')
+
+DELTA = "('{metric}', {bucket}, {delta})"
+
+APPLY = '''CREATE OR REPLACE FUNCTION apply_catalogue_stats()
+RETURNS trigger AS $$
+BEGIN
+    IF current_setting('casting.stats_pending', true) = 'on' THEN
+        PERFORM set_config('casting.stats_pending', 'off', true);
+        WITH pending AS (
+            DELETE FROM catalogue_stats_deltas
+            RETURNING metric, bucket, delta
+        )
+        INSERT INTO catalogue_stats (metric, bucket, count)
+        SELECT metric, bucket, sum(delta) FROM pending
+        GROUP BY metric, bucket
+        HAVING sum(delta) <> 0
+        ORDER BY metric, bucket
+        ON CONFLICT (metric, bucket)
+        DO UPDATE SET count = catalogue_stats.count + excluded.count;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+
+
+def stage(deltas):
+    return ('INSERT INTO catalogue_stats_deltas (metric, bucket, delta) '
+            'VALUES ' + ', '.join(deltas))
+
+
+def deltas(metrics, row, delta):
+    return [DELTA.format(metric=metric, bucket=bucket.format(row=row),
+                         delta=delta)
+            for metric, bucket in metrics]
+
+
+def moves(metrics):
+    statements = []
+    for metric, bucket in metrics:
+        old, new = bucket.format(row='OLD'), bucket.format(row='NEW')
+        move = stage([DELTA.format(metric=metric, bucket=old, delta=-1),
+                      DELTA.format(metric=metric, bucket=new, delta=1)])
+        statements.append(f'''IF {old} IS DISTINCT FROM {new} THEN
+            {move};
+        END IF''')
+    return statements
+
+
+def create_postgresql_triggers():
+    op.execute(APPLY)
+    for table, metrics in METRICS['postgresql'].items():
+        old = stage(deltas(metrics, 'OLD', -1))
+        new = stage(deltas(metrics, 'NEW', 1))
+        move = ';\n        '.join(moves(metrics))
+        op.execute(f'''CREATE OR REPLACE FUNCTION {table}_catalogue_stats()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {new};
+    ELSIF TG_OP = 'DELETE' THEN
+        {old};
+    ELSE
+        {move};
+    END IF;
+    PERFORM set_config('casting.stats_pending', 'on', true);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql''')
+        op.execute(f'''CREATE TRIGGER {table}_catalogue_stats
+AFTER INSERT OR UPDATE OF {COLUMNS[table]} OR DELETE ON {table}
+FOR EACH ROW EXECUTE PROCEDURE {table}_catalogue_stats()''')
+    for table in CATALOGUE:
+        op.execute(f'''CREATE CONSTRAINT TRIGGER {table}_catalogue_stats_apply
+AFTER INSERT OR UPDATE OR DELETE ON {table}
+DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW EXECUTE PROCEDURE apply_catalogue_stats()''')
+
+
+def create_sqlite_triggers():
+    for table, metrics in METRICS['sqlite'].items():
+        events = [
+            ('insert', 'INSERT', upserts(metrics, 'NEW', 1)),
+            ('update', f'UPDATE OF {COLUMNS[table]}',
+             upserts(metrics, 'OLD', -1) + upserts(metrics, 'NEW', 1)),
+            ('delete', 'DELETE', upserts(metrics, 'OLD', -1))
+        ]
+        for name, when, statements in events:
+            body = ''.join(f'    {statement};\n' for statement in statements)
+            op.execute(f'CREATE TRIGGER {table}_catalogue_stats_{name}\n'
+                       f'AFTER {when} ON {table}\nBEGIN\n{body}END')
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    # db.create_all may already have built the table and its triggers
+    if sa.inspect(op.get_bind()).has_table('catalogue_stats'):
+        return
+    op.create_table(
+        'catalogue_stats',
+        sa.Column('metric', sa.String(), nullable=False),
+        sa.Column('bucket', sa.String(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False,
+                  server_default='0'),
+        sa.PrimaryKeyConstraint('metric', 'bucket')
+    )
+    op.create_table(
+        'catalogue_stats_deltas',
+        sa.Column('metric', sa.String(), nullable=False),
+        sa.Column('bucket', sa.String(), nullable=False),
+        sa.Column('delta', sa.Integer(), nullable=False)
+    )
+    if dialect == 'postgresql':
+        create_postgresql_triggers()
+    else:
+        create_sqlite_triggers()
+    for table, metrics in METRICS[dialect].items():
+        for metric, bucket in metrics:
+            op.execute(
+                'INSERT INTO catalogue_stats (metric, bucket, count) '
+                f"SELECT '{metric}', {bucket.format(row=table)}, count(*) "
+                f'FROM {table} GROUP BY {bucket.format(row=table)}')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for table in CATALOGUE:
+            op.execute(f'DROP TRIGGER IF EXISTS {table}_catalogue_stats_apply '
+                       f'ON {table}')
+        op.execute('DROP FUNCTION IF EXISTS apply_catalogue_stats()')
+        for table in COLUMNS:
+            op.execute(f'DROP TRIGGER IF EXISTS {table}_catalogue_stats '
+                       f'ON {table}')
+            op.execute(f'DROP FUNCTION IF EXISTS {table}_catalogue_stats()')
+    else:
+        for table in COLUMNS:
+            for name in ('insert', 'update', 'delete'):
+                op.execute(
+                    f'DROP TRIGGER IF EXISTS {table}_catalogue_stats_{name}')
+    op.drop_table('catalogue_stats_deltas')
+    op.drop_table('catalogue_stats')
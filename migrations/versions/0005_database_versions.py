@@ -0,0 +1,161 @@
+"""catalogue and row versions behind the ETags, kept by triggers
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import os
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+# a copy of the triggers of versions.py at this revision
+VERSIONED = ('actors', 'movies')
+CATALOGUE = VERSIONED + ('movie_actors',)
+
+POSTGRESQL_FUNCTIONS = [
+    '''CREATE OR REPLACE FUNCTION row_version()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM row_versions
+        WHERE table_name = TG_TABLE_NAME AND row_id = OLD.id;
+    ELSE
+        INSERT INTO row_versions (table_name, row_id, version)
+        VALUES (TG_TABLE_NAME, NEW.id, nextval('row_version_seq'))
+        ON CONFLICT (table_name, row_id)
+        DO UPDATE SET version = excluded.version;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql''',
+    '''CREATE OR REPLACE FUNCTION bump_catalogue_version()
+RETURNS trigger AS $$
+BEGIN
+    IF current_setting('casting.catalogue_bumped', true)
+            IS DISTINCT FROM 'on' THEN
+        UPDATE catalogue_version SET version = version + 1;
+        PERFORM set_config('casting.catalogue_bumped', 'on', true);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql''',
+    '''CREATE OR REPLACE FUNCTION truncate_versions()
+RETURNS trigger AS $$
+BEGIN
+    DELETE FROM row_versions WHERE table_name = TG_TABLE_NAME;
+    UPDATE catalogue_version SET version = version + 1;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+]
+
+
+def postgresql_triggers(table):
+    triggers = [
+        ('catalogue_version', 'CONSTRAINT TRIGGER',
+         'INSERT OR UPDATE OR DELETE',
+         'DEFERRABLE INITIALLY DEFERRED FOR EACH ROW',
+         'bump_catalogue_version'),
+        ('truncate_versions', 'TRIGGER', 'TRUNCATE', 'FOR EACH STATEMENT',
+         'truncate_versions')
+    ]
+    if table in VERSIONED:
+        triggers.append(('row_version', 'TRIGGER',
+                         'INSERT OR UPDATE OR DELETE', 'FOR EACH ROW',
+                         'row_version'))
+    return triggers
+
+
+def create_postgresql_triggers():
+    op.execute('CREATE SEQUENCE row_version_seq')
+    for function in POSTGRESQL_FUNCTIONS:
+        op.execute(function)
+    for table in CATALOGUE:
+        for name, kind, events, when, function in postgresql_triggers(table):
+            op.execute(f'CREATE {kind} {table}_{name}\n'
+                       f'AFTER {events} ON {table}\n'
+                       f'{when} EXECUTE PROCEDURE {function}()')
+
+
+def create_sqlite_triggers():
+    bump = 'UPDATE catalogue_version SET version = version + 1'
+    for table in CATALOGUE:
+        for name, row in (('insert', 'NEW'), ('update', 'NEW'),
+                          ('delete', 'OLD')):
+            body = [bump]
+            if table in VERSIONED and row == 'NEW':
+                body.append(
+                    'INSERT INTO row_versions (table_name, row_id, version) '
+                    f"SELECT '{table}', NEW.id, version "
+                    'FROM catalogue_version WHERE true '
+                    'ON CONFLICT (table_name, row_id) '
+                    'DO UPDATE SET version = excluded.version')
+            elif table in VERSIONED:
+                body.append('DELETE FROM row_versions '
+                            f"WHERE table_name = '{table}' "
+                            'AND row_id = OLD.id')
+            body = ''.join(f'    {statement};\n' for statement in body)
+            op.execute(f'CREATE TRIGGER {table}_versions_{name}\n'
+                       f'AFTER {name.upper()} ON {table}\nBEGIN\n{body}END')
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    # db.create_all may already have built the tables and their triggers
+    if sa.inspect(op.get_bind()).has_table('catalogue_version'):
+        return
+    op.create_table(
+        'catalogue_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('nonce', sa.String(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False,
+                  server_default='0'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'row_versions',
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('row_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name', 'row_id')
+    )
+    op.execute(sa.text(
+        'INSERT INTO catalogue_version (id, nonce, version) '
+        'VALUES (1, :nonce, 1)').bindparams(nonce=os.urandom(16).hex()))
+    if dialect == 'postgresql':
+        create_postgresql_triggers()
+        version = "nextval('row_version_seq')"
+    else:
+        create_sqlite_triggers()
+        version = '1'
+    for table in VERSIONED:
+        op.execute('INSERT INTO row_versions (table_name, row_id, version) '
+                   f"SELECT '{table}', id, {version} FROM {table}")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for table in CATALOGUE:
+            for name, *_ in postgresql_triggers(table):
+                op.execute(f'DROP TRIGGER IF EXISTS {table}_{name} '
+                           f'ON {table}')
+        for function in ('row_version', 'bump_catalogue_version',
+                         'truncate_versions'):
+            op.execute(f'DROP FUNCTION IF EXISTS {function}()')
+        op.execute('DROP SEQUENCE IF EXISTS row_version_seq')
+    else:
+        for table in CATALOGUE:
+            for name in ('insert', 'update', 'delete'):
+                op.execute(
+                    f'DROP TRIGGER IF EXISTS {table}_versions_{name}')
+    op.drop_table('row_versions')
+    op.drop_table('catalogue_version')
@@ -1,34 +1,154 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import sqlite3
+from datetime import date, datetime
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Date,
+    String,
+    Integer,
+    ForeignKey,
+    Index,
+    Table,
+    event,
+    func,
+    create_engine,
+    text
+)
+from sqlalchemy.engine import Engine
 import json
+from cache import DETAIL_CACHE
+from pool import engine_options, configure_engine
+from replicas import RoutingSQLAlchemy
 
 
-database_path = os.environ['DATABASE_URL']
+# reads of GET requests may be routed to a replica (see replicas.py)
+db = RoutingSQLAlchemy()
 
-db = SQLAlchemy()
+# release dates are written and returned as MM-DD-YYYY,
+# ISO dates (YYYY-MM-DD) are accepted as input too
+DATE_FORMAT = '%m-%d-%Y'
 
 
 # sets up the database
-def setup_db(app, database_path=database_path):
+# the URL defaults to DATABASE_URL from the app config or the environment;
+# the schema itself is created by the migrations (manage.py db upgrade)
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = app.config.get('DATABASE_URL') or \
+            os.environ['DATABASE_URL']
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    configure_engine(db.engine)
 
 
 def get_db():
     return db
 
 
+# parses a release date given as MM-DD-YYYY or YYYY-MM-DD
+# raises ValueError on anything else
+def parse_date(value):
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        raise ValueError('date must be a string')
+    try:
+        return datetime.strptime(value, DATE_FORMAT).date()
+    except ValueError:
+        return date.fromisoformat(value)
+
+
+# called after a commit that wrote rows of a table
+# drops them from the detail cache
+# (their versions are bumped by the triggers of versions.py)
+def rows_changed(table, *row_ids):
+    DETAIL_CACHE.invalidate(table, *row_ids)
+
+
+# casting rows rely on ON DELETE CASCADE, which SQLite only enforces
+# with foreign keys switched on
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
+# casting association between movies and actors
+movie_actors = Table(
+    'movie_actors',
+    db.Model.metadata,
+    Column('movie_id', Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True,
+           index=True)
+)
+
+
+# counts of actors and movies per (metric, bucket), kept up to date by
+# the triggers of stats.py
+catalogue_stats = Table(
+    'catalogue_stats',
+    db.Model.metadata,
+    Column('metric', String, primary_key=True),
+    Column('bucket', String, primary_key=True),
+    Column('count', Integer, nullable=False, server_default='0')
+)
+
+
+# changes to catalogue_stats staged by the writes of a transaction until
+# it commits (Postgres only, see stats.py)
+catalogue_stats_deltas = Table(
+    'catalogue_stats_deltas',
+    db.Model.metadata,
+    Column('metric', String, nullable=False),
+    Column('bucket', String, nullable=False),
+    Column('delta', Integer, nullable=False)
+)
+
+
+# version of the whole catalogue and the random nonce of the database,
+# a single row kept up to date by the triggers of versions.py
+catalogue_version = Table(
+    'catalogue_version',
+    db.Model.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('nonce', String, nullable=False),
+    Column('version', BigInteger, nullable=False, server_default='0')
+)
+
+
+# version of every actor and movie, kept up to date by the triggers of
+# versions.py
+row_versions = Table(
+    'row_versions',
+    db.Model.metadata,
+    Column('table_name', String, primary_key=True),
+    Column('row_id', Integer, primary_key=True),
+    Column('version', BigInteger, nullable=False)
+)
+
+
 # movie model
 class Movie(db.Model):
     __tablename__ = 'movies'
+    __table_args__ = (
+        Index('ix_movies_title_id', 'title', 'id'),
+        Index('ix_movies_title_pattern', 'title',
+              postgresql_ops={'title': 'text_pattern_ops'}),
+        Index('ix_movies_release_date_id', 'release_date', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
-    release_date = Column(String)
+    release_date = Column(Date)
+    actors = db.relationship('Actor', secondary=movie_actors,
+                             back_populates='movies', order_by='Actor.id',
+                             passive_deletes=True)
 
     def __init__(self, title, release_date):
         self.title = title
@@ -36,31 +156,50 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        row_id = self.id
         db.session.commit()
+        rows_changed(self.__tablename__, row_id)
 
     def update(self):
+        row_id = self.id
         db.session.commit()
+        rows_changed(self.__tablename__, row_id)
 
     def delete(self):
+        row_id = self.id
         db.session.delete(self)
         db.session.commit()
+        rows_changed(self.__tablename__, row_id)
 
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date
+            'release_date': self.release_date.strftime(DATE_FORMAT)
+            if self.release_date is not None else None
         }
 
 
 # actor model
 class Actor(db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        Index('ix_actors_name_id', 'name', 'id'),
+        Index('ix_actors_age_id', 'age', 'id'),
+        Index('ix_actors_gender_id', 'gender', 'id'),
+        Index('ix_actors_gender_age_id', 'gender', 'age', 'id'),
+        Index('ix_actors_name_pattern', 'name',
+              postgresql_ops={'name': 'text_pattern_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     age = Column(Integer)
     gender = Column(String)
+    movies = db.relationship('Movie', secondary=movie_actors,
+                             back_populates='actors', order_by='Movie.id',
+                             passive_deletes=True)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -69,14 +208,21 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        row_id = self.id
         db.session.commit()
+        rows_changed(self.__tablename__, row_id)
 
     def update(self):
+        row_id = self.id
         db.session.commit()
+        rows_changed(self.__tablename__, row_id)
 
     def delete(self):
+        row_id = self.id
         db.session.delete(self)
         db.session.commit()
+        rows_changed(self.__tablename__, row_id)
 
     def format(self):
         return {
@@ -85,3 +231,167 @@ class Actor(db.Model):
             'age': self.age,
             'gender': self.gender
         }
+
+
+# Builds a detached model instance from a mapping of column values
+def from_row(model, values):
+    values = dict(values)
+    row_id = values.pop('id')
+    obj = model(**values)
+    obj.id = row_id
+    return obj
+
+
+# Reserves count ids from the sequence of the table's id column (Postgres)
+def reserve_ids(table, count):
+    return db.session.execute(text(
+        "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+        'FROM generate_series(1, :count)'),
+        {'table': table.name, 'count': count}).scalars().all()
+
+
+# inserts many rows of a model in one transaction
+# on Postgres rows are written in multi-row INSERT statements of
+# batch_size rows, with ids reserved beforehand so the returned rows are
+# matched to the input by id rather than by the order of RETURNING;
+# a batch that fails is retried row by row so one bad row does not
+# fail the others
+# returns a list of (index, instance, error) in input order
+def insert_many(model, rows, batch_size=500):
+    table = model.__table__
+    returning = db.engine.dialect.implicit_returning
+    batched = db.engine.dialect.name == 'postgresql'
+    results = []
+
+    def insert_one(index, values):
+        try:
+            with db.session.begin_nested():
+                if returning:
+                    row = db.session.execute(
+                        table.insert().values(values).returning(*table.c)
+                    ).one()
+                    obj = from_row(model, row._mapping)
+                else:
+                    result = db.session.execute(table.insert(), values)
+                    obj = from_row(model, dict(
+                        values, id=result.inserted_primary_key[0]))
+            results.append((index, obj, None))
+        except Exception as e:
+            results.append((index, None, str(e.__class__.__name__)))
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if not batched:
+            for index, values in batch:
+                insert_one(index, values)
+            continue
+        ids = reserve_ids(table, len(batch))
+        try:
+            with db.session.begin_nested():
+                inserted = db.session.execute(
+                    table.insert()
+                    .values([dict(values, id=row_id)
+                             for (index, values), row_id in zip(batch, ids)])
+                    .returning(*table.c)
+                ).all()
+        except Exception:
+            for index, values in batch:
+                insert_one(index, values)
+            continue
+        by_id = {row.id: row for row in inserted}
+        for (index, values), row_id in zip(batch, ids):
+            results.append(
+                (index, from_row(model, by_id[row_id]._mapping), None))
+
+    db.session.commit()
+    ids = [obj.id for index, obj, error in results if obj is not None]
+    if ids:
+        rows_changed(model.__tablename__, *ids)
+    return results
+
+
+# updates every row of a model matching the criteria in one statement
+# returns the updated instances (or just their ids with ids_only)
+def update_many(model, criteria, values, ids_only=False):
+    table = model.__table__
+    statement = table.update().where(*criteria).values(values)
+    if db.engine.dialect.implicit_returning:
+        rows = db.session.execute(
+            statement.returning(*([table.c.id] if ids_only else table.c))
+        ).all()
+    else:
+        ids = db.session.execute(
+            db.select(table.c.id).where(*criteria)).scalars().all()
+        db.session.execute(table.update().where(table.c.id.in_(ids))
+                           .values(values))
+        rows = db.session.execute(
+            db.select(*([table.c.id] if ids_only else table.c))
+            .where(table.c.id.in_(ids))).all()
+    db.session.commit()
+    return _changed(model, rows, ids_only)
+
+
+# deletes every row of a model matching the criteria in one statement
+# returns the deleted instances (or just their ids with ids_only)
+def delete_many(model, criteria, ids_only=False):
+    table = model.__table__
+    statement = table.delete().where(*criteria)
+    if db.engine.dialect.implicit_returning:
+        rows = db.session.execute(
+            statement.returning(*([table.c.id] if ids_only else table.c))
+        ).all()
+    else:
+        rows = db.session.execute(
+            db.select(*([table.c.id] if ids_only else table.c))
+            .where(*criteria)).all()
+        db.session.execute(table.delete().where(
+            table.c.id.in_([row.id for row in rows])))
+    db.session.commit()
+    return _changed(model, rows, ids_only)
+
+
+def _changed(model, rows, ids_only):
+    ids = [row.id for row in rows]
+    if ids:
+        rows_changed(model.__tablename__, *ids)
+    if ids_only:
+        return ids
+    return [from_row(model, row._mapping) for row in rows]
+
+
+# casts actors in a movie, ignoring actors already in its cast
+def add_cast(movie_id, actor_ids):
+    existing = set(db.session.execute(
+        db.select(movie_actors.c.actor_id)
+        .where(movie_actors.c.movie_id == movie_id)
+        .where(movie_actors.c.actor_id.in_(actor_ids))).scalars())
+    new_ids = [actor_id for actor_id in dict.fromkeys(actor_ids)
+               if actor_id not in existing]
+    if new_ids:
+        db.session.execute(movie_actors.insert(), [
+            {'movie_id': movie_id, 'actor_id': actor_id}
+            for actor_id in new_ids])
+    db.session.commit()
+    return new_ids
+
+
+# removes actors from the cast of a movie
+def remove_cast(movie_id, actor_ids):
+    removed = db.session.execute(
+        movie_actors.delete()
+        .where(movie_actors.c.movie_id == movie_id)
+        .where(movie_actors.c.actor_id.in_(actor_ids))).rowcount
+    db.session.commit()
+    return removed
+
+
+# counts the casting rows of each id in one aggregate query
+# column is movie_actors.c.movie_id (cast sizes) or .actor_id (filmographies)
+def count_casting(column, ids):
+    if not ids:
+        return {}
+    counts = dict(db.session.execute(
+        db.select(column, func.count())
+        .where(column.in_(ids))
+        .group_by(column)).all())
+    return {row_id: counts.get(row_id, 0) for row_id in ids}
@@ -0,0 +1,143 @@
+import base64
+import json
+import os
+from datetime import date
+from flask import request, abort
+from sqlalchemy import Date, tuple_
+from sqlalchemy.sql import Select
+from models import db
+
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 200))
+
+
+'''
+Keyset pagination
+List endpoints page on the primary key instead of OFFSET, so every page
+is a single index range scan no matter how deep the client pages.
+
+    limit: page size, clamped to MAX_PAGE_SIZE
+    cursor: opaque token returned as next_cursor by the previous page
+
+Pages sorted on another column key on (column, id) instead, which stays
+index-backed as long as the column is one of the indexed sort keys.
+'''
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, date) else value
+              for value in values]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    if not isinstance(values, list) or not values:
+        raise ValueError('malformed cursor')
+    return values
+
+
+# Reads limit and cursor from the query string
+# (args defaults to the Flask request's)
+# Aborts with 422 if either one is malformed
+def get_page_args(args=None):
+    if args is None:
+        args = request.args
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(422)
+    if limit < 1:
+        abort(422)
+    cursor = args.get('cursor')
+    after = None
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except Exception:
+            abort(422)
+    return min(limit, MAX_PAGE_SIZE), after
+
+
+# Returns one page of the query ordered by the sort column (id by default)
+# and the cursor of the next page (None on the last page)
+# Rows are ordered by (sort, id) so the cursor holds both values.
+# NULLs come last in ascending and first in descending order; the NULL
+# and non-NULL rows are read as two separate ranges so that each one is
+# a plain index range scan on (sort, id)
+def paginate(query, model, limit, after=None, sort=None, descending=False):
+    steps = page_steps(query, model, limit, after, sort, descending)
+    rows = None
+    while True:
+        try:
+            query = steps.send(rows)
+        except StopIteration as done:
+            return done.value
+        rows = _fetch(query)
+
+
+# The statements of paginate() as a generator: it yields each query to
+# run, is sent back its rows and returns the page, so the async app
+# (asyncdb.py) drives the same logic with an async session
+def page_steps(query, model, limit, after=None, sort=None, descending=False):
+    if sort is None or sort is model.id:
+        if after:
+            if len(after) != 1:
+                raise ValueError('cursor does not match the sort')
+            query = query.filter(
+                model.id < after[0] if descending else model.id > after[0])
+        order = [model.id.desc() if descending else model.id]
+        rows = yield query.order_by(*order).limit(limit + 1)
+        return _page(rows, limit, lambda row: [row.id])
+
+    if after and len(after) != 2:
+        raise ValueError('cursor does not match the sort')
+    if after and after[0] is not None and isinstance(sort.type, Date):
+        after = [date.fromisoformat(after[0]), after[1]]
+    ranges = [True, False] if descending else [False, True]
+    start = ranges.index(after[0] is None) if after else 0
+    rows = []
+    for position in range(start, len(ranges)):
+        nulls = ranges[position]
+        if nulls:
+            range_query = query.filter(sort.is_(None))
+            order = [model.id.desc() if descending else model.id]
+        else:
+            range_query = query.filter(sort.isnot(None))
+            order = [sort.desc(), model.id.desc()] if descending \
+                else [sort, model.id]
+        if after and position == start:
+            range_query = range_query.filter(
+                _after(model, sort, descending, nulls, *after))
+        rows += yield (range_query.order_by(*order)
+                             .limit(limit + 1 - len(rows)))
+        if len(rows) > limit:
+            break
+    return _page(rows, limit,
+                 lambda row: [getattr(row, sort.key), row.id])
+
+
+# query is an ORM Query or a core Select (see fastjson.py)
+def _fetch(query):
+    if isinstance(query, Select):
+        return db.session.execute(query).all()
+    return query.all()
+
+
+def _after(model, sort, descending, nulls, value, last_id):
+    if nulls:
+        return model.id < last_id if descending else model.id > last_id
+    if descending:
+        return tuple_(sort, model.id) < tuple_(value, last_id)
+    return tuple_(sort, model.id) > tuple_(value, last_id)
+
+
+def _page(rows, limit, cursor_values):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(cursor_values(rows[-1]))
+    return rows, next_cursor
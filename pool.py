@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+'''
+Connection pool
+Every gunicorn worker holds its own pool, so the pool is sized from the
+process layout instead of SQLAlchemy's defaults:
+
+    WEB_CONCURRENCY workers x WEB_THREADS threads share DB_MAX_CONNECTIONS
+    connections (minus DB_RESERVED_CONNECTIONS kept free for migrations and
+    one-off dynos)
+
+A worker keeps one connection per thread and may open overflow
+connections up to its share of the budget. Connections are pinged before
+use and recycled after DB_POOL_RECYCLE seconds, so a dyno waking from idle
+does not hand out connections the server already closed. Postgres
+statements are cut off after DB_STATEMENT_TIMEOUT milliseconds.
+
+POOL_STATS records how long checkouts wait for a connection, how many are
+in use and how often the pool overflows or times out.
+'''
+
+
+def _int_env(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _flag_env(name, default):
+    return os.environ.get(name, default).lower() not in ('0', 'false', 'no')
+
+
+class PoolStats:
+    def __init__(self, log_interval=60):
+        self.log_interval = log_interval
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.in_use = 0
+        self.in_use_max = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self.pool = None
+        self._logged_at = time.time()
+        self._lock = threading.Lock()
+
+    # Clears the counters a worker inherited from the preloading master
+    def reset(self):
+        pool = self.pool
+        self.__init__(self.log_interval)
+        self.pool = pool
+
+    def checked_out(self, wait, in_use):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+            self.in_use = in_use
+            if in_use > self.in_use_max:
+                self.in_use_max = in_use
+        self._maybe_log()
+
+    def checked_in(self, in_use):
+        self.in_use = in_use
+
+    def overflowed(self):
+        with self._lock:
+            self.overflows += 1
+
+    def timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def _maybe_log(self):
+        now = time.time()
+        if self.log_interval <= 0 or \
+                now - self._logged_at < self.log_interval:
+            return
+        self._logged_at = now
+        print('pool ' + ' '.join(f'{key}={value}'
+                                 for key, value in self.stats().items()))
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'size': self.pool.size() if self.pool is not None else 0,
+            'max_overflow': self.pool._max_overflow
+            if self.pool is not None else 0,
+            'checkouts': self.checkouts,
+            'wait_avg': self.wait_total / self.checkouts
+            if self.checkouts else 0.0,
+            'wait_max': self.wait_max,
+            'in_use': self.in_use,
+            'in_use_max': self.in_use_max,
+            'overflows': self.overflows,
+            'timeouts': self.timeouts
+        }
+
+
+POOL_STATS = PoolStats(_int_env('DB_POOL_LOG_INTERVAL', 60))
+
+
+# A QueuePool that reports checkout waits, overflows and timeouts
+# to POOL_STATS; recreate() keeps the class, so it survives dispose()
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkout = threading.local()
+        POOL_STATS.pool = self
+
+    # QueuePool._do_get calls itself again when it loses an overflow race,
+    # only the outermost call of a checkout is recorded
+    def _do_get(self):
+        if getattr(self._checkout, 'active', False):
+            return super()._do_get()
+        self._checkout.active = True
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            POOL_STATS.timed_out()
+            raise
+        finally:
+            self._checkout.active = False
+        POOL_STATS.checked_out(time.perf_counter() - started,
+                               self.checkedout())
+        return connection
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        POOL_STATS.checked_in(self.checkedout())
+
+    def _inc_overflow(self):
+        if not super()._inc_overflow():
+            return False
+        if self._overflow > 0:
+            POOL_STATS.overflowed()
+        return True
+
+
+# Returns the connection budget of one worker process
+def worker_connections():
+    workers = max(1, _int_env('WEB_CONCURRENCY', 1))
+    budget = _int_env('DB_MAX_CONNECTIONS', 20) - \
+        _int_env('DB_RESERVED_CONNECTIONS', 2)
+    return max(1, budget // workers)
+
+
+# Builds SQLALCHEMY_ENGINE_OPTIONS for the database URL
+# SQLite keeps the pooling Flask-SQLAlchemy picks for it
+def engine_options(database_path):
+    if make_url(database_path).get_backend_name() == 'sqlite':
+        return {}
+    threads = max(1, _int_env('WEB_THREADS', 1))
+    budget = worker_connections()
+    pool_size = min(_int_env('DB_POOL_SIZE', threads), budget)
+    max_overflow = _int_env('DB_MAX_OVERFLOW', budget - pool_size)
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': _int_env('DB_POOL_RECYCLE', 300),
+        'pool_pre_ping': _flag_env('DB_POOL_PRE_PING', '1')
+    }
+
+
+# Sets the statement timeout on every new Postgres connection
+# (a SET rather than a startup option, which PgBouncer rejects)
+def configure_engine(engine):
+    timeout = _int_env('DB_STATEMENT_TIMEOUT', 30000)
+    if engine.dialect.name != 'postgresql' or timeout <= 0:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_statement_timeout(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'SET statement_timeout = {timeout}')
+        cursor.close()
+        # a SET is undone if its transaction is rolled back on checkin
+        dbapi_connection.commit()
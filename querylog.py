@@ -0,0 +1,126 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from flask import (
+    current_app, g, has_app_context, has_request_context, request
+)
+from sqlalchemy import event
+
+
+'''
+Query log
+Engine events count the SQL statements each request runs and the time
+spent in them (query_stats(), also used by timing.py). A statement taking
+at least SLOW_QUERY_MS milliseconds (default 500, 0 disables) is printed as
+a JSON line with its bound parameters redacted to their types, so no
+request data ends up in the logs. The threshold is kept per app in
+app.extensions['slow_query_ms']; statements run outside an app context
+use the default.
+
+max_queries() is the test-side counterpart: it fails with an
+AssertionError when the code under it runs more statements than its
+budget, which catches N+1 regressions in CI.
+'''
+
+
+SLOW_QUERY_MS = 500
+
+# statement lists of the active max_queries() blocks
+_budgets = []
+
+
+class QueryStats:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Returns the query stats of the current request, or None outside one
+def query_stats():
+    if not g:
+        return None
+    stats = g.get('query_stats')
+    if stats is None:
+        stats = g.query_stats = QueryStats()
+    return stats
+
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {key: type(item).__name__ for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [type(item).__name__ for item in value]
+    return type(value).__name__
+
+
+def redact_parameters(parameters, executemany):
+    if executemany:
+        return {'rows': len(parameters),
+                'first': _redact(parameters[0]) if parameters else None}
+    return _redact(parameters)
+
+
+def _log_slow(statement, parameters, executemany, seconds):
+    entry = {
+        'event': 'slow_query',
+        'ms': round(seconds * 1000, 2),
+        'statement': ' '.join(statement.split()),
+        'parameters': redact_parameters(parameters, executemany)
+    }
+    if has_request_context():
+        entry['method'] = request.method
+        entry['path'] = request.path
+    print(json.dumps(entry))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    stats = query_stats()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += seconds
+    for budget in _budgets:
+        budget.append(statement)
+    if has_app_context():
+        threshold = current_app.extensions.get('slow_query_ms',
+                                               SLOW_QUERY_MS)
+    else:
+        threshold = SLOW_QUERY_MS
+    if threshold and seconds * 1000 >= threshold:
+        _log_slow(statement, parameters, executemany, seconds)
+
+
+# sets up the query counters and the slow query log on the engine
+# SLOW_QUERY_MS is read from the app config or the environment
+def setup_query_log(app, engine):
+    app.extensions['slow_query_ms'] = float(app.config.get(
+        'SLOW_QUERY_MS', os.environ.get('SLOW_QUERY_MS', SLOW_QUERY_MS)))
+    if not event.contains(engine, 'after_cursor_execute',
+                          _after_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+# Fails when the block runs more than limit SQL statements
+# Yields the list of statements run so far
+@contextmanager
+def max_queries(limit):
+    budget = []
+    _budgets.append(budget)
+    try:
+        yield budget
+    finally:
+        _budgets.remove(budget)
+    if len(budget) > limit:
+        raise AssertionError(
+            f'{len(budget)} queries over a budget of {limit}:\n' +
+            '\n'.join(' '.join(statement.split()) for statement in budget))
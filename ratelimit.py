@@ -0,0 +1,280 @@
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+
+
+'''
+Admission control and rate limiting
+Two checks protect the capacity of a worker from a client that loops on
+an endpoint:
+
+    load shedding: a request arriving while MAX_IN_FLIGHT requests are
+    already being served by the process, or that waited longer than
+    MAX_QUEUE_MS in the router queue (X-Request-Start header, set by the
+    Heroku router), is answered 503 before any auth or database work
+    rate limiting: every JWT sub has a token bucket per permission,
+    refilled at RATE_LIMIT requests per second up to RATE_BURST (default
+    twice the rate, at least 1); RATE_LIMITS overrides both per
+    permission, e.g. "get:movies=5/10,post:actor=1/5". A request finding
+    its bucket empty is answered 429 right after its token is verified
+
+Both carry a Retry-After header. All limits default to 0 (off) and are
+read from the app config or the environment. Both the WSGI app and the
+ASGI app of asgi.py enforce them.
+
+Buckets live in the worker, in a bounded LRU of RATE_LIMIT_SIZE keys
+(default 10000), unless RATE_LIMIT_URL points to Redis: buckets are then
+shared by every worker and dyno at the cost of one script call per
+request. While Redis is unreachable the worker falls back to its own
+buckets. Rejections are counted in stats() and exported by metrics.py.
+'''
+
+
+class AdmissionError(Exception):
+    def __init__(self, error, status_code, retry_after):
+        self.error = error
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+# Returns the bucket size for the rate: the burst, or by default twice
+# the rate but at least one token, since a bucket that never holds a
+# whole token rejects every request
+# Raises ValueError for a burst below one request
+def bucket_size(rate, burst=None):
+    if not burst:
+        return max(1.0, 2 * rate)
+    if burst < 1:
+        raise ValueError(f'rate limit burst {burst} is below 1')
+    return burst
+
+
+# Parses RATE_LIMITS into {permission: (rate, burst)}
+def parse_limits(value):
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        permission, _, limit = item.rpartition('=')
+        rate, _, burst = limit.partition('/')
+        rate = float(rate)
+        limits[permission.strip()] = (
+            rate, bucket_size(rate, float(burst) if burst else None))
+    return limits
+
+
+# In-process token buckets, a bounded LRU of (tokens, updated at)
+class LocalBuckets:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Takes a token from the bucket
+    # Returns 0 or the seconds until the bucket holds one
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._entries.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._entries[key] = (tokens, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# the same bucket as LocalBuckets.take, atomically on the Redis clock
+TAKE_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+# Token buckets shared through Redis
+class SharedBuckets:
+    def __init__(self, client):
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[f'casting:rate:{key}'],
+                                args=[rate, burst]))
+
+
+class RateLimiter:
+    def __init__(self, rate=0.0, burst=None, limits=None, maxsize=10000,
+                 shared=None):
+        self.rate = rate
+        self.burst = bucket_size(rate, burst)
+        self.limits = limits or {}
+        self.local = LocalBuckets(maxsize)
+        self.shared = shared
+        self.rejections = {}
+        self.shared_errors = 0
+        self._lock = threading.Lock()
+
+    def limit(self, permission):
+        return self.limits.get(permission, (self.rate, self.burst))
+
+    def _take(self, key, rate, burst):
+        if self.shared is not None:
+            try:
+                return self.shared.take(key, rate, burst)
+            except Exception:
+                print(sys.exc_info())
+                self.shared_errors += 1
+        return self.local.take(key, rate, burst)
+
+    # Takes a token from the bucket of the subject for the permission
+    # Raises an AdmissionError (429) when it is empty
+    def check(self, subject, permission):
+        rate, burst = self.limit(permission)
+        if rate <= 0:
+            return
+        wait = self._take(f'{subject}:{permission}', rate, burst)
+        if wait > 0:
+            with self._lock:
+                self.rejections[permission] = \
+                    self.rejections.get(permission, 0) + 1
+            raise AdmissionError('rate limit exceeded', 429,
+                                 math.ceil(wait))
+
+    def stats(self):
+        return {
+            'size': len(self.local),
+            'rejections': dict(self.rejections),
+            'shared_errors': self.shared_errors
+        }
+
+
+# Seconds the request spent in the router queue, None without the header
+# X-Request-Start holds the time since the epoch in milliseconds (Heroku)
+# or as t=<seconds>, t=<microseconds> (nginx, Apache)
+def queue_seconds(header, now=None):
+    if not header:
+        return None
+    try:
+        started = float(header.split('=', 1)[-1])
+    except ValueError:
+        return None
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    now = time.time() if now is None else now
+    return max(0.0, now - started)
+
+
+# Caps the requests served at once by the process
+class Admission:
+    def __init__(self, max_in_flight=0, max_queue_ms=0):
+        self.max_in_flight = max_in_flight
+        self.max_queue_ms = max_queue_ms
+        self.in_flight = 0
+        self.shed = {'in_flight': 0, 'queue': 0}
+        self._lock = threading.Lock()
+
+    # Admits a request or raises an AdmissionError (503)
+    def enter(self, request_start=None):
+        reason = None
+        if self.max_queue_ms > 0:
+            waited = queue_seconds(request_start)
+            if waited is not None and waited * 1000 > self.max_queue_ms:
+                reason = 'queue'
+        with self._lock:
+            if reason is None and \
+                    0 < self.max_in_flight <= self.in_flight:
+                reason = 'in_flight'
+            if reason is None:
+                self.in_flight += 1
+                return
+            self.shed[reason] += 1
+        raise AdmissionError('server overloaded', 503, 1)
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'shed': dict(self.shed)
+        }
+
+
+def create_shared_buckets(url):
+    if not url:
+        return None
+    try:
+        import redis
+    except ImportError:
+        print('RATE_LIMIT_URL is set but the redis package is missing')
+        return None
+    return SharedBuckets(redis.Redis.from_url(url, socket_timeout=0.05))
+
+
+# Builds the rate limiter from setting(key, default)
+def create_rate_limiter(setting):
+    return RateLimiter(
+        rate=float(setting('RATE_LIMIT', 0)),
+        burst=float(setting('RATE_BURST', 0)),
+        limits=parse_limits(setting('RATE_LIMITS', '')),
+        maxsize=int(setting('RATE_LIMIT_SIZE', 10000)),
+        shared=create_shared_buckets(setting('RATE_LIMIT_URL', '')))
+
+
+# Builds the load shedder from setting(key, default)
+def create_admission(setting):
+    return Admission(
+        max_in_flight=int(setting('MAX_IN_FLIGHT', 0)),
+        max_queue_ms=float(setting('MAX_QUEUE_MS', 0)))
+
+
+# sets up load shedding and rate limiting for the app
+# the limits are read from the app config or the environment
+def setup_admission(app):
+    def setting(key, default):
+        return app.config.get(key, os.environ.get(key, default))
+
+    app.extensions['rate_limiter'] = create_rate_limiter(setting)
+    admission = app.extensions['admission'] = create_admission(setting)
+    if not admission.max_in_flight and not admission.max_queue_ms:
+        return
+
+    @app.before_request
+    def admit():
+        # scrapes and CORS preflights are never shed
+        if request.endpoint == 'metrics' or request.method == 'OPTIONS':
+            return
+        admission.enter(request.headers.get('X-Request-Start'))
+        g.admitted = True
+
+    @app.teardown_request
+    def release(exc):
+        if g.pop('admitted', False):
+            admission.leave()
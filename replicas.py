@@ -0,0 +1,289 @@
+import hashlib
+import itertools
+import math
+import os
+import sys
+import threading
+import time
+import weakref
+from flask import has_request_context, g, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from cache import LocalStore, create_shared_store
+from pool import engine_options, configure_engine
+from querylog import setup_query_log
+
+
+'''
+Read replicas
+With DATABASE_REPLICA_URLS set (comma separated), GET and HEAD requests
+read from a replica while writes keep going to DATABASE_URL. The routing
+session picks the engine on the first statement of a request and keeps it
+for the rest of the request, so a response is read from one snapshot.
+
+A request reads from the primary instead when:
+
+    the client (the sub of its token) wrote in the last
+    REPLICA_STICKY_SECONDS (default 5), so it reads its own writes
+    no replica is healthy
+
+Replicas are checked at most every REPLICA_CHECK_SECONDS (default 5) on
+the request path. Connecting to a Postgres replica gives up after
+REPLICA_CONNECT_TIMEOUT seconds (default 2, the libpq minimum), so a
+replica that stops answering delays the requests that check it by that
+much rather than until the TCP timeout. A replica is unhealthy when it
+cannot be reached, when a statement on it fails with a lost connection,
+or when its replay lag is over the sticky window; it is checked again
+after the same interval. A request that cannot connect to its replica
+reads from the primary instead of failing. Replicas are picked round
+robin. A successful write request stamps the time of the write for its
+client in REPLICA_STICKY_URL (a redis:// URL shared by every dyno, or
+local://); without it the stamps are kept per worker, so a client whose
+next read lands on another worker may not see its write. Other clients
+keep reading from the replicas. ETags and the detail cache do not depend
+on it: their versions are read from the same replica as the rows (see
+versions.py).
+'''
+
+
+# replay lag of a Postgres standby, 0 when it has replayed everything it
+# received or when the server is not a standby
+LAG_SQL = '''
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM
+                          now() - pg_last_xact_replay_timestamp()), 0)
+END
+'''
+
+# replicas of every router, for the gunicorn fork hooks
+_replicas = weakref.WeakSet()
+
+# Time of the last write of each client (the sub of its token)
+class ClientWrites:
+    def __init__(self, store, window):
+        self.store = store
+        self.window = window
+
+    @staticmethod
+    def _key(subject):
+        digest = hashlib.sha1(subject.encode()).hexdigest()
+        return 'casting:write:' + digest
+
+    def stamp(self, subject):
+        if self.window <= 0:
+            return
+        key = self._key(subject)
+        try:
+            self.store.hset(key, 'at', repr(time.time()))
+            self.store.expire(key, math.ceil(self.window))
+        except Exception:
+            print(sys.exc_info())
+
+    # Returns whether the client wrote inside the window; a store that
+    # cannot be read counts as a recent write so the read stays correct
+    def recent(self, subject):
+        try:
+            written_at = self.store.hget(self._key(subject), 'at')
+        except Exception:
+            print(sys.exc_info())
+            return True
+        return written_at is not None and \
+            time.time() - float(written_at) < self.window
+
+
+class Replica:
+    def __init__(self, name, engine, check_interval=5.0, max_lag=5.0):
+        self.name = name
+        self.engine = engine
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.up = True
+        self.lag = 0.0
+        self.reads = 0
+        self.failures = 0
+        self._checked_at = None
+        self._lock = threading.Lock()
+        event.listen(engine, 'handle_error', self._handle_error)
+        _replicas.add(self)
+
+    # Returns whether the replica may serve reads, checking it first
+    # when the last check is older than the interval
+    def healthy(self):
+        checked_at = self._checked_at
+        if checked_at is None or \
+                time.monotonic() - checked_at >= self.check_interval:
+            self.check()
+        return self.up
+
+    def check(self):
+        # one thread checks while the others go on with the last result
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == 'postgresql':
+                    self.lag = float(connection.execute(
+                        text(LAG_SQL)).scalar())
+                else:
+                    connection.execute(text('SELECT 1'))
+                    self.lag = 0.0
+            self.up = self.lag <= self.max_lag
+        except Exception:
+            print(sys.exc_info())
+            self.failed()
+        finally:
+            self._checked_at = time.monotonic()
+            self._lock.release()
+
+    def failed(self):
+        self.up = False
+        self.failures += 1
+        self._checked_at = time.monotonic()
+
+    def _handle_error(self, context):
+        if context.is_disconnect:
+            self.failed()
+
+
+class ReplicaRouter:
+    def __init__(self, replicas, sticky=5.0, writes=None):
+        self.replicas = replicas
+        self.sticky = sticky
+        self.writes = writes or ClientWrites(LocalStore(), sticky)
+        self.fallbacks = {'recent_write': 0, 'unhealthy': 0}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def _fallback(self, reason):
+        with self._lock:
+            self.fallbacks[reason] += 1
+
+    # Returns the replica a read of the client should use, None for the
+    # primary
+    def choose(self, subject=None):
+        if subject is not None and self.writes.recent(subject):
+            self._fallback('recent_write')
+            return None
+        start = next(self._turn)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if replica.healthy():
+                replica.reads += 1
+                return replica
+        self._fallback('unhealthy')
+        return None
+
+    def stats(self):
+        return {
+            'fallbacks': dict(self.fallbacks),
+            'replicas': [{
+                'name': replica.name,
+                'up': replica.up,
+                'lag': replica.lag,
+                'reads': replica.reads,
+                'failures': replica.failures
+            } for replica in self.replicas]
+        }
+
+
+# Closes or drops the pools of every replica engine (see gunicorn.conf.py)
+def dispose_replicas(close=True):
+    for replica in list(_replicas):
+        replica.engine.dispose(close=close)
+
+
+# Returns the replica of the current request, picked on its first statement
+# Reads of GET and HEAD requests may go to a replica, anything else and
+# work outside a request uses the primary (None)
+def request_replica(app):
+    router = app.extensions.get('replicas')
+    if router is None or not has_request_context() or \
+            request.method not in ('GET', 'HEAD'):
+        return None
+    if 'db_replica' not in g:
+        g.db_replica = router.choose(g.get('subject'))
+    return g.db_replica
+
+
+# Session routing the statements of read-only requests to a replica
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replica = request_replica(self.app)
+        if replica is not None:
+            return replica.engine
+        return super().get_bind(mapper, clause)
+
+    # a replica that cannot be connected to is marked down and the rest
+    # of the request reads from the primary
+    def _connection_for_bind(self, engine, execution_options=None, **kw):
+        replica = request_replica(self.app)
+        if replica is None or engine is not replica.engine:
+            return super()._connection_for_bind(engine, execution_options,
+                                                **kw)
+        try:
+            return super()._connection_for_bind(engine, execution_options,
+                                                **kw)
+        except exc.DBAPIError:
+            print(sys.exc_info())
+            replica.failed()
+            g.db_replica = None
+            return super()._connection_for_bind(self.get_bind(),
+                                                execution_options, **kw)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def create_replica_engine(url, connect_timeout=2):
+    options = engine_options(url)
+    # POOL_STATS reports the primary pool only
+    if options:
+        options['poolclass'] = QueuePool
+    if make_url(url).get_backend_name() == 'postgresql':
+        options['connect_args'] = {'connect_timeout': connect_timeout}
+    engine = create_engine(url, **options)
+    configure_engine(engine)
+    return engine
+
+
+# sets up read routing to the replicas of DATABASE_REPLICA_URLS
+# the settings are read from the app config or the environment
+def setup_replicas(app):
+    def setting(key, default):
+        return app.config.get(key, os.environ.get(key, default))
+
+    app.extensions['replicas'] = None
+    urls = [url.strip() for url in
+            setting('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    if not urls:
+        return
+    sticky = float(setting('REPLICA_STICKY_SECONDS', 5))
+    check_interval = float(setting('REPLICA_CHECK_SECONDS', 5))
+    connect_timeout = int(setting('REPLICA_CONNECT_TIMEOUT', 2))
+    replicas = []
+    for i, url in enumerate(urls):
+        engine = create_replica_engine(url, connect_timeout)
+        setup_query_log(app, engine)
+        replicas.append(Replica(str(i), engine,
+                                check_interval=check_interval,
+                                max_lag=sticky))
+    store = create_shared_store(setting('REPLICA_STICKY_URL', ''),
+                                'REPLICA_STICKY_URL') or LocalStore()
+    writes = ClientWrites(store, sticky)
+    app.extensions['replicas'] = ReplicaRouter(replicas, sticky=sticky,
+                                               writes=writes)
+
+    # a write that went through keeps its client on the primary
+    @app.after_request
+    def stamp_write(response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and \
+                response.status_code < 400 and g.get('subject'):
+            writes.stamp(g.subject)
+        return response
@@ -0,0 +1,254 @@
+from sqlalchemy import event, select, text
+from models import db, catalogue_stats
+from versions import CATALOGUE
+
+
+'''
+Catalogue statistics
+GET /stats/actors and GET /stats/movies return counts by gender, by age
+decade and by release year without scanning the catalogue: they read the
+few rows of the catalogue_stats summary table, one per (metric, bucket).
+
+Triggers on actors and movies keep the summary up to date in the
+transaction of every write, whichever path made it (single, bulk, group
+commit, the ASGI app or plain SQL):
+
+    insert: +1 to the buckets of the new row
+    update of a bucketed column: -1 to the old buckets, +1 to the new ones
+    delete: -1 to the buckets of the old row
+
+On Postgres the row triggers only append these deltas to
+catalogue_stats_deltas, which no other transaction sees or locks. A
+deferred trigger sums them and upserts the summary rows once, at commit,
+in (metric, bucket) order, so writers hold the shared summary rows only
+while they commit and multi-row writes (bulk, group commit) touching the
+same buckets in any order cannot deadlock. The deferred trigger runs on
+every table of the catalogue and sorts before the catalogue version
+trigger of versions.py, so every transaction takes the summary rows
+before the catalogue version row. SQLite has a single writer and upserts
+the summary directly.
+
+Buckets of rows with a NULL value are named 'unknown'. TRUNCATE is not
+seen by the triggers; `python manage.py rebuild_stats` recomputes the
+whole table with GROUP BY queries. The triggers are created by migration
+0004 and, for databases built with db.create_all(), by create_all itself.
+'''
+
+
+# metric name and bucket expression of each summarized column,
+# {row} is NEW, OLD or the table itself
+METRICS = {
+    'postgresql': {
+        'actors': [
+            ('actor_gender', "COALESCE({row}.gender, 'unknown')"),
+            ('actor_age', "COALESCE(({row}.age / 10 * 10)::text, 'unknown')")
+        ],
+        'movies': [
+            ('movie_year', "COALESCE(EXTRACT(YEAR FROM {row}.release_date)"
+                           "::int::text, 'unknown')")
+        ]
+    },
+    'sqlite': {
+        'actors': [
+            ('actor_gender', "COALESCE({row}.gender, 'unknown')"),
+            ('actor_age',
+             "COALESCE(CAST({row}.age / 10 * 10 AS TEXT), 'unknown')")
+        ],
+        'movies': [
+            # SQLAlchemy stores dates as YYYY-MM-DD text in SQLite
+            ('movie_year', "COALESCE(substr({row}.release_date, 1, 4), "
+                           "'unknown')")
+        ]
+    }
+}
+
+COLUMNS = {'actors': 'gender, age', 'movies': 'release_date'}
+
+UPSERT = ('INSERT INTO catalogue_stats (metric, bucket, count) '
+          "VALUES ('{metric}', {bucket}, {delta}) "
+          'ON CONFLICT (metric, bucket) '
+          'DO UPDATE SET count = catalogue_stats.count + excluded.count')
+
+
+def _upserts(metrics, row, delta):
+    return [UPSERT.format(metric=metric, bucket=bucket.format(row=row),
+                          delta=delta)
+            for metric, bucket in metrics]
+
+
+DELTA = "('{metric}', {bucket}, {delta})"
+
+# applies the deltas staged by the transaction, on the first deferred
+# event after a write staged some
+APPLY = '''CREATE OR REPLACE FUNCTION apply_catalogue_stats()
+RETURNS trigger AS $$
+BEGIN
+    IF current_setting('casting.stats_pending', true) = 'on' THEN
+        PERFORM set_config('casting.stats_pending', 'off', true);
+        WITH pending AS (
+            DELETE FROM catalogue_stats_deltas
+            RETURNING metric, bucket, delta
+        )
+        INSERT INTO catalogue_stats (metric, bucket, count)
+        SELECT metric, bucket, sum(delta) FROM pending
+        GROUP BY metric, bucket
+        HAVING sum(delta) <> 0
+        ORDER BY metric, bucket
+        ON CONFLICT (metric, bucket)
+        DO UPDATE SET count = catalogue_stats.count + excluded.count;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+
+
+def _stage(deltas):
+    return ('INSERT INTO catalogue_stats_deltas (metric, bucket, delta) '
+            'VALUES ' + ', '.join(deltas))
+
+
+def _deltas(metrics, row, delta):
+    return [DELTA.format(metric=metric, bucket=bucket.format(row=row),
+                         delta=delta)
+            for metric, bucket in metrics]
+
+
+# An update stages a move for each metric whose bucket changed
+def _postgresql_moves(metrics):
+    moves = []
+    for metric, bucket in metrics:
+        old, new = bucket.format(row='OLD'), bucket.format(row='NEW')
+        move = _stage([DELTA.format(metric=metric, bucket=old, delta=-1),
+                       DELTA.format(metric=metric, bucket=new, delta=1)])
+        moves.append(f'''IF {old} IS DISTINCT FROM {new} THEN
+            {move};
+        END IF''')
+    return moves
+
+
+def _postgresql_triggers(dialect_metrics):
+    statements = [APPLY]
+    for table, metrics in dialect_metrics.items():
+        old = _stage(_deltas(metrics, 'OLD', -1))
+        new = _stage(_deltas(metrics, 'NEW', 1))
+        moves = ';\n        '.join(_postgresql_moves(metrics))
+        statements += [
+            f'''CREATE OR REPLACE FUNCTION {table}_catalogue_stats()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {new};
+    ELSIF TG_OP = 'DELETE' THEN
+        {old};
+    ELSE
+        {moves};
+    END IF;
+    PERFORM set_config('casting.stats_pending', 'on', true);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql''',
+            f'DROP TRIGGER IF EXISTS {table}_catalogue_stats ON {table}',
+            f'''CREATE TRIGGER {table}_catalogue_stats
+AFTER INSERT OR UPDATE OF {COLUMNS[table]} OR DELETE ON {table}
+FOR EACH ROW EXECUTE PROCEDURE {table}_catalogue_stats()'''
+        ]
+    for table in CATALOGUE:
+        statements += [
+            f'DROP TRIGGER IF EXISTS {table}_catalogue_stats_apply '
+            f'ON {table}',
+            f'''CREATE CONSTRAINT TRIGGER {table}_catalogue_stats_apply
+AFTER INSERT OR UPDATE OR DELETE ON {table}
+DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW EXECUTE PROCEDURE apply_catalogue_stats()'''
+        ]
+    return statements
+
+
+def _sqlite_triggers(dialect_metrics):
+    statements = []
+    for table, metrics in dialect_metrics.items():
+        events = [
+            ('insert', 'INSERT', _upserts(metrics, 'NEW', 1)),
+            ('update', f'UPDATE OF {COLUMNS[table]}',
+             _upserts(metrics, 'OLD', -1) + _upserts(metrics, 'NEW', 1)),
+            ('delete', 'DELETE', _upserts(metrics, 'OLD', -1))
+        ]
+        for name, when, upserts in events:
+            body = ''.join(f'    {upsert};\n' for upsert in upserts)
+            statements.append(
+                f'CREATE TRIGGER IF NOT EXISTS {table}_catalogue_stats_{name}'
+                f'\nAFTER {when} ON {table}\nBEGIN\n{body}END')
+    return statements
+
+
+# Returns the statements creating the summary triggers of the dialect
+def trigger_statements(dialect):
+    if dialect == 'postgresql':
+        return _postgresql_triggers(METRICS[dialect])
+    return _sqlite_triggers(METRICS[dialect])
+
+
+# Recomputes every summary row from the actors and movies tables
+# in the transaction of the connection; writes to both tables wait for
+# it on Postgres
+def rebuild_stats(connection):
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text('LOCK TABLE actors, movies IN SHARE MODE'))
+    connection.execute(catalogue_stats.delete())
+    for table, metrics in METRICS[dialect].items():
+        for metric, bucket in metrics:
+            connection.execute(text(
+                'INSERT INTO catalogue_stats (metric, bucket, count) '
+                f"SELECT '{metric}', {bucket.format(row=table)}, count(*) "
+                f'FROM {table} GROUP BY {bucket.format(row=table)}'))
+
+
+# create_all() builds the triggers along with the tables and fills the
+# summary of a database that already holds rows
+@event.listens_for(db.Model.metadata, 'after_create')
+def create_stats_triggers(metadata, connection, tables=(), **kw):
+    if connection.dialect.name not in METRICS:
+        return
+    for statement in trigger_statements(connection.dialect.name):
+        connection.execute(text(statement))
+    if catalogue_stats in tables:
+        rebuild_stats(connection)
+
+
+# Returns {metric: {bucket: count}} for the metrics
+# buckets left empty by deletes are skipped
+def read_stats(*metrics):
+    rows = db.session.execute(
+        select(catalogue_stats.c.metric, catalogue_stats.c.bucket,
+               catalogue_stats.c.count)
+        .where(catalogue_stats.c.metric.in_(metrics))
+        .where(catalogue_stats.c.count > 0)).all()
+    stats = {metric: {} for metric in metrics}
+    for metric, bucket, count in rows:
+        stats[metric][bucket] = count
+    return stats
+
+
+def _decade(bucket):
+    if bucket == 'unknown':
+        return bucket
+    return f'{bucket}-{int(bucket) + 9}'
+
+
+def actor_stats():
+    stats = read_stats('actor_gender', 'actor_age')
+    return {
+        'total': sum(stats['actor_gender'].values()),
+        'by_gender': stats['actor_gender'],
+        'by_age': {_decade(bucket): count
+                   for bucket, count in stats['actor_age'].items()}
+    }
+
+
+def movie_stats():
+    stats = read_stats('movie_year')
+    return {
+        'total': sum(stats['movie_year'].values()),
+        'by_year': stats['movie_year']
+    }
@@ -0,0 +1,49 @@
+import json
+import os
+from flask import request, Response, stream_with_context
+
+
+NDJSON = 'application/x-ndjson'
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+
+
+'''
+NDJSON streaming
+Full exports of a table are written to the socket as one JSON object per
+line while rows are read from a server-side cursor in batches, so memory
+stays flat and the first byte goes out before the whole table is read.
+
+    opt in with an Accept: application/x-ndjson header or ?stream=true
+'''
+
+
+def wants_stream():
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    accept = request.accept_mimetypes
+    return accept[NDJSON] > accept['application/json']
+
+
+# Streams every row of the query ordered by id as NDJSON
+# formatter turns a row into a dict (model.format() by default)
+def stream_ndjson(query, model, formatter=None,
+                  batch_size=STREAM_BATCH_SIZE):
+    if formatter is None:
+        def formatter(row):
+            return row.format()
+
+    rows = query.order_by(model.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+
+    def generate():
+        batch = []
+        for row in rows:
+            batch.append(json.dumps(formatter(row)))
+            if len(batch) >= batch_size:
+                yield '\n'.join(batch) + '\n'
+                batch = []
+        if batch:
+            yield '\n'.join(batch) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
@@ -1,27 +1,52 @@
 import os
+import subprocess
+import socket
+import sqlite3
+import sys
+import threading
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
 
+from flask import g
+from sqlalchemy import text
+from starlette.testclient import TestClient
+
+import asgi
+import authentication
+import fastjson
+from cache import DetailCache, LocalStore
+from groupcommit import COMMITS
+from jwks import JWKSStore
+from pool import POOL_STATS, TimedQueuePool, engine_options
+from ratelimit import RateLimiter, parse_limits
+from querylog import max_queries
+from replicas import request_replica
+from tokencache import VerifiedTokenCache
 from app import create_app
-from models import setup_db, Movie, Actor
+from authentication import AuthError
+from models import db, Movie, Actor
 
 ca_cred = os.environ['CA_CRED']
 cd_cred = os.environ['CD_CRED']
 ep_cred = os.environ['EP_CRED']
 
+# seconds allowed for importing app.py and building the app
+# without a database or network
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET', 2.0))
+
 
 class CastingTestCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
-        self.client = self.app.test_client
         self.database_path = os.environ['DATABASE_URL']
-        setup_db(self.app, self.database_path)
+        self.app = create_app({'DATABASE_URL': self.database_path})
+        self.client = self.app.test_client
 
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.create_all()
+            db.create_all()
 
     def tearDown(self):
         pass
@@ -45,6 +70,56 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    def test_pass_create_actors_bulk(self):
+        res = self.client().post(
+            '/actors/bulk',
+            json=[{"name": "Ann", "age": 30, "gender": "female"},
+                  {"name": "Bob", "age": 41, "gender": "male"}],
+            headers={"Authorization": f"Bearer {cd_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['actors']), 2)
+
+    def test_pass_create_actors_bulk_returning_order(self):
+        names = [f'Bulk {i}' for i in range(5)]
+        execute = db.session.execute
+
+        # Postgres does not promise RETURNING rows in input order
+        def execute_reversed(statement, *args, **kwargs):
+            result = execute(statement, *args, **kwargs)
+            if getattr(statement, 'is_insert', False) and result.returns_rows:
+                rows = result.all()[::-1]
+                return mock.Mock(**{'all.return_value': rows,
+                                    'one.return_value': rows[0]})
+            return result
+
+        with self.app.app_context(), \
+                mock.patch.object(db.session, 'execute', execute_reversed):
+            res = self.client().post(
+                '/actors/bulk',
+                json=[{"name": name, "age": 30, "gender": "female"}
+                      for name in names],
+                headers={"Authorization": f"Bearer {cd_cred}"})
+        actors = json.loads(res.data)['actors']
+        self.assertEqual([actor['name'] for actor in actors], names)
+        with self.app.app_context():
+            for actor in actors:
+                self.assertEqual(db.session.get(Actor, actor['id']).name,
+                                 actor['name'])
+
+    def test_fail_create_actors_bulk(self):
+        res = self.client().post(
+            '/actors/bulk',
+            json=[{"name": "Ann", "age": 30, "gender": "female"},
+                  {"age": 41, "gender": "male"}],
+            headers={"Authorization": f"Bearer {cd_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['errors'][0]['index'], 1)
+
     def test_pass_create_movie(self):
         res = self.client().post(
             '/movies',
@@ -72,6 +147,35 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['actors'])
 
+    def test_pass_get_actors_fields(self):
+        res = self.client().get(
+            '/actors?fields=id,name',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['actors'])
+        self.assertEqual(set(data['actors'][0]), {'id', 'name'})
+
+    def test_pass_get_actors_fast_path(self):
+        self.addCleanup(setattr, fastjson, 'FAST_READS', fastjson.FAST_READS)
+        bodies = []
+        for fast in (True, False):
+            fastjson.FAST_READS = fast
+            res = self.client().get(
+                '/actors?sort=-age&limit=5',
+                headers={"Authorization": f"Bearer {ca_cred}"})
+            self.assertEqual(res.status_code, 200)
+            bodies.append(res.data)
+        self.assertEqual(bodies[0], bodies[1])
+
+    def test_fail_get_actors_fields(self):
+        res = self.client().get(
+            '/actors?fields=salary',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_fail_get_actors(self):
         res = self.client().delete(
             '/actors',
@@ -80,6 +184,26 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 405)
         self.assertEqual(data['success'], False)
 
+    def test_pass_filter_actors(self):
+        res = self.client().get(
+            '/actors?gender=male&min_age=18&sort=-age',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        ages = [actor['age'] for actor in data['actors']]
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(actor['gender'] == 'male'
+                            for actor in data['actors']))
+        self.assertTrue(all(age >= 18 for age in ages))
+        self.assertEqual(ages, sorted(ages, reverse=True))
+
+    def test_fail_filter_actors(self):
+        res = self.client().get(
+            '/actors?sort=gender',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_pass_get_actor(self):
         res = self.client().get(
             '/actors/8',
@@ -88,6 +212,38 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['actor'])
 
+    def test_pass_get_actor_not_modified(self):
+        res = self.client().get(
+            '/actors/8',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        etag = res.headers['ETag']
+        res = self.client().get(
+            '/actors/8',
+            headers={"Authorization": f"Bearer {ca_cred}",
+                     "If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_fail_get_actor_not_modified(self):
+        headers = {"Authorization": f"Bearer {ca_cred}"}
+        detail = self.client().get('/actors/8', headers=headers)
+        listed = self.client().get('/actors?limit=5', headers=headers)
+        # a write the app does not see, as from psql or another dyno
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(
+                    text('UPDATE actors SET name = name WHERE id = 8'))
+        detail_again = self.client().get(
+            '/actors/8', headers=dict(headers, **{
+                "If-None-Match": detail.headers['ETag']}))
+        listed_again = self.client().get(
+            '/actors?limit=5', headers=dict(headers, **{
+                "If-None-Match": listed.headers['ETag']}))
+        self.assertEqual(detail_again.status_code, 200)
+        self.assertNotEqual(detail_again.headers['ETag'],
+                            detail.headers['ETag'])
+        self.assertEqual(listed_again.status_code, 200)
+
     def test_fail_get_actor(self):
         res = self.client().get(
             '/actors/1000',
@@ -104,6 +260,35 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['movies'])
 
+    def test_pass_get_movies_released_between(self):
+        res = self.client().get(
+            '/movies?released_after=01-01-2020&released_before=12-31-2020'
+            '&sort=release_date',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        years = [movie['release_date'][-4:] for movie in data['movies']]
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(year == '2020' for year in years))
+
+    def test_fail_get_movies_released_between(self):
+        res = self.client().get(
+            '/movies?released_after=yesterday',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_pass_stream_movies(self):
+        res = self.client().get(
+            '/movies',
+            headers={"Authorization": f"Bearer {ca_cred}",
+                     "Accept": "application/x-ndjson"})
+        lines = res.data.decode().splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(lines)
+        self.assertTrue(json.loads(lines[0])['title'])
+
     def test_fail_get_movies(self):
         res = self.client().delete(
             '/movies',
@@ -112,6 +297,31 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 405)
         self.assertEqual(data['success'], False)
 
+    def test_pass_get_actors_page(self):
+        res = self.client().get(
+            '/actors?limit=1',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get(
+            f"/actors?limit=1&cursor={data['next_cursor']}",
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        next_data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_data['actors'][0]['id'],
+                           data['actors'][0]['id'])
+
+    def test_fail_get_actors_page(self):
+        res = self.client().get(
+            '/actors?cursor=not-a-cursor',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_pass_get_movie(self):
         res = self.client().get(
             '/movies/9',
@@ -120,6 +330,30 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['movie'])
 
+    def test_pass_get_movie_cast(self):
+        res = self.client().post(
+            '/movies/9/actors',
+            json={"actor_ids": [8]},
+            headers={"Authorization": f"Bearer {ep_cred}"})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(
+            '/movies/9?expand=cast,cast_count',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(8, [actor['id'] for actor in data['movie']['actors']])
+        self.assertEqual(data['movie']['cast_count'],
+                         len(data['movie']['actors']))
+
+    def test_fail_get_movie_cast(self):
+        res = self.client().get(
+            '/movies/9?expand=crew',
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_fail_get_movie(self):
         res = self.client().get(
             '/movies/1000',
@@ -165,6 +399,24 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    def test_pass_patch_actors_bulk(self):
+        res = self.client().patch(
+            '/actors/bulk?return=count',
+            json={"ids": [8], "changes": {"gender": "female"}},
+            headers={"Authorization": f"Bearer {cd_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['count'], 1)
+
+    def test_fail_patch_actors_bulk(self):
+        res = self.client().patch(
+            '/actors/bulk',
+            json={"changes": {"gender": "female"}},
+            headers={"Authorization": f"Bearer {cd_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     # GET
     def test_pass_get_actors(self):
         res = self.client().get(
@@ -215,6 +467,606 @@ class CastingTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    def test_pass_delete_movies_bulk(self):
+        res = self.client().delete(
+            '/movies/bulk',
+            json={"ids": [1000]},
+            headers={"Authorization": f"Bearer {ep_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['count'], 0)
+
+    def test_fail_delete_movies_bulk(self):
+        res = self.client().delete(
+            '/movies/bulk',
+            json={"ids": [1000]},
+            headers={"Authorization": f"Bearer {ca_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['success'], False)
+
+    def test_pass_token_cache_hit(self):
+        headers = {"Authorization": f"Bearer {ca_cred}"}
+        with mock.patch('authentication.verify_decode_jwt',
+                        wraps=authentication.verify_decode_jwt) as verify:
+            first = self.client().get('/actors', headers=headers)
+            second = self.client().get('/actors', headers=headers)
+        stats = self.app.extensions['token_cache'].stats()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_fail_token_cache_expired(self):
+        cache = VerifiedTokenCache(maxsize=8)
+        now = time.time()
+        cache.put('token', {'sub': 'user|1', 'exp': now + 60})
+        with mock.patch('tokencache.time.time', return_value=now + 59):
+            self.assertIsNotNone(cache.get('token'))
+        with mock.patch('tokencache.time.time', return_value=now + 60):
+            self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_pass_token_cache_eviction(self):
+        cache = VerifiedTokenCache(maxsize=2)
+        exp = time.time() + 60
+        cache.put('a', {'sub': 'a', 'exp': exp})
+        cache.put('b', {'sub': 'b', 'exp': exp})
+        cache.get('a')
+        cache.put('c', {'sub': 'c', 'exp': exp})
+        # b was the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a').payload['sub'], 'a')
+        self.assertEqual(cache.get('c').payload['sub'], 'c')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_fail_token_cache_invalid(self):
+        headers = {"Authorization": f"Bearer {ca_cred}"}
+        error = AuthError({'code': 'invalid_token',
+                           'description': 'Bad signature.'}, 401)
+        with mock.patch('authentication.verify_decode_jwt',
+                        side_effect=error) as verify:
+            first = self.client().get('/actors', headers=headers)
+            second = self.client().get('/actors', headers=headers)
+        self.assertEqual(first.status_code, 401)
+        self.assertEqual(second.status_code, 401)
+        self.assertEqual(verify.call_count, 2)
+        self.assertEqual(self.app.extensions['token_cache'].stats()['size'],
+                         0)
+
+    def test_pass_pool_options(self):
+        with mock.patch.dict(os.environ, {
+                'WEB_CONCURRENCY': '3', 'WEB_THREADS': '4',
+                'DB_MAX_CONNECTIONS': '20', 'DB_RESERVED_CONNECTIONS': '2'}):
+            options = engine_options('postgresql://localhost/casting')
+        self.assertEqual(options['pool_size'], 4)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(engine_options('sqlite:///casting.db'), {})
+
+    def test_pass_pool_checkout_recorded_once(self):
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'),
+                              pool_size=1, max_overflow=1)
+        self.addCleanup(pool.dispose)
+        checkouts = POOL_STATS.checkouts
+        # losing the overflow race makes QueuePool._do_get call itself
+        with mock.patch.object(TimedQueuePool, '_inc_overflow',
+                               side_effect=[False, True]):
+            pool.connect().close()
+        self.assertEqual(POOL_STATS.checkouts - checkouts, 1)
+
+    def test_pass_detail_cache_l1_hit(self):
+        cache = DetailCache(maxsize=8)
+        body, age = cache.get('actors', 900001, 1)
+        self.assertIsNone(body)
+        cache.put('actors', 900001, 1, b'{"a": 1}')
+        self.assertEqual(cache.get('actors', 900001, 1)[0], b'{"a": 1}')
+        self.assertEqual(cache.stats()['l1_hits'], 1)
+
+    def test_pass_detail_cache_l2_hit(self):
+        store = LocalStore()
+        writer = DetailCache(maxsize=8, shared=store)
+        writer.put('actors', 900002, 1, b'{"a": 2}')
+        reader = DetailCache(maxsize=8, shared=store)
+        self.assertEqual(reader.get('actors', 900002, 1)[0], b'{"a": 2}')
+        self.assertEqual(reader.get('actors', 900002, 1)[0], b'{"a": 2}')
+        self.assertEqual(reader.stats()['l2_hits'], 1)
+        self.assertEqual(reader.stats()['l1_hits'], 1)
+
+    def test_fail_detail_cache_invalidated(self):
+        cache = DetailCache(maxsize=8, shared=LocalStore())
+        cache.put('actors', 900003, 1, b'OLD')
+        cache.invalidate('actors', 900003)
+        self.assertIsNone(cache.get('actors', 900003, 1)[0])
+
+    def test_fail_detail_cache_stale_fill(self):
+        store = LocalStore()
+        cache = DetailCache(maxsize=8, shared=store)
+        # a reader misses at version 1, a write moves the row to version 2
+        # and invalidates it, then the reader stores the body it read
+        self.assertIsNone(cache.get('actors', 900004, 1)[0])
+        cache.invalidate('actors', 900004)
+        cache.put('actors', 900004, 1, b'OLD')
+        self.assertIsNone(cache.get('actors', 900004, 2)[0])
+        other = DetailCache(maxsize=8, shared=store)
+        self.assertIsNone(other.get('actors', 900004, 2)[0])
+
+    def test_pass_local_store(self):
+        store = LocalStore()
+        store.hset('key', 'field', b'value')
+        self.assertEqual(store.hget('key', 'field'), b'value')
+        self.assertIsNone(store.hget('key', 'other'))
+        store.delete('key')
+        self.assertIsNone(store.hget('key', 'field'))
+        store.hset('key', 'field', b'value')
+        store.expire('key', 0)
+        self.assertIsNone(store.hget('key', 'field'))
+
+    def jwks_store(self, delay=0, fail=False, **kwargs):
+        store = JWKSStore(url='https://casting.invalid/jwks.json', **kwargs)
+        store.fetches = 0
+
+        def fetch():
+            store.fetches += 1
+            time.sleep(delay)
+            if fail:
+                raise OSError('identity provider down')
+            return {'keys': [{'kid': 'k1', 'fetch': store.fetches}]}
+
+        store._fetch = fetch
+        return store
+
+    def wait_for_refresh(self, store):
+        deadline = time.monotonic() + 2
+        while store._lock.locked() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_pass_jwks_ttl(self):
+        store = self.jwks_store(ttl=0.05, min_refresh=0)
+        self.assertEqual(store.get_key('k1')['fetch'], 1)
+        self.assertEqual(store.get_key('k1')['fetch'], 1)
+        time.sleep(0.06)
+        # the expired key is served while it is refetched
+        self.assertEqual(store.get_key('k1')['fetch'], 1)
+        self.wait_for_refresh(store)
+        self.assertEqual(store.get_key('k1')['fetch'], 2)
+        self.assertEqual(store.fetches, 2)
+
+    def test_pass_jwks_single_flight(self):
+        store = self.jwks_store(delay=0.3, ttl=600, min_refresh=0)
+        store.warm()
+        store._fetched_at -= 601
+        waits = []
+
+        def get_key():
+            started = time.perf_counter()
+            store.get_key('k1')
+            waits.append(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=get_key) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(max(waits), 0.2)
+        self.wait_for_refresh(store)
+        self.assertEqual(store.fetches, 2)
+
+        # an unknown kid waits for one shared refetch
+        threads = [threading.Thread(target=store.get_key, args=('k2',))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(store.fetches, 3)
+
+    def test_fail_jwks_fetch(self):
+        store = self.jwks_store(ttl=0, min_refresh=0)
+        store.warm()
+        store._fetch = mock.Mock(side_effect=OSError('down'))
+        with redirect_stdout(StringIO()):
+            self.assertEqual(store.get_key('k1')['fetch'], 1)
+            self.wait_for_refresh(store)
+            self.assertEqual(store.get_key('k1')['fetch'], 1)
+            self.assertIsNone(store.get_key('k2'))
+        self.assertTrue(store._fetch.called)
+
+    def test_pass_jwks_boot_fetch_failed(self):
+        store = self.jwks_store(ttl=600, min_refresh=600)
+        fetch = store._fetch
+        store._fetch = mock.Mock(side_effect=OSError('down'))
+        with redirect_stdout(StringIO()):
+            store.warm()
+            self.assertIsNone(store.get_key('k1'))
+        # not throttled while no keyset was ever loaded
+        store._fetch = fetch
+        self.assertEqual(store.get_key('k1')['fetch'], 1)
+
+    def test_pass_startup_budget(self):
+        env = {key: value for key, value in os.environ.items()
+               if key not in ('DATABASE_URL', 'AUTH0_DOMAIN', 'ALGORITHMS',
+                              'API_AUDIENCE', 'JWKS_FILE')}
+        env['JWKS_JSON'] = '{"keys": []}'
+        code = (
+            "import time\n"
+            "started = time.perf_counter()\n"
+            "from app import create_app\n"
+            "create_app({'DATABASE_URL': 'postgresql://127.0.0.1:1/none',\n"
+            "            'AUTH0_DOMAIN': 'casting.invalid',\n"
+            "            'ALGORITHMS': 'RS256', 'API_AUDIENCE': 'casting'})\n"
+            "print(time.perf_counter() - started)\n")
+        result = subprocess.run(
+            [sys.executable, '-c', code], env=env, capture_output=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertLess(float(result.stdout), STARTUP_BUDGET)
+
+    def test_pass_create_app_offline(self):
+        env = {key: value for key, value in os.environ.items()
+               if key not in ('JWKS_FILE', 'JWKS_JSON')}
+        with mock.patch.dict(os.environ, env, clear=True), \
+                mock.patch('jwks.urlopen') as urlopen:
+            create_app({'DATABASE_URL': self.database_path})
+        self.assertFalse(urlopen.called)
+
+    def test_pass_server_timing(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'SERVER_TIMING': True})
+        res = app.test_client().get(
+            '/actors', headers={"Authorization": f"Bearer {ca_cred}"})
+        self.assertEqual(res.status_code, 200)
+        timing = res.headers['Server-Timing']
+        for name in ('auth;dur=', 'db;dur=', 'serialize;dur=', 'total;dur='):
+            self.assertIn(name, timing)
+
+    def test_fail_server_timing_disabled(self):
+        # another app timing its requests leaves this one untouched
+        create_app({'DATABASE_URL': self.database_path,
+                    'SERVER_TIMING': True})
+        res = self.client().get(
+            '/actors', headers={"Authorization": f"Bearer {ca_cred}"})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Server-Timing', res.headers)
+
+    def test_pass_query_budget(self):
+        headers = {"Authorization": f"Bearer {ca_cred}"}
+        # one query reads the versions behind the ETag
+        with max_queries(2):
+            res = self.client().get('/actors?limit=20', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        with max_queries(4):
+            res = self.client().get(
+                '/movies?expand=cast,cast_count&limit=20', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        with max_queries(4):
+            res = self.client().get(
+                '/actors?expand=movies,movie_count&limit=20',
+                headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_fail_query_budget(self):
+        with self.assertRaises(AssertionError):
+            with max_queries(0):
+                self.client().get(
+                    '/actors', headers={"Authorization": f"Bearer {ca_cred}"})
+
+    def test_pass_slow_query_log(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'SLOW_QUERY_MS': 0.000001})
+        out = StringIO()
+        with redirect_stdout(out):
+            res = app.test_client().get(
+                '/actors?name_prefix=Secret',
+                headers={"Authorization": f"Bearer {ca_cred}"})
+        self.assertEqual(res.status_code, 200)
+        entry = json.loads(out.getvalue().splitlines()[0])
+        self.assertEqual(entry['event'], 'slow_query')
+        self.assertEqual(entry['path'], '/actors')
+        self.assertNotIn('Secret', out.getvalue())
+
+    def test_fail_slow_query_log_other_app(self):
+        create_app({'DATABASE_URL': self.database_path,
+                    'SLOW_QUERY_MS': 0.000001})
+        out = StringIO()
+        with redirect_stdout(out):
+            res = self.client().get(
+                '/actors', headers={"Authorization": f"Bearer {ca_cred}"})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('slow_query', out.getvalue())
+
+    def test_pass_metrics(self):
+        self.client().get(
+            '/actors', headers={"Authorization": f"Bearer {ca_cred}"})
+        self.client().get('/nothing-here')
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        body = res.get_data(as_text=True)
+        self.assertIn('http_requests_total{route="/actors",method="GET",'
+                      'status="200"}', body)
+        self.assertIn('http_requests_total{route="unmatched",method="GET",'
+                      'status="404"}', body)
+        self.assertIn('http_request_duration_seconds_bucket', body)
+        self.assertIn('auth_token_cache_misses_total', body)
+
+    def test_fail_metrics_token(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'METRICS_TOKEN': 'scrape'})
+        res = app.test_client().get('/metrics')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['success'], False)
+        res = app.test_client().get(
+            '/metrics', headers={"Authorization": "Bearer scrape"})
+        self.assertEqual(res.status_code, 200)
+
+    def test_fail_rate_limit(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'RATE_LIMIT': 1, 'RATE_BURST': 2})
+        headers = {"Authorization": f"Bearer {ca_cred}"}
+        for _ in range(2):
+            res = app.test_client().get('/actors', headers=headers)
+            self.assertEqual(res.status_code, 200)
+        res = app.test_client().get('/actors', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertTrue(res.headers['Retry-After'])
+        # buckets are kept per permission
+        res = app.test_client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_pass_slow_rate_limit(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'RATE_LIMIT': 0.2,
+                          'RATE_LIMITS': 'get:movies=0.1'})
+        headers = {"Authorization": f"Bearer {ca_cred}"}
+        self.assertEqual(app.test_client().get(
+            '/actors', headers=headers).status_code, 200)
+        self.assertEqual(app.test_client().get(
+            '/movies', headers=headers).status_code, 200)
+        self.assertEqual(app.test_client().get(
+            '/movies', headers=headers).status_code, 429)
+
+    def test_fail_rate_limit_burst(self):
+        with self.assertRaises(ValueError):
+            parse_limits('get:movies=1/0.5')
+        with self.assertRaises(ValueError):
+            RateLimiter(rate=1, burst=0.5)
+
+    def test_fail_load_shed(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'MAX_QUEUE_MS': 500})
+        started = int((time.time() - 2) * 1000)
+        res = app.test_client().get(
+            '/actors', headers={"Authorization": f"Bearer {ca_cred}",
+                                "X-Request-Start": str(started)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['success'], False)
+
+    def test_pass_group_commit(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'GROUP_COMMIT': 1, 'GROUP_COMMIT_WINDOW_MS': 20})
+        headers = {"Authorization": f"Bearer {cd_cred}"}
+        responses = []
+
+        def create(i):
+            responses.append(app.test_client().post(
+                '/actors', json={"name": f"Group {i}", "age": 30,
+                                 "gender": "female"}, headers=headers))
+
+        commits = COMMITS.commits
+        threads = [threading.Thread(target=create, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([res.status_code for res in responses], [200] * 8)
+        ids = {res.get_json()['actor']['id'] for res in responses}
+        self.assertEqual(len(ids), 8)
+        self.assertLess(COMMITS.commits - commits, 8)
+
+    def test_fail_group_commit(self):
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'GROUP_COMMIT': 1})
+        res = app.test_client().patch(
+            '/actors/100000', json={"age": 40},
+            headers={"Authorization": f"Bearer {cd_cred}"})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_pass_actor_stats(self):
+        headers = {"Authorization": f"Bearer {cd_cred}"}
+        before = self.client().get('/stats/actors', headers=headers) \
+            .get_json()['actors']
+        self.client().post('/actors', json={"name": "Old Timer", "age": 94,
+                                            "gender": "stats"},
+                           headers=headers)
+        res = self.client().get('/stats/actors', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actors']['total'], before['total'] + 1)
+        self.assertEqual(data['actors']['by_gender']['stats'],
+                         before['by_gender'].get('stats', 0) + 1)
+        self.assertEqual(data['actors']['by_age']['90-99'],
+                         before['by_age'].get('90-99', 0) + 1)
+
+    def test_pass_actor_stats_concurrent_writers(self):
+        with self.app.app_context():
+            engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            self.skipTest('SQLite has a single writer')
+        insert = text('INSERT INTO actors (name, age, gender) '
+                      "VALUES ('Concurrent', 30, :gender)")
+        count = text("SELECT COALESCE(sum(count), 0) FROM catalogue_stats "
+                     "WHERE metric = 'actor_gender' "
+                     "AND bucket IN ('stats-a', 'stats-b')")
+        with engine.connect() as connection:
+            before = connection.execute(count).scalar()
+        with engine.connect() as first, engine.connect() as second:
+            for connection in (first, second):
+                connection.execute(text("SET lock_timeout = '2s'"))
+            transactions = [first.begin(), second.begin()]
+            # the two transactions write the same buckets in opposite
+            # orders; neither waits for the other before committing
+            first.execute(insert, {'gender': 'stats-a'})
+            second.execute(insert, {'gender': 'stats-b'})
+            first.execute(insert, {'gender': 'stats-b'})
+            second.execute(insert, {'gender': 'stats-a'})
+            for transaction in transactions:
+                transaction.commit()
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(count).scalar(), before + 4)
+            self.assertEqual(connection.execute(text(
+                'SELECT count(*) FROM catalogue_stats_deltas')).scalar(), 0)
+
+    def test_fail_movie_stats(self):
+        res = self.client().get('/stats/movies')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['success'], False)
+
+    def test_pass_replica_reads(self):
+        headers = {"Authorization": f"Bearer {cd_cred}"}
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'DATABASE_REPLICA_URLS': self.database_path,
+                          'REPLICA_STICKY_SECONDS': 0})
+        res = app.test_client().get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            app.extensions['replicas'].stats()['replicas'][0]['reads'], 1)
+
+        app = create_app({'DATABASE_URL': self.database_path,
+                          'DATABASE_REPLICA_URLS': self.database_path,
+                          'REPLICA_STICKY_SECONDS': 60})
+        app.test_client().post('/actors', json={
+            "name": "Sticky", "age": 30, "gender": "female"},
+            headers=headers)
+        res = app.test_client().get('/actors', headers=headers)
+        stats = app.extensions['replicas'].stats()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(stats['replicas'][0]['reads'], 0)
+        self.assertEqual(stats['fallbacks']['recent_write'], 1)
+        # other clients keep reading from the replica
+        with app.test_request_context('/actors'):
+            g.subject = 'auth0|someone-else'
+            self.assertIsNotNone(request_replica(app))
+
+    def test_fail_replica_unreachable(self):
+        app = create_app({
+            'DATABASE_URL': self.database_path,
+            'DATABASE_REPLICA_URLS': 'sqlite:////nonexistent/replica.db',
+            'REPLICA_STICKY_SECONDS': 0})
+        with redirect_stdout(StringIO()):
+            res = app.test_client().get(
+                '/movies', headers={"Authorization": f"Bearer {ca_cred}"})
+        stats = app.extensions['replicas'].stats()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(stats['replicas'][0]['up'], False)
+        self.assertEqual(stats['fallbacks']['unhealthy'], 1)
+
+    def test_fail_replica_timeout(self):
+        # a server that accepts connections and never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(8)
+        self.addCleanup(server.close)
+        # without a connect timeout the check waits until this closes it
+        closer = threading.Timer(15, server.close)
+        closer.start()
+        self.addCleanup(closer.cancel)
+        port = server.getsockname()[1]
+        app = create_app({
+            'DATABASE_URL': self.database_path,
+            'DATABASE_REPLICA_URLS':
+                f'postgresql://casting@127.0.0.1:{port}/casting'
+                '?sslmode=disable',
+            'REPLICA_CONNECT_TIMEOUT': 2,
+            'REPLICA_STICKY_SECONDS': 0})
+        started = time.monotonic()
+        with redirect_stdout(StringIO()):
+            res = app.test_client().get(
+                '/movies', headers={"Authorization": f"Bearer {ca_cred}"})
+        stats = app.extensions['replicas'].stats()
+        self.assertEqual(res.status_code, 200)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(stats['replicas'][0]['up'], False)
+        self.assertEqual(stats['fallbacks']['unhealthy'], 1)
+
+    def test_pass_asgi_same_body(self):
+        headers = {"Authorization": f"Bearer {ca_cred}"}
+        app = asgi.create_app({'DATABASE_URL': self.database_path})
+        with TestClient(app) as client:
+            res = client.get('/actors?limit=5&sort=-age', headers=headers)
+        expected = self.client().get('/actors?limit=5&sort=-age',
+                                     headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, expected.data)
+        self.assertEqual(res.headers['ETag'], expected.headers['ETag'])
+
+    def test_fail_asgi_auth(self):
+        app = asgi.create_app({'DATABASE_URL': self.database_path})
+        with TestClient(app) as client:
+            res = client.get('/actors')
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.json()['success'], False)
+
+    def test_pass_asgi_actor_age(self):
+        headers = {"Authorization": f"Bearer {cd_cred}"}
+        app = asgi.create_app({'DATABASE_URL': self.database_path})
+        with TestClient(app) as client:
+            res = client.post('/actors', json={"name": "Async Actor",
+                                               "age": "41",
+                                               "gender": "female"},
+                              headers=headers)
+            actor_id = res.json()['actor']['id']
+            modified = client.patch(f'/actors/{actor_id}',
+                                    json={"age": "42"}, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['actor']['age'], 41)
+        self.assertEqual(modified.json()['actor']['age'], 42)
+
+    def test_fail_asgi_actor_age(self):
+        headers = {"Authorization": f"Bearer {cd_cred}"}
+        app = asgi.create_app({'DATABASE_URL': self.database_path})
+        with TestClient(app) as client, redirect_stdout(StringIO()):
+            res = client.post('/actors', json={"name": "Async Actor",
+                                               "age": "forty",
+                                               "gender": "female"},
+                              headers=headers)
+            modified = client.patch('/actors/1', json={"age": [42]},
+                                    headers=headers)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.json()['success'], False)
+        self.assertEqual(modified.status_code, 422)
+
+    def test_fail_asgi_rate_limit(self):
+        headers = {"Authorization": f"Bearer {ca_cred}"}
+        app = asgi.create_app({'DATABASE_URL': self.database_path,
+                               'RATE_LIMIT': 1, 'RATE_BURST': 1})
+        with TestClient(app) as client:
+            self.assertEqual(
+                client.get('/actors', headers=headers).status_code, 200)
+            res = client.get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.json()['success'], False)
+        self.assertTrue(res.headers['Retry-After'])
+
+    def test_fail_asgi_load_shed(self):
+        app = asgi.create_app({'DATABASE_URL': self.database_path,
+                               'MAX_QUEUE_MS': 500})
+        started = int((time.time() - 2) * 1000)
+        with TestClient(app) as client:
+            res = client.get(
+                '/actors', headers={"Authorization": f"Bearer {ca_cred}",
+                                    "X-Request-Start": str(started)})
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.json()['success'], False)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,143 @@
+import json
+import os
+import time
+from flask import g, request
+from querylog import query_stats
+
+
+'''
+Request timing
+With SERVER_TIMING=1 every response carries a Server-Timing header that
+splits the request into
+
+    auth: token parsing, verification and the permission check
+    db: time spent executing SQL statements (desc holds the query count)
+    serialize: formatting rows and encoding the JSON body
+    total: the whole request, up to the response being returned
+
+With TIMING_LOG=1 the same numbers are printed as one JSON line per
+request. Blocks are timed exclusive of the SQL they run, so a lazy load
+during serialization counts towards db only. Streamed bodies are sent after
+the response is returned and are not included.
+
+The db numbers come from the query counters of querylog.py. Both settings
+are kept per app in app.extensions['timing']. When both are off nothing is
+registered on the app, requests carry no timer and timed() hands back a
+shared no-op context.
+'''
+
+
+def _flag(value):
+    return str(value).lower() not in ('', '0', 'false', 'no')
+
+
+def _db_seconds():
+    stats = query_stats()
+    return stats.seconds if stats is not None else 0.0
+
+
+class RequestTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = {}
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def header(self):
+        parts = [f'{name};dur={seconds * 1000:.2f}'
+                 for name, seconds in self.durations.items()]
+        stats = query_stats()
+        if stats.count:
+            parts.append(f'db;dur={stats.seconds * 1000:.2f};'
+                         f'desc="{stats.count} queries"')
+        parts.append(f'total;dur={self.total() * 1000:.2f}')
+        return ', '.join(parts)
+
+    def record(self, status):
+        stats = query_stats()
+        entry = {
+            'event': 'timing',
+            'method': request.method,
+            'path': request.path,
+            'status': status,
+            'queries': stats.count
+        }
+        for name, seconds in self.durations.items():
+            entry[f'{name}_ms'] = round(seconds * 1000, 2)
+        if stats.count:
+            entry['db_ms'] = round(stats.seconds * 1000, 2)
+        entry['total_ms'] = round(self.total() * 1000, 2)
+        return entry
+
+
+class _Timed:
+    __slots__ = ('name', 'timer', 'started', 'db_before')
+
+    def __init__(self, name, timer):
+        self.name = name
+        self.timer = timer
+
+    def __enter__(self):
+        self.db_before = _db_seconds()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        elapsed -= _db_seconds() - self.db_before
+        self.timer.add(self.name, elapsed)
+        return False
+
+
+class _NotTimed:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOT_TIMED = _NotTimed()
+
+
+# Times the block as part of the current request's Server-Timing entry
+# No-op outside a request or when timing is off for the app
+def timed(name):
+    timer = g.get('timer') if g else None
+    if timer is None:
+        return _NOT_TIMED
+    return _Timed(name, timer)
+
+
+# sets up request timing for the app
+# SERVER_TIMING and TIMING_LOG are read from the app config
+# or the environment
+def setup_timing(app):
+    header = _flag(app.config.get(
+        'SERVER_TIMING', os.environ.get('SERVER_TIMING', '')))
+    log = _flag(app.config.get(
+        'TIMING_LOG', os.environ.get('TIMING_LOG', '')))
+    app.extensions['timing'] = {'header': header, 'log': log}
+    if not (header or log):
+        return
+
+    @app.before_request
+    def start_timer():
+        g.timer = RequestTimer()
+
+    @app.after_request
+    def add_timing(response):
+        timer = g.get('timer')
+        if timer is None:
+            return response
+        if header:
+            response.headers['Server-Timing'] = timer.header()
+        if log:
+            print(json.dumps(timer.record(response.status_code)))
+        return response
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+Verified token cache
+A bounded LRU of already verified JWT payloads, so clients that reuse the
+same bearer token skip the RS256 signature check and claims validation.
+
+    entries are keyed by a SHA-256 digest of the token, never the token
+    entries expire at the token's exp claim
+    each entry carries the token's permissions as a frozenset
+    AUTH_CACHE_SIZE sets the number of entries (default 1024, 0 disables)
+'''
+
+
+class VerifiedToken:
+    __slots__ = ('payload', 'permissions', 'expires_at')
+
+    def __init__(self, payload, expires_at):
+        self.payload = payload
+        self.permissions = frozenset(payload.get('permissions') or ())
+        self.expires_at = expires_at
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        if self.maxsize <= 0:
+            return None
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        exp = payload.get('exp')
+        entry = VerifiedToken(payload, exp)
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return entry
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+def create_token_cache():
+    return VerifiedTokenCache(int(os.environ.get('AUTH_CACHE_SIZE', 1024)))
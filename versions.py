@@ -0,0 +1,214 @@
+import hashlib
+import os
+from collections import namedtuple
+from flask import request, Response
+from sqlalchemy import event, text
+from models import db, catalogue_version, row_versions
+
+
+'''
+Catalogue and row versions
+GET responses carry a strong ETag derived from versions the database keeps
+up to date, so a matching If-None-Match is answered with a 304 after one
+small query, without loading or serializing the rows.
+
+    catalogue_version: a single row with a counter bumped by every
+    transaction writing actors, movies or the casting, and a random nonce
+    set when the table is created, so a rebuilt database never matches
+    ETags handed out before
+    row_versions: a version per actor and movie, renewed by every insert
+    and update of the row and dropped with it
+
+Triggers maintain both in the transaction of the write, whichever path
+made it (any dyno, manage.py, the ASGI app or plain SQL). On Postgres row
+versions come from a sequence and the catalogue counter is bumped once per
+transaction by a deferred trigger, so concurrent writers only queue on it
+while they commit; SQLite has a single writer and bumps it for every row.
+
+List ETags, and the ETags of responses embedding other tables, include the
+catalogue version; plain detail ETags only the version of their row. A row
+without a version (deleted or never written) reads as version 0. The
+versions are read through the session of the request, so a request routed
+to a replica gets the versions of the rows it reads (see replicas.py).
+The triggers are created by migration 0005 and by db.create_all().
+'''
+
+
+# tables whose rows are versioned, and every table of the catalogue
+VERSIONED = ('actors', 'movies')
+CATALOGUE = VERSIONED + ('movie_actors',)
+
+VERSIONS_SQL = text(
+    'SELECT catalogue_version.nonce, catalogue_version.version, '
+    'COALESCE((SELECT row_versions.version FROM row_versions '
+    'WHERE row_versions.table_name = :table '
+    'AND row_versions.row_id = :row_id), 0) '
+    'FROM catalogue_version')
+
+Versions = namedtuple('Versions', ['nonce', 'catalogue', 'row'])
+
+
+def _postgresql_triggers():
+    statements = [
+        'CREATE SEQUENCE IF NOT EXISTS row_version_seq',
+        '''CREATE OR REPLACE FUNCTION row_version()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM row_versions
+        WHERE table_name = TG_TABLE_NAME AND row_id = OLD.id;
+    ELSE
+        INSERT INTO row_versions (table_name, row_id, version)
+        VALUES (TG_TABLE_NAME, NEW.id, nextval('row_version_seq'))
+        ON CONFLICT (table_name, row_id)
+        DO UPDATE SET version = excluded.version;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql''',
+        # runs at commit, once per transaction
+        '''CREATE OR REPLACE FUNCTION bump_catalogue_version()
+RETURNS trigger AS $$
+BEGIN
+    IF current_setting('casting.catalogue_bumped', true)
+            IS DISTINCT FROM 'on' THEN
+        UPDATE catalogue_version SET version = version + 1;
+        PERFORM set_config('casting.catalogue_bumped', 'on', true);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql''',
+        # TRUNCATE skips the row triggers
+        '''CREATE OR REPLACE FUNCTION truncate_versions()
+RETURNS trigger AS $$
+BEGIN
+    DELETE FROM row_versions WHERE table_name = TG_TABLE_NAME;
+    UPDATE catalogue_version SET version = version + 1;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+    ]
+    for table in CATALOGUE:
+        # fires after {table}_catalogue_stats_apply of stats.py, whose
+        # name sorts first, so the summary rows are locked before this one
+        triggers = [
+            ('catalogue_version', 'CONSTRAINT TRIGGER', 'INSERT OR UPDATE '
+             'OR DELETE', 'DEFERRABLE INITIALLY DEFERRED FOR EACH ROW',
+             'bump_catalogue_version'),
+            ('truncate_versions', 'TRIGGER', 'TRUNCATE',
+             'FOR EACH STATEMENT', 'truncate_versions')
+        ]
+        if table in VERSIONED:
+            triggers.append(('row_version', 'TRIGGER', 'INSERT OR UPDATE '
+                             'OR DELETE', 'FOR EACH ROW', 'row_version'))
+        for name, kind, events, when, function in triggers:
+            statements += [
+                f'DROP TRIGGER IF EXISTS {table}_{name} ON {table}',
+                f'CREATE {kind} {table}_{name}\nAFTER {events} ON {table}\n'
+                f'{when} EXECUTE PROCEDURE {function}()'
+            ]
+    return statements
+
+
+def _sqlite_triggers():
+    bump = 'UPDATE catalogue_version SET version = version + 1'
+    statements = []
+    for table in CATALOGUE:
+        for name, row in (('insert', 'NEW'), ('update', 'NEW'),
+                          ('delete', 'OLD')):
+            body = [bump]
+            if table in VERSIONED and row == 'NEW':
+                body.append(
+                    'INSERT INTO row_versions (table_name, row_id, version) '
+                    f"SELECT '{table}', NEW.id, version "
+                    'FROM catalogue_version WHERE true '
+                    'ON CONFLICT (table_name, row_id) '
+                    'DO UPDATE SET version = excluded.version')
+            elif table in VERSIONED:
+                body.append('DELETE FROM row_versions '
+                            f"WHERE table_name = '{table}' "
+                            'AND row_id = OLD.id')
+            body = ''.join(f'    {statement};\n' for statement in body)
+            statements.append(
+                f'CREATE TRIGGER IF NOT EXISTS {table}_versions_{name}\n'
+                f'AFTER {name.upper()} ON {table}\nBEGIN\n{body}END')
+    return statements
+
+
+# Returns the statements creating the version triggers of the dialect
+def trigger_statements(dialect):
+    if dialect == 'postgresql':
+        return _postgresql_triggers()
+    return _sqlite_triggers()
+
+
+# Gives every actor and movie without a version one
+def fill_row_versions(connection):
+    if connection.dialect.name == 'postgresql':
+        version = "nextval('row_version_seq')"
+    else:
+        version = '(SELECT version FROM catalogue_version)'
+    for table in VERSIONED:
+        connection.execute(text(
+            'INSERT INTO row_versions (table_name, row_id, version) '
+            f"SELECT '{table}', id, {version} FROM {table} "
+            'WHERE NOT EXISTS (SELECT 1 FROM row_versions '
+            f"WHERE table_name = '{table}' AND row_id = {table}.id)"))
+
+
+# create_all() builds the triggers along with the tables, the nonce of a
+# new database and the versions of rows it already holds
+@event.listens_for(db.Model.metadata, 'after_create')
+def create_version_triggers(metadata, connection, tables=(), **kw):
+    if connection.dialect.name not in ('postgresql', 'sqlite'):
+        return
+    for statement in trigger_statements(connection.dialect.name):
+        connection.execute(text(statement))
+    if catalogue_version in tables:
+        connection.execute(catalogue_version.insert().values(
+            id=1, nonce=os.urandom(16).hex(), version=1))
+    if row_versions in tables:
+        fill_row_versions(connection)
+
+
+# Returns the statement reading the versions, with the version of a row
+# when table and row_id are given
+def versions_statement(table=None, row_id=None):
+    return VERSIONS_SQL.bindparams(table=table, row_id=row_id)
+
+
+# Reads the versions in the session of the Flask request
+def read_versions(table=None, row_id=None):
+    return Versions(*db.session.execute(
+        versions_statement(table, row_id)).one())
+
+
+def _etag(versions, *parts):
+    raw = ':'.join(str(part) for part in (versions.nonce,) + parts)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+# ETag of a list response, covering the whole catalogue and the query
+# string (path defaults to the full path of the Flask request)
+def table_etag(versions, table, path=None):
+    if path is None:
+        path = request.full_path
+    return _etag(versions, table, versions.catalogue, path)
+
+
+# ETag of a detail response, covering a single row, or the whole catalogue
+# too when the response embeds related tables
+def row_etag(versions, table, row_id, *related, path=None):
+    if path is None:
+        path = request.full_path
+    catalogue = versions.catalogue if related else None
+    return _etag(versions, table, row_id, versions.row, catalogue, path)
+
+
+# Returns a 304 response if the client already holds the representation
+def not_modified(etag):
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
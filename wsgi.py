@@ -0,0 +1,16 @@
+from app import create_app
+
+
+'''
+WSGI entry point
+gunicorn --config gunicorn.conf.py wsgi:app
+
+Importing app.py only defines the factory; the app is built here, once per
+process (once in total with preload_app). The JWKS is fetched here too
+rather than in create_app(), so manage.py, the tests and the benchmarks
+build an app without touching the network.
+'''
+
+
+app = create_app()
+app.extensions['jwks'].warm()